@@ -0,0 +1,63 @@
+'''Cost of interpolating the GPS position for a sample.
+
+Fixes are appended at 10 Hz and the position is looked up for every sample,
+with growing history sizes. For comparison, the two fixes around the time
+are searched with a linear scan.
+
+usage: python benchmarks/bench_fixhistory.py [--lookups N]
+'''
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from collections.abc import Sequence
+
+from crowdbike.fixhistory import FixHistory
+
+
+def _history(capacity: int) -> FixHistory:
+    history = FixHistory(capacity=capacity)
+    for i in range(capacity):
+        history.append(i / 10, 51.4 + i * 1e-5, 7.2 + i * 1e-5, 100, 10.8)
+    return history
+
+
+def bench_bisect(history: FixHistory, times: list[float]) -> float:
+    start = time.perf_counter()
+    for t in times:
+        history.at(t)
+    return (time.perf_counter() - start) / len(times) * 1e6
+
+
+def bench_linear(history: FixHistory, times: list[float]) -> float:
+    fix_times = history._times
+    start = time.perf_counter()
+    for t in times:
+        # the first fix after t
+        next(
+            (i for i, fix_time in enumerate(fix_times) if fix_time > t),
+            len(fix_times),
+        )
+    return (time.perf_counter() - start) / len(times) * 1e6
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=20_000)
+    args = parser.parse_args(argv)
+
+    print(f'{"fixes":>7} {"bisect µs":>10} {"linear µs":>10}')
+    for capacity in (10, 64, 600, 6000):
+        history = _history(capacity)
+        rnd = random.Random(capacity)
+        times = [rnd.uniform(0, capacity / 10) for _ in range(args.lookups)]
+        print(
+            f'{capacity:>7} {bench_bisect(history, times):>10.2f} '
+            f'{bench_linear(history, times):>10.2f}',
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
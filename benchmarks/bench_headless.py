@@ -0,0 +1,107 @@
+'''Memory and CPU usage of the headless mode compared to the GUI.
+
+Both modes are started as subprocesses and sampled from ``/proc`` while
+they are recording. This needs to be run on the Raspberry Pi with the
+sensors connected and, for the GUI, a display (e.g. via VNC).
+
+usage: python benchmarks/bench_headless.py [--duration S] [--stationary]
+'''
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from collections.abc import Sequence
+from typing import NamedTuple
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+class Usage(NamedTuple):
+    # resident set size in KiB
+    rss: int
+    # user + system CPU time in seconds
+    cpu: float
+
+
+def _usage(pid: int) -> Usage:
+    with open(f'/proc/{pid}/status') as f:
+        rss = next(
+            int(line.split()[1]) for line in f if line.startswith('VmRSS:')
+        )
+    with open(f'/proc/{pid}/stat') as f:
+        # the command name may contain spaces, the fields start after it
+        fields = f.read().rpartition(')')[2].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return Usage(rss=rss, cpu=(utime + stime) / CLK_TCK)
+
+
+def measure(
+        args: list[str],
+        duration: float,
+        warmup: float,
+) -> tuple[Usage, float]:
+    '''returns the peak RSS and the mean CPU load in % of one core'''
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'crowdbike.main', *args],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        time.sleep(warmup)
+        if proc.poll() is not None:
+            raise SystemExit(f'{args} exited with {proc.returncode}')
+        start = _usage(proc.pid)
+        start_time = time.monotonic()
+        usage = start
+        peak = start.rss
+        while time.monotonic() - start_time < duration:
+            time.sleep(1)
+            usage = _usage(proc.pid)
+            peak = max(peak, usage.rss)
+        load = (usage.cpu - start.cpu) / (time.monotonic() - start_time)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return Usage(rss=peak, cpu=usage.cpu), load * 100
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=120,
+        help='seconds to sample each mode for, default: 120',
+    )
+    parser.add_argument(
+        '--warmup',
+        type=float,
+        default=15,
+        help='seconds to wait for the sensors to start, default: 15',
+    )
+    parser.add_argument('--stationary', action='store_true')
+    args = parser.parse_args(argv)
+
+    run_args = ['run', '--stationary'] if args.stationary else ['run']
+    modes = {
+        'headless': [*run_args, '--headless'],
+        'gui': run_args,
+    }
+    print(f'{"mode":<10} {"peak RSS MiB":>12} {"CPU %":>7} {"CPU s":>7}')
+    for mode, mode_args in modes.items():
+        usage, load = measure(mode_args, args.duration, args.warmup)
+        print(
+            f'{mode:<10} {usage.rss / 1024:>12.1f} {load:>7.1f} '
+            f'{usage.cpu:>7.1f}',
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,97 @@
+'''Pin writes of the status light while the sensor threads are blinking.
+
+Three threads flash their LED as the sensor threads do. The previous
+``update_led`` wrote all three pins on every call (and switched the other
+LEDs off), the :class:`LedManager` only writes the pins that changed. The
+writes are counted with a backend that does not need GPIOs.
+
+usage: python benchmarks/bench_led.py [--seconds S]
+'''
+from __future__ import annotations
+
+import argparse
+import threading
+import time
+from collections.abc import Callable
+from collections.abc import Sequence
+
+from crowdbike.led import LedManager
+from crowdbike.led import PINS
+
+# LED and blink interval in seconds, as the sensor threads
+SENSORS = {'red': .2, 'yellow': 1, 'green': .1}
+
+
+class CountingBackend:
+    def __init__(self) -> None:
+        self.writes = 0
+
+    def setup(self, pins: list[int]) -> None:
+        pass
+
+    def output(self, pin: int, on: bool) -> None:
+        self.writes += 1
+
+    def cleanup(self) -> None:
+        pass
+
+
+def _blink(
+        switch: Callable[[str, bool], None],
+        led: str,
+        interval: float,
+        stop: threading.Event,
+) -> None:
+    while not stop.is_set():
+        switch(led, True)
+        stop.wait(interval / 2)
+        switch(led, False)
+        stop.wait(interval / 2)
+
+
+def run(switch: Callable[[str, bool], None], seconds: float) -> None:
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_blink, args=(switch, led, interval, stop))
+        for led, interval in SENSORS.items()
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    # the previous update_led: every call writes all pins
+    old = CountingBackend()
+    lock = threading.Lock()
+    calls = 0
+
+    def update_led(led: str, on: bool) -> None:
+        nonlocal calls
+        with lock:
+            calls += 1
+            for name, pin in PINS.items():
+                old.output(pin, on and name == led)
+
+    run(update_led, args.seconds)
+
+    new = CountingBackend()
+    manager = LedManager(backend=new)
+    run(lambda led, on: manager.set(**{led: on}), args.seconds)
+    manager.close()
+
+    print(f'{calls} LED changes in {args.seconds:.0f}s')
+    print(f'update_led: {old.writes:>6} pin writes')
+    print(f'LedManager: {new.writes:>6} pin writes')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+'''Per-sample cost of writing measurement rows.
+
+Compares the persistent ``LogWriter`` with the previous approach, which
+re-read the whole logfile on every sample to determine the record counter.
+The cost per sample is reported at increasing row counts, it should stay
+flat for the ``LogWriter``.
+
+usage: python benchmarks/bench_logwriter.py [--rows N] [--legacy-rows N]
+'''
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from collections.abc import Sequence
+
+from crowdbike.writer import LogWriter
+from crowdbike.writer import Sample
+
+SAMPLE = Sample(
+    raspberry_time='2024-06-01 12:00:00',
+    gps_time='2024-06-01 12:00:00',
+    altitude=112.5,
+    latitude=51.445,
+    longitude=7.262,
+    speed=18.3,
+    temperature=21.352,
+    temperature_raw=21.35215,
+    rel_humidity=55.123,
+    rel_humidity_raw=55.12345,
+    vapour_pressure=1.40123,
+    pm10=float('nan'),
+    pm2_5=float('nan'),
+)
+WINDOW = 1000
+
+
+def _checkpoints(rows: int) -> list[int]:
+    points = []
+    n = 1
+    while n < rows:
+        points.append(n)
+        n *= 10
+    points.append(rows)
+    return points
+
+
+def _legacy_write(logfile: str, counter: int) -> int:
+    '''the previous implementation of ``count()``, kept for comparison'''
+    with open(logfile, 'a+') as f0:
+        f0.seek(0)
+        counter = len(f0.readlines()) - 1
+        f0.write(f'01,{counter},{SAMPLE.raspberry_time},')
+        f0.write(f'{SAMPLE.gps_time},')
+        f0.write(f'{SAMPLE.altitude:.3f}' + ',')
+        f0.write(f'{SAMPLE.latitude:.6f}' + ',')
+        f0.write(f'{SAMPLE.longitude:.6f}' + ',')
+        f0.write(f'{SAMPLE.speed:.1f}' + ',')
+        f0.write(f'{SAMPLE.temperature},{SAMPLE.temperature_raw},')
+        f0.write(f'{SAMPLE.rel_humidity},{SAMPLE.rel_humidity_raw},')
+        f0.write(f'{SAMPLE.vapour_pressure},{SAMPLE.pm10},{SAMPLE.pm2_5},')
+        f0.write('b8:27:eb:00:00:00,1,0.10.0\n')
+    return counter
+
+
+def bench_writer(path: str, rows: int) -> None:
+    checkpoints = _checkpoints(rows)
+    with LogWriter(
+        path, pi_id='01', mac='b8:27:eb:00:00:00', sensor_id='1',
+        version='0.10.0',
+    ) as writer:
+        done = 0
+        for point in checkpoints:
+            # write up to the checkpoint, then time a window of samples
+            while done < point - WINDOW:
+                writer.write(SAMPLE)
+                done += 1
+            start = time.perf_counter()
+            n = point - done
+            for _ in range(n):
+                writer.write(SAMPLE)
+            done += n
+            per_sample = (time.perf_counter() - start) / max(n, 1)
+            print(f'{"LogWriter":<10} row {point:>9,}: {per_sample * 1e6:8.2f} µs/sample')  # noqa: E501
+
+
+def bench_legacy(path: str, rows: int) -> None:
+    with open(path, 'w') as f:
+        f.write('header\n')
+
+    counter = 0
+    for point in _checkpoints(rows):
+        while counter < point - 1:
+            counter = _legacy_write(path, counter) + 1
+        start = time.perf_counter()
+        counter = _legacy_write(path, counter) + 1
+        per_sample = time.perf_counter() - start
+        print(f'{"legacy":<10} row {point:>9,}: {per_sample * 1e6:8.2f} µs/sample')  # noqa: E501
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--legacy-rows', type=int, default=10_000)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bench_writer(os.path.join(tmpdir, 'writer.csv'), args.rows)
+        if args.legacy_rows > 0:
+            bench_legacy(os.path.join(tmpdir, 'legacy.csv'), args.legacy_rows)
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
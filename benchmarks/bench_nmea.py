@@ -0,0 +1,101 @@
+'''Sentences parsed per second by the NMEA parser, replaying a log.
+
+A log can be recorded on the Raspberry Pi with e.g.
+``timeout 600 cat /dev/ttyS0 > ride.nmea``. Without ``--log``, a synthetic
+10 Hz ride is generated, which also contains the GSA and GSV sentences the
+receiver sends by default. ``--write`` stores it, so it can be replayed.
+
+The log is fed in chunks of different sizes, as they are read from the
+UART. If ``adafruit-circuitpython-gps`` (used before) is installed, it is
+run on the same log for comparison, reading one line per ``update()``.
+
+usage: python benchmarks/bench_nmea.py [--log FILE] [--write FILE]
+'''
+from __future__ import annotations
+
+import argparse
+import io
+import time
+from collections.abc import Sequence
+
+from crowdbike.nmea import NmeaParser
+from crowdbike.simulation import synthetic_nmea
+
+
+def bench_parser(
+        log: bytes,
+        chunk_size: int,
+) -> tuple[float, int, NmeaParser]:
+    parser = NmeaParser()
+    fixes = 0
+    start = time.perf_counter()
+    for i in range(0, len(log), chunk_size):
+        fixes += len(parser.feed(log[i:i + chunk_size], time.monotonic()))
+    return time.perf_counter() - start, fixes, parser
+
+
+class _Uart(io.BytesIO):
+    @property
+    def in_waiting(self) -> int:
+        return len(self.getbuffer()) - self.tell()
+
+
+def bench_adafruit(log: bytes) -> tuple[float, int] | None:
+    try:
+        import adafruit_gps
+    except ImportError:
+        return None
+    gps = adafruit_gps.GPS(_Uart(log))
+    lines = log.count(b'\n')
+    start = time.perf_counter()
+    for _ in range(lines):
+        gps.update()
+    return time.perf_counter() - start, lines
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', help='file with a recorded NMEA log')
+    parser.add_argument('--write', help='store the synthetic log in a file')
+    parser.add_argument(
+        '--seconds',
+        type=int,
+        default=600,
+        help='duration of the synthetic 10 Hz ride, default: 600',
+    )
+    args = parser.parse_args(argv)
+
+    if args.log:
+        with open(args.log, 'rb') as f:
+            log = f.read()
+    else:
+        log = synthetic_nmea(args.seconds)
+        if args.write:
+            with open(args.write, 'wb') as f:
+                f.write(log)
+    lines = log.count(b'\n')
+    print(f'log: {len(log):,} bytes, {lines:,} sentences\n')
+
+    print(
+        f'{"chunk":>6} {"sentences/s":>12} {"lines/s":>10} {"fixes":>7} '
+        f'{"checksum errors":>16}',
+    )
+    for chunk_size in (64, 512, 4096):
+        duration, fixes, nmea = bench_parser(log, chunk_size)
+        print(
+            f'{chunk_size:>6} {nmea.sentences / duration:>12,.0f} '
+            f'{lines / duration:>10,.0f} {fixes:>7} '
+            f'{nmea.checksum_errors:>16}',
+        )
+
+    result = bench_adafruit(log)
+    if result is None:
+        print('\nadafruit_gps is not installed, skipping the comparison')
+    else:
+        duration, updates = result
+        print(f'\nadafruit_gps: {updates / duration:,.0f} lines/s')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,135 @@
+'''Cost of buffering and aggregating sensor readings per log interval.
+
+Readings are appended at increasing sensor rates and aggregated once per
+sampling interval, as done by the sensor threads and the logging. For
+comparison, the same aggregates are computed from a plain list using the
+``statistics`` module.
+
+usage: python benchmarks/bench_ringbuffer.py [--interval S] [--ticks N]
+'''
+from __future__ import annotations
+
+import argparse
+import math
+import random
+import statistics
+import time
+import tracemalloc
+from collections.abc import Sequence
+
+from crowdbike.ringbuffer import RingBuffer
+
+FIELDS = ('temperature_raw', 'rel_humidity_raw')
+
+
+def _readings(n: int, seed: int) -> list[tuple[float, float]]:
+    rnd = random.Random(seed)
+    return [
+        (
+            float('nan') if rnd.random() < .01 else rnd.gauss(21, .1),
+            rnd.gauss(55, .5),
+        )
+        for _ in range(n)
+    ]
+
+
+def bench_ringbuffer(
+        readings: list[tuple[float, float]],
+        per_tick: int,
+        ticks: int,
+) -> tuple[float, float]:
+    '''returns the mean cost of an append and of an aggregation in µs'''
+    buffer = RingBuffer(2 * per_tick, FIELDS)
+    append = aggregate = 0.0
+    for _ in range(ticks):
+        start = time.perf_counter()
+        for r in readings:
+            buffer.append(r)
+        append += time.perf_counter() - start
+
+        start = time.perf_counter()
+        buffer.aggregate()
+        aggregate += time.perf_counter() - start
+    return (
+        append / (ticks * per_tick) * 1e6,
+        aggregate / ticks * 1e6,
+    )
+
+
+def bench_statistics(
+        readings: list[tuple[float, float]],
+        per_tick: int,
+        ticks: int,
+) -> tuple[float, float]:
+    append = aggregate = 0.0
+    for _ in range(ticks):
+        start = time.perf_counter()
+        values: list[tuple[float, float]] = []
+        for r in readings:
+            values.append(r)
+        append += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(len(FIELDS)):
+            valid = [v[i] for v in values if not math.isnan(v[i])]
+            if valid:
+                statistics.fmean(valid)
+                min(valid)
+                max(valid)
+                statistics.pstdev(valid)
+        aggregate += time.perf_counter() - start
+    return (
+        append / (ticks * per_tick) * 1e6,
+        aggregate / ticks * 1e6,
+    )
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=5,
+        help='sampling interval (seconds between two rows), default: 5',
+    )
+    parser.add_argument('--ticks', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    print(
+        f'{"rate":>6} {"readings":>8} '
+        f'{"append µs":>10} {"aggregate µs":>13} '
+        f'{"stats append µs":>16} {"stats aggregate µs":>19}',
+    )
+    for rate in (5, 10, 20, 50, 100):
+        per_tick = math.ceil(rate * args.interval)
+        readings = _readings(per_tick, seed=rate)
+        rb_append, rb_aggregate = bench_ringbuffer(
+            readings, per_tick, args.ticks,
+        )
+        st_append, st_aggregate = bench_statistics(
+            readings, per_tick, args.ticks,
+        )
+        print(
+            f'{rate:>4}Hz {per_tick:>8} '
+            f'{rb_append:>10.2f} {rb_aggregate:>13.1f} '
+            f'{st_append:>16.2f} {st_aggregate:>19.1f}',
+        )
+
+    # memory does not grow with the number of readings
+    tracemalloc.start()
+    buffer = RingBuffer(100, FIELDS)
+    readings = _readings(1000, seed=0)
+    for _ in range(1000):
+        for r in readings:
+            buffer.append(r)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f'\n1,000,000 readings without aggregating: peak {peak / 1024:.1f} '
+        f'KiB traced, {buffer.overwritten:,} overwritten',
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
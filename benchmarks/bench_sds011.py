@@ -0,0 +1,108 @@
+'''Throughput of the SDS011 frame parser on a recorded byte stream.
+
+The stream is fed to the parser in chunks of different sizes, as returned by
+``serial.read()``. For comparison, the previous approach of reading fixed 10
+byte blocks and checking the bytes at fixed positions is run on the same
+stream, which loses every frame after the first misaligned byte.
+
+A stream can be recorded on the Raspberry Pi with e.g.
+``timeout 600 cat /dev/ttyUSB0 > sds011.bin``. Without ``--stream``, a
+synthetic stream with corrupted and dropped bytes is generated.
+
+usage: python benchmarks/bench_sds011.py [--stream FILE] [--frames N]
+'''
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from collections.abc import Sequence
+
+from crowdbike.sds011 import data_frame
+from crowdbike.sds011 import FRAME_SIZE
+from crowdbike.sds011 import FrameParser
+from crowdbike.sds011 import TAIL
+
+
+def synthetic_stream(frames: int, seed: int = 0) -> bytes:
+    '''frames with 0.1 % corrupted and 0.1 % dropped bytes'''
+    rnd = random.Random(seed)
+    stream = bytearray()
+    for _ in range(frames):
+        frame = bytearray(
+            data_frame(rnd.randint(0, 2000) / 10, rnd.randint(0, 4000) / 10),
+        )
+        for i in range(FRAME_SIZE):
+            r = rnd.random()
+            if r < .001:
+                frame[i] = rnd.randint(0, 255)
+            elif r < .002:
+                del frame[i]
+                break
+        stream += frame
+    return bytes(stream)
+
+
+def bench_parser(stream: bytes, chunk_size: int) -> tuple[float, FrameParser]:
+    parser = FrameParser()
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        parser.feed(stream[i:i + chunk_size])
+    return time.perf_counter() - start, parser
+
+
+def bench_fixed(stream: bytes) -> tuple[float, int]:
+    '''the previous parsing: blocks of 10 bytes at fixed positions'''
+    valid = 0
+    start = time.perf_counter()
+    for i in range(0, len(stream) - FRAME_SIZE + 1, FRAME_SIZE):
+        data = stream[i:i + FRAME_SIZE]
+        if (
+                data[0] == 0xAA and data[1] == 0xC0 and data[9] == TAIL and
+                sum(data[2:8]) % 256 == data[8]
+        ):
+            valid += 1
+    return time.perf_counter() - start, valid
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', help='file with a recorded byte stream')
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=100_000,
+        help='number of frames of the synthetic stream, default: 100000',
+    )
+    args = parser.parse_args(argv)
+
+    if args.stream:
+        with open(args.stream, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(args.frames)
+    print(f'stream: {len(stream):,} bytes\n')
+
+    print(
+        f'{"chunk":>6} {"MB/s":>8} {"frames/s":>11} {"frames":>8} '
+        f'{"checksum errors":>16} {"skipped bytes":>14}',
+    )
+    for chunk_size in (1, 10, 64, 4096):
+        duration, frame_parser = bench_parser(stream, chunk_size)
+        print(
+            f'{chunk_size:>6} {len(stream) / duration / 1e6:>8.2f} '
+            f'{frame_parser.frames / duration:>11,.0f} '
+            f'{frame_parser.frames:>8} {frame_parser.checksum_errors:>16} '
+            f'{frame_parser.skipped:>14}',
+        )
+
+    duration, valid = bench_fixed(stream)
+    print(
+        f'\nfixed 10 byte blocks: {len(stream) / duration / 1e6:.2f} MB/s, '
+        f'{valid} valid frames',
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
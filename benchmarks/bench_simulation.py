@@ -0,0 +1,126 @@
+'''Stress test of ``crowdbike run`` with simulated sensors.
+
+``crowdbike run --headless`` is started as a subprocess with the simulation
+configured by the ``CROWDBIKE_SIMULATION`` environment variable, so it runs
+on any computer, using the configuration created by ``crowdbike init``. The
+sensors are replayed ``--speed`` times faster than real time with the given
+faults. Afterwards, the failed readings, the rows written and the missed
+ticks are counted from its log.
+
+usage: python benchmarks/bench_simulation.py [--duration S] [--speed X]
+    [--garbage P] [--stall P] [--disconnect P] [--error P]
+'''
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Sequence
+
+FAULTS = ('garbage', 'drop', 'stall', 'disconnect', 'error')
+
+
+def run(
+        simulation: dict[str, object],
+        duration: float,
+        stationary: bool,
+        logfile: str,
+) -> int:
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump(simulation, f)
+        f.flush()
+        args = ['run', '--headless', '--logfile', logfile]
+        args += ['--loglevel', 'INFO']
+        if stationary:
+            args.append('--stationary')
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'crowdbike.main', *args],
+            env={**os.environ, 'CROWDBIKE_SIMULATION': f.name},
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            time.sleep(duration)
+            if proc.poll() is not None:
+                raise SystemExit(f'crowdbike exited with {proc.returncode}')
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return proc.returncode
+
+
+def summarize(log: str) -> None:
+    failed = collections.Counter(
+        re.findall(r'failed reading (\w+): (.*)', log),
+    )
+    for (sensor, error), count in sorted(failed.items()):
+        print(f'  {count:>6}x {sensor}: {error}')
+    patterns = (
+        r'sampling: stopped after .*',
+        r'closed \S+: \d+ rows written.*',
+        r'closed GPS UART port: .*',
+        r'PM sensor stopped: .*',
+    )
+    for pattern in patterns:
+        for line in re.findall(pattern, log):
+            print(f'  {line}')
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=60,
+        help='seconds to record for, default: 60',
+    )
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=100,
+        help='times faster than real time, default: 100',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stationary', action='store_true')
+    for fault in FAULTS:
+        parser.add_argument(
+            f'--{fault}',
+            type=float,
+            default=0,
+            help=f'probability of a {fault} fault',
+        )
+    parser.add_argument('--nmea', help='recorded NMEA stream')
+    parser.add_argument('--sds011', help='recorded SDS011 stream')
+    parser.add_argument('--temp-hum', help='csv file with temperature/rh')
+    args = parser.parse_args(argv)
+
+    simulation = {
+        'speed': args.speed,
+        'seed': args.seed,
+        'faults': {f: getattr(args, f) for f in FAULTS},
+        'nmea': args.nmea,
+        'sds011': args.sds011,
+        'temp_hum': args.temp_hum,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        logfile = os.path.join(tmp, 'crowdbike.log')
+        returncode = run(simulation, args.duration, args.stationary, logfile)
+        with open(logfile) as f:
+            log = f.read()
+
+    print(f'{args.duration:.0f}s at {args.speed:g}x, exit code {returncode}')
+    summarize(log)
+    return returncode
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,105 @@
+'''Import time of the ``crowdbike`` command and of each of its commands.
+
+Uses ``python -X importtime`` in a fresh interpreter and takes the fastest
+of ``--repeat`` runs. Fails (exit code 1) if importing ``crowdbike.main``
+takes longer than ``--budget`` milliseconds or if it imports one of the
+heavy modules that only some commands need, so startup regressions are
+caught. The default budget is meant for a desktop computer, use a higher
+one on the Raspberry Pi.
+
+usage: python benchmarks/bench_startup.py [--budget MS] [--repeat N]
+'''
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+from collections.abc import Sequence
+
+# only imported by the commands that need them
+HEAVY = (
+    'numpy', 'tkinter', 'serial', 'RPi', 'adafruit_dht', 'board',
+    'sensirion_i2c_driver', 'sensirion_i2c_sht', 'http.client',
+    'concurrent.futures', 'importlib.metadata', 'importlib.resources',
+)
+# the modules each command imports in addition to crowdbike.main
+COMMANDS = {
+    'upload': ('crowdbike.upload',),
+    'export': ('crowdbike.binlog',),
+    'process': ('crowdbike.process',),
+    'calibrate': ('crowdbike.calibrate',),
+    'run': ('crowdbike.recorder', 'crowdbike.sensors', 'crowdbike.simulation'),
+}
+
+
+def importtime(modules: Sequence[str]) -> dict[str, tuple[int, int]]:
+    '''self and cumulative import time in µs per module'''
+    code = ';'.join(f'import {m}' for m in modules)
+    out = subprocess.run(
+        (sys.executable, '-X', 'importtime', '-c', code),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative))
+    return times
+
+
+def fastest(modules: Sequence[str], repeat: int) -> dict[str, tuple[int, int]]:
+    runs = [importtime(modules) for _ in range(repeat)]
+    return min(runs, key=lambda r: sum(r[m][1] for m in modules))
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=60,
+        help='max. import time of crowdbike.main in ms, default: 60',
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    times = fastest(('crowdbike.main',), args.repeat)
+    main_ms = times['crowdbike.main'][1] / 1000
+    print(f'crowdbike.main: {main_ms:.1f} ms (budget {args.budget:.0f} ms)')
+    print('slowest modules (self time):')
+    for name, (self_us, _) in sorted(
+            times.items(), key=lambda t: t[1][0], reverse=True,
+    )[:10]:
+        print(f'  {self_us / 1000:>6.1f} ms  {name}')
+
+    print('\nadditional import time per command:')
+    for command, modules in COMMANDS.items():
+        try:
+            cmd_times = fastest(('crowdbike.main', *modules), args.repeat)
+        except subprocess.CalledProcessError as e:
+            # e.g. the drivers are not installed on this computer
+            error = e.stderr.strip().splitlines()[-1]
+            print(f'  {command:<9} failed: {error}')
+            continue
+        cmd_ms = sum(cmd_times[m][1] for m in modules) / 1000
+        print(f'  {command:<9} {cmd_ms:>6.1f} ms')
+
+    ok = True
+    heavy = sorted(
+        name for name in times
+        if name.split('.')[0] in HEAVY or name in HEAVY
+    )
+    if heavy:
+        print(f'\ncrowdbike.main imports {", ".join(heavy)}')
+        ok = False
+    if main_ms > args.budget:
+        print(f'\ncrowdbike.main exceeds the budget of {args.budget:.0f} ms')
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
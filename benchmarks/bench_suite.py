@@ -0,0 +1,497 @@
+'''Time and memory per operation of the acquisition and logging hot paths.
+
+The cases cover everything that runs per tick or per reading, the writers
+at growing file sizes, reprocessing a logfile and an upload to the local
+WebDAV stand-in server. The sensors use replayed streams, so this runs on
+any computer.
+
+Every case is timed in batches (best of ``--repeat``), then run once more
+with ``tracemalloc`` for the memory: ``peak`` is the most memory that was
+allocated at once during one call, ``retained`` what was still allocated
+afterwards, both per operation (not traced for the largest files, as that
+takes minutes). ``--json`` writes the results, which can be compared with
+those of another release using ``--compare``. This exits with 1 if a case
+got slower by more than ``--threshold``.
+
+usage: python benchmarks/bench_suite.py [--json FILE] [--compare FILE]
+    [--threshold F] [--filter TEXT] [--quick]
+'''
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from collections.abc import Iterator
+from collections.abc import Sequence
+from typing import Any
+from typing import NamedTuple
+from typing import Optional
+
+from crowdbike.binlog import BinaryLogWriter
+from crowdbike.helpers import sat_vappressure
+from crowdbike.helpers import vappressure
+from crowdbike.metrics import metrics
+from crowdbike.process import Calibration
+from crowdbike.process import process_file
+from crowdbike.recorder import Recorder
+from crowdbike.scheduler import Tick
+from crowdbike.sensors import GPS
+from crowdbike.sensors import PmSensor
+from crowdbike.sensors import SHT85
+from crowdbike.sensors import TempHumReading
+from crowdbike.simulation import Faults
+from crowdbike.simulation import nmea_epochs
+from crowdbike.simulation import sds011_frames
+from crowdbike.simulation import SimulatedSht3x
+from crowdbike.simulation import synthetic_nmea
+from crowdbike.simulation import synthetic_sds011
+from crowdbike.simulation import synthetic_temp_hum
+from crowdbike.upload import upload_to_cloud
+from crowdbike.writer import LogWriter
+from crowdbike.writer import Sample
+from testing.webdav_server import WebDavServer
+
+SAMPLE = Sample(
+    raspberry_time='2024-06-01 12:00:00',
+    gps_time='2024-06-01 12:00:00',
+    altitude=112.5,
+    latitude=51.445,
+    longitude=7.262,
+    speed=18.3,
+    temperature=21.352,
+    temperature_raw=21.35215,
+    rel_humidity=55.123,
+    rel_humidity_raw=55.12345,
+    vapour_pressure=1.40123,
+    pm10=12.3,
+    pm2_5=7.8,
+)
+WRITER_ROWS = (1_000, 10_000, 100_000, 1_000_000)
+LOGGER = logging.getLogger('bench')
+
+
+class Case(NamedTuple):
+    name: str
+    op: Callable[[], object]
+    # called before every batch, not timed
+    setup: Optional[Callable[[], object]] = None
+    # operations per call, e.g. rows written
+    per_call: int = 1
+    # calls per batch, found automatically if None
+    number: Optional[int] = None
+    # whether the memory is traced, this is slow for millions of allocations
+    trace: bool = True
+
+
+class Result(NamedTuple):
+    name: str
+    ops: int
+    time_per_op: float
+    peak_per_op: float
+    retained_per_op: float
+
+
+class _Replay:
+    '''a serial port returning one chunk of a recording per read'''
+
+    def __init__(self, chunks: list[bytes]) -> None:
+        self.chunks = chunks
+        self.port: Optional[str] = None
+        self.baudrate = 9600
+        self._i = 0
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.chunks[self._i % len(self.chunks)])
+
+    def read(self, size: int = 1) -> bytes:
+        chunk = self.chunks[self._i % len(self.chunks)]
+        self._i += 1
+        return chunk
+
+    def isOpen(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+    def open(self) -> None: ...
+    def close(self) -> None: ...
+    def flush(self) -> None: ...
+    def reset_input_buffer(self) -> None: ...
+
+
+def _writer(cls: Any, path: str, **kwargs: Any) -> Any:
+    return cls(
+        path, pi_id='01', mac='b8:27:eb:12:34:56', sensor_id='1',
+        version='0.10.0', **kwargs,
+    )
+
+
+@contextlib.contextmanager
+def sensor_cases(tmp: str) -> Iterator[list[Case]]:
+    gps = GPS(LOGGER, rate=10, uart=_Replay(nmea_epochs(synthetic_nmea(60))))
+    pm = PmSensor(
+        '/dev/null', LOGGER, ser=_Replay(sds011_frames(synthetic_sds011(60))),
+    )
+    temp_hum = SHT85(
+        LOGGER,
+        device=SimulatedSht3x(synthetic_temp_hum(60), 1, 1, Faults(), 0),
+    )
+    config = {
+        'user': {
+            'bike_nr': '01',
+            'studentname': 'bench',
+            'sensor_id': '1',
+            'logfile_path': os.path.join(tmp, 'logs'),
+            'sampling_rate': 1,
+            'pm_sensor': True,
+            'aggregate': True,
+            'gps_fix_age': True,
+        },
+    }
+    calib = {
+        'temp_cal_a1': 1.01,
+        'temp_cal_a0': -.2,
+        'hum_cal_a1': .98,
+        'hum_cal_a0': 1.5,
+    }
+    recorder = Recorder(
+        config, calib, LOGGER, gps=gps, temp_hum=temp_hum,
+        pm_factory=lambda: pm, mac='b8:27:eb:12:34:56', version='0.10.0',
+    )
+    pm.buffer = recorder.pm_buffer
+    for _ in range(20):
+        gps._publish(gps.read(gps.snapshot.seq + 1, time.monotonic()))
+    pm._publish(pm.read(1, time.monotonic()))
+    tick = Tick(number=0, deadline=time.monotonic(), late=0, missed=0)
+    seq = 0
+
+    def gps_read() -> None:
+        gps._publish(gps.read(gps.snapshot.seq + 1, time.monotonic()))
+
+    def pm_read() -> None:
+        pm._publish(pm.read(pm.snapshot.seq + 1, time.monotonic()))
+
+    def sample() -> None:
+        nonlocal seq
+        # the readings of one second, as the sensor thread publishes them
+        for _ in range(5):
+            seq += 1
+            temp_hum._publish(
+                TempHumReading(seq, time.monotonic(), 21.35215, 55.12345),
+            )
+        recorder.sample(tick)
+
+    csv_writer = _writer(
+        LogWriter, os.path.join(tmp, 'tick.csv'),
+        extra_columns=recorder.extra_columns,
+    )
+    binary_writer = _writer(
+        BinaryLogWriter, os.path.join(tmp, 'tick.bin'),
+        time_format=recorder.time_fmt,
+        extra_columns=recorder.extra_columns,
+    )
+    csv_writer.open()
+    binary_writer.open()
+
+    def tick_csv() -> None:
+        sample()
+        assert recorder.latest is not None
+        csv_writer.write(recorder.latest[0])
+
+    def tick_binary() -> None:
+        sample()
+        assert recorder.latest is not None
+        binary_writer.write(recorder.latest[0])
+
+    def vapour_pressure() -> None:
+        vappressure(55.123, sat_vappressure(21.352))
+
+    try:
+        yield [
+            Case('sds011.read', pm_read),
+            Case('gps.read', gps_read),
+            Case(
+                'gps.position_at',
+                lambda: gps.position_at(time.monotonic()),
+            ),
+            Case('vapour_pressure', vapour_pressure),
+            Case('sample', sample),
+            Case('tick.csv', tick_csv),
+            Case('tick.binary', tick_binary),
+            Case(
+                'metrics.sensor_read',
+                lambda: metrics.sensor_read('bench', 1e-4),
+            ),
+            Case('metrics.prometheus', metrics.prometheus),
+        ]
+    finally:
+        csv_writer.close()
+        binary_writer.close()
+
+
+@contextlib.contextmanager
+def writer_cases(tmp: str, sizes: Sequence[int]) -> Iterator[list[Case]]:
+    cases = []
+    for cls, ext in ((LogWriter, 'csv'), (BinaryLogWriter, 'bin')):
+        for rows in sizes:
+            path = os.path.join(tmp, f'{rows}.{ext}')
+
+            def write_file(
+                    cls: Any = cls,
+                    path: str = path,
+                    rows: int = rows,
+            ) -> None:
+                if os.path.exists(path):
+                    os.remove(path)
+                with _writer(cls, path) as writer:
+                    for _ in range(rows):
+                        writer.write(SAMPLE)
+
+            cases.append(
+                Case(
+                    f'{ext}_write.{rows}', write_file,
+                    per_call=rows, number=1, trace=rows <= 100_000,
+                ),
+            )
+    yield cases
+
+
+@contextlib.contextmanager
+def process_cases(tmp: str, rows: int = 100_000) -> Iterator[list[Case]]:
+    src = os.path.join(tmp, 'process.csv')
+    with _writer(LogWriter, src) as writer:
+        writer.write_many([SAMPLE] * rows)
+    calib = Calibration(1.01, -.2, .98, 1.5)
+    yield [
+        Case(
+            'process.csv',
+            lambda: process_file(
+                src, os.path.join(tmp, 'processed.csv'), calib,
+            ),
+            per_call=rows,
+            number=1,
+        ),
+    ]
+
+
+@contextlib.contextmanager
+def upload_cases(
+        tmp: str,
+        files: int = 10,
+        rows: int = 5000,
+) -> Iterator[list[Case]]:
+    src = os.path.join(tmp, 'upload_src')
+    log_dir = os.path.join(tmp, 'upload_logs')
+    os.makedirs(src)
+    for i in range(files):
+        with _writer(LogWriter, os.path.join(src, f'{i}.csv')) as writer:
+            writer.write_many([SAMPLE] * rows)
+
+    with WebDavServer() as server:
+        config = {
+            'user': {'logfile_path': log_dir},
+            'cloud': {
+                'base_url': server.url,
+                'folder_token': server.folder_token,
+                'passwd': server.passwd,
+            },
+        }
+
+        def setup() -> None:
+            shutil.rmtree(log_dir, ignore_errors=True)
+            shutil.copytree(src, log_dir)
+
+        def upload() -> None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = upload_to_cloud(False, config, LOGGER)
+            assert len(results) == files and all(r.ok for r in results)
+
+        yield [Case('upload', upload, setup=setup, per_call=files, number=1)]
+
+
+def _batch(case: Case, number: int) -> float:
+    if case.setup is not None:
+        case.setup()
+    op = case.op
+    start = time.perf_counter()
+    for _ in range(number):
+        op()
+    return time.perf_counter() - start
+
+
+def _numbers() -> Iterator[int]:
+    '''1, 2, 5, 10, 20, ... calls, as timeit's autorange'''
+    for exponent in itertools.count():
+        for factor in (1, 2, 5):
+            yield factor * 10 ** exponent
+
+
+def measure(case: Case, repeat: int, min_time: float = .2) -> Result:
+    number = case.number
+    if number is None:
+        number = next(n for n in _numbers() if _batch(case, n) >= min_time)
+    best = min(_batch(case, number) for _ in range(repeat))
+    if not case.trace:
+        return Result(
+            name=case.name,
+            ops=number * case.per_call,
+            time_per_op=best / (number * case.per_call),
+            peak_per_op=float('nan'),
+            retained_per_op=float('nan'),
+        )
+
+    if case.setup is not None:
+        case.setup()
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        case.op()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Result(
+        name=case.name,
+        ops=number * case.per_call,
+        time_per_op=best / (number * case.per_call),
+        peak_per_op=(peak - start) / case.per_call,
+        retained_per_op=(current - start) / case.per_call,
+    )
+
+
+def _metadata() -> dict[str, Any]:
+    try:
+        import importlib.metadata
+        version = importlib.metadata.version('crowdbike')
+    except Exception:
+        version = 'unknown'
+    return {
+        'crowdbike': version,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def compare(
+        results: list[Result],
+        baseline: dict[str, Any],
+        threshold: float,
+) -> bool:
+    '''print the change to the baseline, False if a case got slower'''
+    old = {r['name']: r for r in baseline['results']}
+    print(
+        f'\ncompared to crowdbike {baseline["metadata"]["crowdbike"]} '
+        f'({baseline["metadata"]["date"]}):',
+    )
+    ok = True
+    for r in results:
+        if r.name not in old:
+            continue
+        change = r.time_per_op / old[r.name]['time_per_op'] - 1
+        slower = change > threshold
+        ok &= not slower
+        print(
+            f'  {r.name:<22} {change:>+8.1%}'
+            f'{"  REGRESSION" if slower else ""}',
+        )
+    return ok
+
+
+def _asdict(result: Result) -> dict[str, Any]:
+    '''the result with ``null`` for values that were not measured'''
+    return {
+        k: None if isinstance(v, float) and math.isnan(v) else v
+        for k, v in result._asdict().items()
+    }
+
+
+def _fmt_bytes(value: float) -> str:
+    return f'{value:,.0f}' if math.isfinite(value) else 'nan'
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=.25,
+        help='max. slowdown compared to --compare, default: 0.25 (25%%)',
+    )
+    parser.add_argument('--filter', help='only run cases containing this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--quick',
+        action='store_true',
+        help=f'write at most {WRITER_ROWS[-2]:,} rows, fewer repeats',
+    )
+    args = parser.parse_args(argv)
+
+    sizes = WRITER_ROWS[:-1] if args.quick else WRITER_ROWS
+    repeat = min(args.repeat, 2) if args.quick else args.repeat
+
+    print(
+        f'{"case":<22} {"ops":>9} {"µs/op":>10} {"ops/s":>12} '
+        f'{"peak B/op":>10} {"retained B/op":>14}',
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+        cases = [
+            *stack.enter_context(sensor_cases(tmp)),
+            *stack.enter_context(writer_cases(tmp, sizes)),
+            *stack.enter_context(process_cases(tmp)),
+            *stack.enter_context(upload_cases(tmp)),
+        ]
+        for case in cases:
+            if args.filter and args.filter not in case.name:
+                continue
+            r = measure(case, repeat)
+            results.append(r)
+            print(
+                f'{r.name:<22} {r.ops:>9,} {r.time_per_op * 1e6:>10.2f} '
+                f'{1 / r.time_per_op:>12,.0f} '
+                f'{_fmt_bytes(r.peak_per_op):>10} '
+                f'{_fmt_bytes(r.retained_per_op):>14}',
+            )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(
+                {
+                    'metadata': _metadata(),
+                    'results': [_asdict(r) for r in results],
+                },
+                f,
+                indent=2,
+            )
+            f.write('\n')
+        print(f'\nresults written to {args.json}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,129 @@
+'''Bytes on the wire and wall time of uploads with and without compression.
+
+Realistic logfiles are uploaded to the local WebDAV stand-in server. Use
+``--bandwidth`` to emulate a slow (e.g. mobile) connection.
+
+usage: python benchmarks/bench_upload.py [--files N] [--rows N]
+                                         [--bandwidth BYTES_PER_S]
+'''
+from __future__ import annotations
+
+import argparse
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections.abc import Sequence
+
+from crowdbike.upload import COMPRESSIONS
+from crowdbike.upload import pending_files
+from crowdbike.upload import WebDavUploader
+from crowdbike.writer import LogWriter
+from crowdbike.writer import Sample
+from testing.webdav_server import WebDavServer
+
+
+def make_logfile(path: str, rows: int, seed: int = 42) -> None:
+    '''write a logfile with a plausible ride'''
+    rnd = random.Random(seed)
+    lat, lon, temp, hum = 51.445, 7.262, 21.0, 55.0
+    with LogWriter(
+        path, pi_id='01', mac='b8:27:eb:12:34:56', sensor_id='1',
+        version='0.10.0',
+    ) as writer:
+        for i in range(rows):
+            lat += rnd.uniform(-2e-5, 5e-5)
+            lon += rnd.uniform(-2e-5, 5e-5)
+            temp += rnd.gauss(0, 0.02)
+            hum += rnd.gauss(0, 0.05)
+            timestamp = time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.gmtime(1717243200 + i * 5),
+            )
+            vappress = (hum / 100) * 0.6113 * math.exp(
+                (2501000.0 / 461.5) * ((1 / 273.15) - (1 / (temp + 273.15))),
+            )
+            writer.write(
+                Sample(
+                    raspberry_time=timestamp,
+                    gps_time=timestamp,
+                    altitude=round(rnd.uniform(100, 120), 1),
+                    latitude=lat,
+                    longitude=lon,
+                    speed=round(rnd.uniform(10, 25), 2),
+                    temperature=round(temp, 3),
+                    temperature_raw=round(temp, 5),
+                    rel_humidity=round(hum, 3),
+                    rel_humidity_raw=round(hum, 5),
+                    vapour_pressure=round(vappress, 5),
+                    pm10=float('nan'),
+                    pm2_5=float('nan'),
+                ),
+            )
+
+
+def bench(
+        src_dir: str,
+        compression: str,
+        bandwidth: float | None,
+        workers: int,
+) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log_dir = shutil.copytree(src_dir, os.path.join(tmpdir, 'logs'))
+        with WebDavServer(bandwidth=bandwidth) as server:
+            uploader = WebDavUploader(
+                server.url,
+                server.folder_token,
+                server.passwd,
+                logging.getLogger('bench'),
+                workers=workers,
+                compression=compression,
+            )
+            files = pending_files(log_dir)
+            raw = sum(os.path.getsize(f) for f in files)
+            start = time.perf_counter()
+            results = uploader.upload(files, os.path.join(log_dir, 'archive'))
+            wall = time.perf_counter() - start
+            assert all(r.ok for r in results), results
+            sent = server.stats['bytes_received']
+
+    print(
+        f'{compression:<6} {len(files):>4} files {raw:>12,} B raw '
+        f'{sent:>12,} B sent ({sent / raw:6.1%}) {wall:8.3f} s',
+    )
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument(
+        '--bandwidth',
+        type=float,
+        default=None,
+        help='bytes per second and connection, default: unlimited',
+    )
+    args = parser.parse_args(argv)
+
+    compressions = ['none', 'gzip']
+    try:
+        import zstandard  # noqa: F401
+        compressions.append('zstd')
+    except ImportError:
+        print('zstandard is not installed, skipping zstd')
+
+    with tempfile.TemporaryDirectory() as src_dir:
+        for i in range(args.files):
+            make_logfile(os.path.join(src_dir, f'{i}.csv'), args.rows, seed=i)
+        for compression in compressions:
+            assert compression in COMPRESSIONS
+            bench(src_dir, compression, args.bandwidth, args.workers)
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
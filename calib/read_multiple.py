@@ -1,37 +1,242 @@
+'''Log the SHT85 sensors connected via i2c multiplexers for the calibration.
+
+Every multiplexer channel is its own device (``/dev/i2c-22``, ...), the
+sensor numbers are mapped to them in a json file (``sensors.json`` by
+default) or with ``--sensor``::
+
+    {"42": "/dev/i2c-22", "45": "/dev/i2c-23"}
+
+Each sensor is read by its own thread, so all sensors of a round are
+measured at the same time and share one timestamp. A round takes as long
+as the slowest sensor, no matter how many sensors are connected. The serial
+numbers are read once at the start.
+'''
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import threading
 import time
+from collections.abc import Sequence
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
+from types import FrameType
+from typing import Any
+from typing import IO
+from typing import Optional
 
 import sentry_sdk
-from sensirion_i2c_driver import I2cConnection
-from sensirion_i2c_driver.linux_i2c_transceiver import LinuxI2cTransceiver
-from sensirion_i2c_sht.sht3x import Sht3xI2cDevice
+
+from crowdbike.scheduler import Scheduler
+from crowdbike.scheduler import Tick
 
 sentry_sdk.init(
     dsn='https://8d1142f8badf4bb2a52e1744b23b2920@o1323140.ingest.sentry.io/6584968',  # noqa: E501
     traces_sample_rate=0,
 )
 
-# map the sensor id to the device address provided by the i2c multiplexer
-SENSORS = {
-    '42': Sht3xI2cDevice(I2cConnection(LinuxI2cTransceiver('/dev/i2c-22'))),
-    '45': Sht3xI2cDevice(I2cConnection(LinuxI2cTransceiver('/dev/i2c-23'))),
-    '59': Sht3xI2cDevice(I2cConnection(LinuxI2cTransceiver('/dev/i2c-24'))),
-    # add more if needed
-}
-
+SENSORS = os.path.join(os.path.dirname(__file__), 'sensors.json')
 FILENAME = 'crowdbike_calibration.csv'
+HEADER = 'date,temperature,humidity,sensor_nr,serial_nr\n'
+
+
+def open_sensors(devices: dict[str, str]) -> dict[str, Any]:
+    '''the sensor number mapped to the sensor on the i2c device'''
+    from sensirion_i2c_driver import I2cConnection
+    from sensirion_i2c_driver.linux_i2c_transceiver import LinuxI2cTransceiver
+    from sensirion_i2c_sht.sht3x import Sht3xI2cDevice
+
+    return {
+        sensor_nr: Sht3xI2cDevice(I2cConnection(LinuxI2cTransceiver(dev)))
+        for sensor_nr, dev in devices.items()
+    }
+
+
+class CalibrationLogger:
+    '''Read all sensors concurrently and write them to ``f``.
+
+    Every round is written with a single write to the buffered file. A
+    sensor that does not answer within ``timeout`` is left out of the round,
+    it is only read again once its last measurement has finished.
+    '''
+
+    def __init__(
+            self,
+            sensors: dict[str, Any],
+            f: IO[str],
+            logger: logging.Logger,
+            timeout: float,
+    ) -> None:
+        self.sensors = sensors
+        self.f = f
+        self.logger = logger
+        self.timeout = timeout
+        self.rows = 0
+        self.failed = 0
+        # one thread per sensor, so a slow sensor does not delay the others
+        self.executor = ThreadPoolExecutor(
+            max_workers=len(sensors),
+            thread_name_prefix='sht',
+        )
+        self._pending: dict[str, Future[Any]] = {}
+        self.serial_nrs = {
+            sensor_nr: str(serial_nr)
+            for sensor_nr, serial_nr in zip(
+                sensors,
+                self.executor.map(
+                    lambda s: s.read_serial_number(),
+                    sensors.values(),
+                ),
+            )
+        }
 
-while True:
-    for sensor_nr, sensor in SENSORS.items():
-        temp, hum = sensor.single_shot_measurement()
-        serial_nr = sensor.read_serial_number()
+    def tick(self, tick: Tick) -> None:
         now = datetime.now(tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-        csv_str = (
-            f'{now},{temp.degrees_celsius},{hum.percent_rh},'
-            f'{sensor_nr},{serial_nr}'
+        futures = {}
+        for sensor_nr, sensor in self.sensors.items():
+            pending = self._pending.get(sensor_nr)
+            if pending is not None and not pending.done():
+                self.logger.warning(f'sensor {sensor_nr} is still busy')
+                self.failed += 1
+                continue
+            futures[sensor_nr] = self._pending[sensor_nr] = (
+                self.executor.submit(sensor.single_shot_measurement)
+            )
+
+        deadline = time.monotonic() + self.timeout
+        rows = []
+        for sensor_nr, future in futures.items():
+            try:
+                temp, hum = future.result(
+                    timeout=max(deadline - time.monotonic(), 0),
+                )
+            except concurrent.futures.TimeoutError:
+                self.logger.warning(f'sensor {sensor_nr} timed out')
+                self.failed += 1
+                continue
+            except Exception:
+                self.logger.exception(f'reading sensor {sensor_nr} failed')
+                self.failed += 1
+                continue
+            rows.append(
+                f'{now},{temp.degrees_celsius},{hum.percent_rh},'
+                f'{sensor_nr},{self.serial_nrs[sensor_nr]}\n',
+            )
+        self.f.write(''.join(rows))
+        self.f.flush()
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+def load_sensors(
+        path: Optional[str],
+        sensors: Sequence[str],
+) -> dict[str, str]:
+    '''the sensor numbers mapped to the devices from the json file at
+    ``path`` and ``NR=DEVICE`` strings'''
+    devices: dict[str, str] = {}
+    if path is not None:
+        with open(path) as f:
+            devices.update(json.load(f))
+    for sensor in sensors:
+        sensor_nr, sep, dev = sensor.partition('=')
+        if not sep:
+            raise SystemExit(f'--sensor must be NR=DEVICE, not {sensor!r}')
+        devices[sensor_nr] = dev
+    if not devices:
+        raise SystemExit('no sensors configured')
+    return devices
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sensors',
+        default=None,
+        help=f'json file mapping the sensor numbers to the i2c devices, '
+        f'default: {os.path.relpath(SENSORS)} unless --sensor is used',
+    )
+    parser.add_argument(
+        '--sensor',
+        action='append',
+        default=[],
+        metavar='NR=DEVICE',
+        help='add a sensor, e.g. 42=/dev/i2c-22, can be used multiple times',
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=1,
+        help='seconds between the rounds, default: %(default)s',
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=FILENAME,
+        help='csv file the measurements are appended to, '
+        'default: %(default)s',
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+    )
+    logger = logging.getLogger('calibration')
+    path = args.sensors
+    if path is None and not args.sensor:
+        path = SENSORS
+    devices = load_sensors(path, args.sensor)
+
+    new = not os.path.exists(args.output) or not os.path.getsize(args.output)
+    with open(args.output, 'a') as f:
+        if new:
+            f.write(HEADER)
+        calib_logger = CalibrationLogger(
+            open_sensors(devices),
+            f,
+            logger,
+            timeout=args.interval,
+        )
+        for sensor_nr, dev in devices.items():
+            logger.info(
+                f'sensor {sensor_nr} on {dev}: '
+                f'serial number {calib_logger.serial_nrs[sensor_nr]}',
+            )
+        scheduler = Scheduler(
+            args.interval,
+            calib_logger.tick,
+            logger,
+            name='calibration',
+        )
+        stop = threading.Event()
+
+        def _stop(signum: int, frame: Optional[FrameType]) -> None:
+            stop.set()
+
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+        scheduler.start()
+        print(
+            f'logging {len(devices)} sensors to {args.output}, '
+            f'stop with Ctrl+C',
         )
-        with open(FILENAME, 'a') as f:
-            f.write(f'{csv_str}\n')
+        stop.wait()
+        scheduler.stop()
+        calib_logger.close()
+    logger.info(
+        f'{calib_logger.rows} rows written, {calib_logger.failed} readings '
+        f'failed',
+    )
+    return 0
+
 
-    time.sleep(1)
+if __name__ == '__main__':
+    raise SystemExit(main())
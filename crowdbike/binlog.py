@@ -0,0 +1,347 @@
+'''Compact binary logfiles.
+
+A binary logfile starts with ``MAGIC``, followed by the length of a JSON
+header as little-endian ``uint32`` and the header itself, padded to a multiple
+of 8 bytes. The header holds the constant columns (``id``, ``mac``,
+``sensor_id``, ``software_version``) and the layout of the records.
+
+The records are fixed-width and little-endian. Timestamps are stored as
+microseconds since the epoch, the measured values as fixed-point integers with
+the same number of decimals as in the csv logfiles. This way the records can
+be converted back into exactly the csv rows they represent and can be loaded
+as a ``numpy.memmap`` without copying (see :func:`load`).
+'''
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+import struct
+from collections.abc import Iterator
+from collections.abc import Sequence
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Any
+from typing import BinaryIO
+from typing import TYPE_CHECKING
+
+from crowdbike.manifest import sha256_file
+from crowdbike.manifest import UploadManifest
+from crowdbike.writer import CNAMES
+from crowdbike.writer import Sample
+from crowdbike.writer import TIME_FMT
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MAGIC = b'CRWDBK\x00\x01'
+# sentinels for values that cannot be represented by an integer
+NAN = -2**31
+NEG_ZERO = -2**31 + 1
+NO_TIME = -2**63
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = timedelta(microseconds=1)
+
+# name, struct code, decimals and whether the csv uses a fixed number of
+# decimals ('{:.3f}') or the shortest representation of the rounded value
+COLUMNS: tuple[tuple[str, str, int, bool], ...] = (
+    ('record', 'I', 0, False),
+    ('raspberry_time', 'q', 0, False),
+    ('gps_time', 'q', 0, False),
+    ('altitude', 'i', 3, True),
+    ('latitude', 'i', 6, True),
+    ('longitude', 'i', 6, True),
+    ('speed', 'i', 1, True),
+    ('temperature', 'i', 3, False),
+    ('temperature_raw', 'i', 5, False),
+    ('rel_humidity', 'i', 3, False),
+    ('rel_humidity_raw', 'i', 5, False),
+    ('vapour_pressure', 'i', 5, False),
+    ('pm10', 'i', 1, False),
+    ('pm2_5', 'i', 1, False),
+)
+
+
+def _encode_time(value: str, time_fmt: str) -> int:
+    if value == 'nan':
+        return NO_TIME
+    dt = datetime.strptime(value, time_fmt).replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // _US
+
+
+def _decode_time(value: int, time_fmt: str) -> str:
+    if value == NO_TIME:
+        return 'nan'
+    return (_EPOCH + value * _US).strftime(time_fmt)
+
+
+def _encode_value(name: str, value: float, decimals: int, fixed: bool) -> int:
+    if math.isnan(value):
+        return NAN
+
+    if fixed:
+        formatted = f'{value:.{decimals}f}'
+        n = int(formatted.replace('.', ''))
+        if n == 0 and formatted[0] == '-':
+            return NEG_ZERO
+    else:
+        n = round(value * 10**decimals)
+        if n / 10**decimals != value:
+            raise ValueError(
+                f'{name}={value!r} cannot be stored with {decimals} decimals',
+            )
+        if n == 0 and math.copysign(1, value) < 0:
+            return NEG_ZERO
+    return n
+
+
+def _decode_value(value: int, decimals: int, fixed: bool) -> str:
+    if value == NAN:
+        return 'nan'
+    elif value == NEG_ZERO:
+        return f'-{0:.{decimals}f}' if fixed else '-0.0'
+    elif fixed:
+        return f'{value / 10**decimals:.{decimals}f}'
+    else:
+        return str(value / 10**decimals)
+
+
+class BinaryLogWriter:
+    '''Append measurement rows to a binary logfile.
+
+    This has the same interface as :class:`crowdbike.writer.LogWriter`.
+    '''
+
+    def __init__(
+            self,
+            path: str,
+            *,
+            pi_id: str,
+            mac: str,
+            sensor_id: str,
+            version: str,
+            manifest: UploadManifest | None = None,
+            extra_columns: Sequence[tuple[str, int]] = (),
+            time_format: str = TIME_FMT,
+    ) -> None:
+        self.path = path
+        self.manifest = manifest
+        self.counter = 0
+        self.header: dict[str, Any] = {
+            'id': pi_id,
+            'mac': mac,
+            'sensor_id': sensor_id,
+            'software_version': version,
+            'time_format': time_format,
+            'columns': [
+                *(list(c) for c in COLUMNS),
+                *([name, 'i', d, True] for name, d in extra_columns),
+            ],
+        }
+        self._record = struct.Struct(_struct_fmt(self.header['columns']))
+        self._f: BinaryIO | None = None
+        self._hash = hashlib.sha256()
+        # size of the file in bytes
+        self.size = 0
+
+    def open(self) -> None:
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            self.header, offset = read_header(self.path)
+            self._record = struct.Struct(_struct_fmt(self.header['columns']))
+            self.counter = (
+                (os.path.getsize(self.path) - offset) // self._record.size
+            )
+            size = offset + self.counter * self._record.size
+            self._hash = sha256_file(self.path, size)
+            self.size = size
+            self._f = open(self.path, 'r+b')
+            # drop an incomplete last record e.g. after a power loss
+            self._f.truncate(size)
+            self._f.seek(0, os.SEEK_END)
+        else:
+            self.counter = 0
+            self._hash = hashlib.sha256()
+            self.size = 0
+            self._f = open(self.path, 'wb')
+            self._write(_pack_header(self.header))
+
+    @property
+    def sha256(self) -> str:
+        '''hex digest of everything written to the file so far'''
+        return self._hash.hexdigest()
+
+    def _write(self, data: bytes) -> None:
+        assert self._f is not None
+        self._f.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def _pack(self, sample: Sample) -> bytes:
+        time_fmt = self.header['time_format']
+        values = [
+            self.counter,
+            _encode_time(sample.raspberry_time, time_fmt),
+            _encode_time(sample.gps_time, time_fmt),
+        ]
+        columns = self.header['columns']
+        if len(sample.extra) != len(columns) - len(COLUMNS):
+            raise ValueError(
+                f'expected {len(columns) - len(COLUMNS)} extra values, got '
+                f'{len(sample.extra)}',
+            )
+        for (name, _, decimals, fixed), value in zip(
+                columns[3:], (*sample[2:-1], *sample.extra),
+        ):
+            values.append(_encode_value(name, value, decimals, fixed))
+
+        try:
+            packed = self._record.pack(*values)
+        except struct.error as e:
+            raise ValueError(f'cannot store {sample!r}: {e}') from e
+        self.counter += 1
+        return packed
+
+    def write(self, sample: Sample) -> int:
+        '''write a row and return the record number it was written with'''
+        if self._f is None:
+            raise ValueError(f'logfile {self.path!r} is not open')
+
+        self._write(self._pack(sample))
+        return self.counter - 1
+
+    def write_many(self, samples: Sequence[Sample]) -> None:
+        '''write multiple rows with a single call to the file object'''
+        if self._f is None:
+            raise ValueError(f'logfile {self.path!r} is not open')
+
+        self._write(b''.join([self._pack(s) for s in samples]))
+
+    def flush(self) -> None:
+        '''hand all buffered rows over to the OS'''
+        if self._f is not None:
+            self._f.flush()
+
+    def sync(self) -> None:
+        '''flush and force the OS to write the rows to the storage'''
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            if self.manifest is not None:
+                self.manifest.record(self.path, self.sha256)
+
+    def __enter__(self) -> BinaryLogWriter:
+        self.open()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'path={self.path!r}, '
+            f'counter={self.counter!r}'
+            ')'
+        )
+
+
+def _struct_fmt(columns: Sequence[Sequence[Any]]) -> str:
+    return '<' + ''.join(c[1] for c in columns)
+
+
+def _pack_header(header: dict[str, Any]) -> bytes:
+    data = json.dumps(header).encode()
+    # pad, so the records start at a multiple of 8 bytes
+    data += b' ' * (-(len(MAGIC) + 4 + len(data)) % 8)
+    return MAGIC + struct.pack('<I', len(data)) + data
+
+
+def read_header(path: str) -> tuple[dict[str, Any], int]:
+    '''read the header of a binary logfile
+
+    :returns: the header and the offset of the first record in bytes
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path!r} is not a crowdbike binary logfile')
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size))
+    return header, len(MAGIC) + 4 + size
+
+
+def iter_rows(path: str, chunk_size: int = 4096) -> Iterator[str]:
+    '''iterate over the rows of a binary logfile, formatted as csv lines'''
+    header, offset = read_header(path)
+    columns = header['columns']
+    time_fmt = header['time_format']
+    record = struct.Struct(_struct_fmt(columns))
+    prefix = f"{header['id']},"
+    suffix = (
+        f",{header['mac']},{header['sensor_id']},"
+        f"{header['software_version']}"
+    )
+    # extra columns are appended after the constant columns
+    extra = columns[len(COLUMNS):]
+    yield f"{','.join((*CNAMES, *(c[0] for c in extra)))}\n"
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            data = f.read(record.size * chunk_size)
+            # ignore an incomplete last record
+            data = data[:len(data) - len(data) % record.size]
+            if not data:
+                break
+            for values in record.iter_unpack(data):
+                fields = [
+                    str(values[0]),
+                    _decode_time(values[1], time_fmt),
+                    _decode_time(values[2], time_fmt),
+                ]
+                for (_, _, decimals, fixed), value in zip(
+                        columns[3:], values[3:],
+                ):
+                    fields.append(_decode_value(value, decimals, fixed))
+
+                row = f"{prefix}{','.join(fields[:len(COLUMNS)])}{suffix}"
+                if extra:
+                    row += f",{','.join(fields[len(COLUMNS):])}"
+                yield f'{row}\n'
+
+
+def export_csv(path: str, out_path: str) -> int:
+    '''convert a binary logfile into a csv logfile
+
+    :returns: the number of rows written
+    '''
+    nr_rows = -1
+    with open(out_path, 'w') as f:
+        for nr_rows, row in enumerate(iter_rows(path)):
+            f.write(row)
+    return nr_rows
+
+
+def load(path: str) -> np.memmap[Any, Any]:
+    '''map the records of a binary logfile into memory without copying them
+
+    The measured values are fixed-point integers, divide them by
+    ``10**decimals`` (see ``header['columns']``) to get the actual values.
+    ``NAN`` and ``NO_TIME`` mark missing values.
+    '''
+    import numpy as np
+
+    header, offset = read_header(path)
+    dtype = np.dtype([(c[0], f'<{c[1]}') for c in header['columns']])
+    nr_records = (os.path.getsize(path) - offset) // dtype.itemsize
+    return np.memmap(
+        path, dtype=dtype, mode='r', offset=offset, shape=(nr_records,),
+    )
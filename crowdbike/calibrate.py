@@ -0,0 +1,432 @@
+'''Fit the calibration of the temperature and humidity sensors.
+
+The sensors are logged side by side in a climate chamber using
+``calib/read_multiple.py``, which writes one row per reading::
+
+    date,temperature,humidity,sensor_nr,serial_nr
+
+The file is read in chunks and the readings of every sensor and of the
+reference (another sensor in the same file or a separate file) are averaged
+per ``interval``. The averages of the same interval are paired and the
+coefficients of all sensors are fitted at once by least squares, so dozens
+of sensors are calibrated in a single pass.
+
+Besides the linear model used by the logger (``reference = a1 * raw + a0``),
+a polynomial or a piecewise linear model can be fitted for the analysis.
+'''
+from __future__ import annotations
+
+import itertools
+import json
+import os
+from collections.abc import Iterable
+from collections.abc import Sequence
+from typing import Any
+from typing import NamedTuple
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+CHAMBER_COLUMNS = ('date', 'temperature', 'humidity', 'sensor_nr', 'serial_nr')
+# the quantities and the prefix of their keys in calibration.json
+QUANTITIES = {'temperature': 'temp', 'humidity': 'hum'}
+# key of the reference in the averages
+REFERENCE = '\x00reference'
+
+_Array = npt.NDArray[np.float64]
+
+
+class Model(NamedTuple):
+    '''a model that is linear in its coefficients'''
+    name: str = 'linear'
+    # degree of the polynomial
+    degree: int = 1
+    # where the slope of the piecewise linear model may change
+    breakpoints: tuple[float, ...] = ()
+
+    def basis(self, x: _Array) -> _Array:
+        '''the design matrix, the last axis are the terms of the model'''
+        if self.name == 'poly':
+            terms = [x ** p for p in range(self.degree + 1)]
+        elif self.name == 'piecewise':
+            terms = [np.ones_like(x), x]
+            terms.extend(np.maximum(x - b, 0) for b in self.breakpoints)
+        else:
+            terms = [np.ones_like(x), x]
+        return np.stack(terms, axis=-1)
+
+    def describe(self) -> dict[str, Any]:
+        if self.name == 'poly':
+            return {'model': self.name, 'degree': self.degree}
+        elif self.name == 'piecewise':
+            return {'model': self.name, 'breakpoints': list(self.breakpoints)}
+        else:
+            return {'model': self.name}
+
+
+class Fit(NamedTuple):
+    # coefficients in the order of the terms of the model
+    coefficients: list[float]
+    # number of paired intervals
+    n: int
+    rmse_before: float
+    rmse_after: float
+    r2: float
+
+
+class Averages:
+    '''Mean temperature and humidity per key (sensor) and interval.
+
+    The sums are accumulated chunk by chunk, so the memory depends on the
+    number of sensors and intervals, not on the number of readings.
+    '''
+
+    def __init__(self, interval: float) -> None:
+        self.interval_ms = int(interval * 1000)
+        # key -> interval -> [sum temperature, n, sum humidity, n]
+        self._sums: dict[str, dict[int, list[float]]] = {}
+        # the serial numbers seen per key
+        self.serials: dict[str, set[str]] = {}
+        self.rows = 0
+        self.skipped = 0
+
+    def add(
+            self,
+            keys: npt.NDArray[Any],
+            times_ms: npt.NDArray[np.int64],
+            temperature: _Array,
+            humidity: _Array,
+    ) -> None:
+        '''add readings, all arrays have one element per reading'''
+        self.rows += len(keys)
+        key_names, key_codes = np.unique(keys, return_inverse=True)
+        bins = times_ms // self.interval_ms
+        if not len(bins):
+            return
+        # one integer per sensor and interval, faster than unique rows
+        first, width = int(bins.min()), int(bins.max() - bins.min()) + 1
+        groups, inverse = np.unique(
+            key_codes * width + (bins - first), return_inverse=True,
+        )
+        sums = []
+        for values in (temperature, humidity):
+            valid = np.isfinite(values)
+            sums.append(
+                np.bincount(inverse, weights=np.where(valid, values, 0)),
+            )
+            sums.append(np.bincount(inverse, weights=valid))
+
+        for group, *group_sums in zip(groups.tolist(), *sums):
+            code, b = divmod(group, width)
+            acc = self._sums.setdefault(
+                str(key_names[code]), {},
+            ).setdefault(b + first, [0., 0., 0., 0.])
+            for i, value in enumerate(group_sums):
+                acc[i] += value
+
+    def keys(self) -> list[str]:
+        # numbers in numerical order
+        return sorted(
+            (k for k in self._sums if k != REFERENCE),
+            key=lambda k: (len(k), k),
+        )
+
+    def means(self, key: str) -> tuple[npt.NDArray[np.int64], _Array, _Array]:
+        '''the intervals and the mean temperature and humidity in them'''
+        sums = self._sums.get(key, {})
+        bins = np.array(sorted(sums), dtype=np.int64)
+        acc = np.array([sums[b] for b in bins.tolist()]).reshape(-1, 4)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return bins, acc[:, 0] / acc[:, 1], acc[:, 2] / acc[:, 3]
+
+
+def _parse_times(dates: Sequence[str]) -> npt.NDArray[np.int64]:
+    '''milliseconds since the epoch, -1 if a date cannot be parsed'''
+    try:
+        times = np.array(dates, dtype='datetime64[ms]')
+    except ValueError:
+        times = np.array(
+            [_parse_time(d) for d in dates], dtype='datetime64[ms]',
+        )
+    ms = times.astype(np.int64)
+    ms[np.isnat(times)] = -1
+    return ms
+
+
+def _parse_time(date: str) -> np.datetime64:
+    try:
+        return np.datetime64(date, 'ms')
+    except ValueError:
+        return np.datetime64('NaT', 'ms')
+
+
+def read_csv(
+        path: str,
+        averages: Averages,
+        *,
+        columns: Sequence[str] = CHAMBER_COLUMNS,
+        key: Optional[str] = None,
+        offset: float = 0,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        chunk_size: int = 100_000,
+) -> None:
+    '''add the readings of a csv file to ``averages``
+
+    ``columns`` are the names of the date, temperature, humidity and key
+    column (and optionally of the serial number). If the file has no header,
+    the columns are in this order. If ``key`` is given, all readings are
+    added with it, e.g. for a reference. ``offset`` seconds are added to the
+    dates, e.g. to correct the time zone. Only readings from ``start`` until
+    before ``end`` are used.
+    '''
+    offset_ms = int(offset * 1000)
+    start_ms, end_ms = (
+        None if d is None else int(_parse_times([d])[0]) for d in (start, end)
+    )
+    with open(path) as f:
+        first = f.readline().rstrip('\n').split(',')
+        if columns[0] in first:
+            index = [first.index(c) for c in columns if c in first]
+            if len(index) < (3 if key is not None else 4):
+                raise ValueError(
+                    f'{path!r} must have the columns {", ".join(columns)}',
+                )
+            lines: Iterable[str] = f
+        else:
+            index = list(range(len(columns)))
+            lines = itertools.chain([','.join(first)], f)
+        width = max(index) + 1
+
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                break
+            split = [line.rstrip('\n').split(',') for line in chunk]
+            rows = [r for r in split if len(r) >= width]
+            averages.skipped += len(split) - len(rows)
+            if not rows:
+                continue
+            cols = list(zip(*rows))
+            times = _parse_times(cols[index[0]]) + offset_ms
+            valid = times >= 0
+            if start_ms is not None:
+                valid &= times >= start_ms
+            if end_ms is not None:
+                valid &= times < end_ms
+            if key is None:
+                keys = np.array(cols[index[3]])
+                if len(index) > 4:
+                    _serials(averages, keys, np.array(cols[index[4]]))
+            else:
+                keys = np.full(len(rows), key)
+            averages.skipped += int((~valid).sum())
+            averages.add(
+                keys[valid],
+                times[valid],
+                _floats(cols[index[1]])[valid],
+                _floats(cols[index[2]])[valid],
+            )
+
+
+def _floats(values: Sequence[str]) -> _Array:
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        return np.array([_float(v) for v in values], dtype=np.float64)
+
+
+def _float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def _serials(
+        averages: Averages,
+        keys: npt.NDArray[Any],
+        serials: npt.NDArray[Any],
+) -> None:
+    for key, serial in set(zip(keys.tolist(), serials.tolist())):
+        averages.serials.setdefault(key, set()).add(serial)
+
+
+def pair(
+        averages: Averages,
+        keys: Sequence[str],
+        reference: str,
+        quantity: str,
+) -> list[tuple[_Array, _Array]]:
+    '''the means of every sensor and of the reference in the same
+    intervals, intervals without a value of both are dropped'''
+    def _means(key: str) -> tuple[npt.NDArray[np.int64], _Array]:
+        bins, temperature, humidity = averages.means(key)
+        return bins, temperature if quantity == 'temperature' else humidity
+
+    ref_bins, ref = _means(reference)
+    pairs = []
+    for key in keys:
+        bins, means = _means(key)
+        _, sensor_i, ref_i = np.intersect1d(
+            bins, ref_bins, assume_unique=True, return_indices=True,
+        )
+        x, y = means[sensor_i], ref[ref_i]
+        valid = np.isfinite(x) & np.isfinite(y)
+        pairs.append((x[valid], y[valid]))
+    return pairs
+
+
+def fit(pairs: Sequence[tuple[_Array, _Array]], model: Model) -> list[Fit]:
+    '''fit the model for all sensors at once
+
+    The pairs are padded to the same length and masked, so the normal
+    equations of all sensors are solved as one stack of matrices.
+    '''
+    if not pairs:
+        return []
+    size = max(max(len(x) for x, _ in pairs), 1)
+    x = np.zeros((len(pairs), size))
+    y = np.zeros((len(pairs), size))
+    mask = np.zeros((len(pairs), size), dtype=bool)
+    for i, (xi, yi) in enumerate(pairs):
+        x[i, :len(xi)] = xi
+        y[i, :len(yi)] = yi
+        mask[i, :len(xi)] = True
+
+    design = model.basis(x)
+    masked = design * mask[..., None]
+    normal = np.einsum('snk,snl->skl', masked, masked)
+    rhs = np.einsum('snk,sn->sk', masked, y)
+    coefficients = (np.linalg.pinv(normal) @ rhs[..., None])[..., 0]
+    predicted = np.einsum('snk,sk->sn', design, coefficients)
+
+    n = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmse_before = np.sqrt(((x - y) ** 2 * mask).sum(axis=1) / n)
+        rmse_after = np.sqrt(((predicted - y) ** 2 * mask).sum(axis=1) / n)
+        y_mean = (y * mask).sum(axis=1) / n
+        ss_tot = (((y - y_mean[:, None]) * mask) ** 2).sum(axis=1)
+        r2 = 1 - rmse_after ** 2 * n / ss_tot
+    # too few intervals to determine the coefficients
+    underdetermined = n < design.shape[-1]
+    for values in (coefficients, rmse_after, r2):
+        values[underdetermined] = np.nan
+
+    return [
+        Fit(
+            coefficients=coefficients[i].tolist(),
+            n=int(n[i]),
+            rmse_before=float(rmse_before[i]),
+            rmse_after=float(rmse_after[i]),
+            r2=float(r2[i]),
+        )
+        for i in range(len(pairs))
+    ]
+
+
+def _round(value: float, digits: int = 5) -> Optional[float]:
+    '''rounded, NaN is written as null'''
+    return round(value, digits) if np.isfinite(value) else None
+
+
+def calibration(
+        sensor: str,
+        serials: Iterable[str],
+        linear: dict[str, Fit],
+        fits: dict[str, Fit],
+        models: dict[str, Model],
+) -> dict[str, Any]:
+    '''the content of the calibration file of a sensor'''
+    calib: dict[str, Any] = {}
+    for quantity, prefix in QUANTITIES.items():
+        a0, a1 = linear[quantity].coefficients
+        calib[f'{prefix}_cal_a1'] = _round(a1)
+        calib[f'{prefix}_cal_a0'] = _round(a0)
+    calib['sensor_nr'] = sensor
+    calib['serial_nr'] = sorted(serials)
+    for quantity, prefix in QUANTITIES.items():
+        f = fits[quantity]
+        calib[f'{prefix}_fit'] = {
+            **models[quantity].describe(),
+            'coefficients': [_round(c, 8) for c in f.coefficients],
+            'n': f.n,
+            'rmse_before': _round(f.rmse_before),
+            'rmse_after': _round(f.rmse_after),
+            'r2': _round(f.r2),
+        }
+    return calib
+
+
+def usable(calib: dict[str, Any]) -> bool:
+    '''whether the linear fits of all quantities could be determined, so
+    the calibration can be used as ``calibration.json``'''
+    return all(
+        calib[f'{prefix}_cal_{a}'] is not None
+        for prefix in QUANTITIES.values()
+        for a in ('a1', 'a0')
+    )
+
+
+def calibrate(
+        averages: Averages,
+        out_dir: str,
+        reference: str = REFERENCE,
+        models: Optional[dict[str, Model]] = None,
+) -> list[dict[str, Any]]:
+    '''fit all sensors and write one ``calibration_<sensor>.json`` each
+    and a summary of all of them to ``calibration_results.csv``
+
+    The linear fit is always written as ``*_cal_a1`` and ``*_cal_a0``, so
+    the file can be used as ``calibration.json``. ``models`` are the models
+    fitted additionally per quantity.
+
+    No file is written for a sensor with too few intervals to determine the
+    linear fit (see :func:`usable`), its ``calibration_file`` is left empty
+    in ``calibration_results.csv``. All sensors are returned.
+    '''
+    models = {q: (models or {}).get(q, Model()) for q in QUANTITIES}
+    sensors = [k for k in averages.keys() if k != reference]
+    linear: dict[str, list[Fit]] = {}
+    fits: dict[str, list[Fit]] = {}
+    for quantity in QUANTITIES:
+        pairs = pair(averages, sensors, reference, quantity)
+        linear[quantity] = fit(pairs, Model())
+        fits[quantity] = (
+            linear[quantity] if models[quantity].name == 'linear'
+            else fit(pairs, models[quantity])
+        )
+
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    with open(os.path.join(out_dir, 'calibration_results.csv'), 'w') as f:
+        f.write(
+            'sensor_nr,serial_nr,quantity,model,n,rmse_before,rmse_after,'
+            'r2,coefficients,calibration_file\n',
+        )
+        for i, sensor in enumerate(sensors):
+            calib = calibration(
+                sensor,
+                averages.serials.get(sensor, ()),
+                {q: linear[q][i] for q in QUANTITIES},
+                {q: fits[q][i] for q in QUANTITIES},
+                models,
+            )
+            filename = ''
+            if usable(calib):
+                filename = f'calibration_{sensor}.json'
+                with open(os.path.join(out_dir, filename), 'w') as c:
+                    json.dump(calib, c, indent=2)
+                    c.write('\n')
+            for quantity, prefix in QUANTITIES.items():
+                r = calib[f'{prefix}_fit']
+                f.write(
+                    f"{sensor},{' '.join(calib['serial_nr'])},{quantity},"
+                    f"{r['model']},{r['n']},{r['rmse_before']},"
+                    f"{r['rmse_after']},{r['r2']},"
+                    f"{' '.join(str(c) for c in r['coefficients'])},"
+                    f'{filename}\n',
+                )
+            results.append(calib)
+    return results
@@ -0,0 +1,118 @@
+'''A short history of GPS fixes to get the position at any point in time.'''
+from __future__ import annotations
+
+import threading
+from bisect import bisect_right
+from typing import NamedTuple
+
+_NAN = float('nan')
+
+
+class Position(NamedTuple):
+    latitude: float
+    longitude: float
+    alt: float
+    # speed in knots
+    speed: float
+    # UTC time of the GPS at the position as a POSIX timestamp
+    time: float
+    # seconds between the requested time and the newest fix before it
+    age: float
+
+
+NO_POSITION = Position(_NAN, _NAN, _NAN, _NAN, _NAN, _NAN)
+
+
+class FixHistory:
+    '''Keep the last ``capacity`` fixes with their monotonic timestamps.
+
+    :meth:`at` interpolates linearly between the two fixes around a point
+    in time. After the newest fix, the position is extrapolated from the
+    last two fixes for up to ``max_extrapolation`` seconds, later the newest
+    fix is returned as is. The fixes are found using a binary search, so a
+    lookup is ``O(log n)``.
+    '''
+
+    def __init__(
+            self,
+            capacity: int = 64,
+            max_extrapolation: float = 1,
+    ) -> None:
+        self.capacity = capacity
+        self.max_extrapolation = max_extrapolation
+        self._times: list[float] = []
+        self._fixes: list[tuple[float, float, float, float, float]] = []
+        self._lock = threading.Lock()
+
+    def append(
+            self,
+            timestamp: float,
+            latitude: float,
+            longitude: float,
+            alt: float,
+            speed: float,
+            time: float = _NAN,
+    ) -> None:
+        '''add a fix, ``timestamp`` is the ``time.monotonic()`` of the fix,
+        ``time`` the UTC time of the GPS as a POSIX timestamp'''
+        fix = (latitude, longitude, alt, speed, time)
+        with self._lock:
+            if self._times and timestamp <= self._times[-1]:
+                # the clock is monotonic, keep the list sorted
+                self._fixes[-1] = fix
+                return
+            self._times.append(timestamp)
+            self._fixes.append(fix)
+            # trim in batches, so appending is amortized O(1)
+            if len(self._times) >= 2 * self.capacity:
+                del self._times[:-self.capacity]
+                del self._fixes[:-self.capacity]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._times.clear()
+            self._fixes.clear()
+
+    def at(self, timestamp: float) -> Position:
+        '''the position at ``timestamp`` (``time.monotonic()``)'''
+        with self._lock:
+            times = self._times
+            fixes = self._fixes
+            if not times:
+                return NO_POSITION
+
+            i = bisect_right(times, timestamp)
+            if i == 0:
+                # before the oldest fix
+                return Position(*fixes[0], age=timestamp - times[0])
+            t0 = times[i - 1]
+            age = timestamp - t0
+            if i < len(times):
+                t1, f0, f1 = times[i], fixes[i - 1], fixes[i]
+            elif (
+                    i > 1 and age <= self.max_extrapolation and
+                    t0 - times[i - 2] <= self.max_extrapolation
+            ):
+                # after the newest fix, continue the last movement
+                t1, f0, f1 = t0, fixes[i - 2], fixes[i - 1]
+                t0 = times[i - 2]
+            else:
+                return Position(*fixes[i - 1], age=age)
+
+        frac = (timestamp - t0) / (t1 - t0)
+        latitude, longitude, alt, speed, time = (
+            v0 + (v1 - v0) * frac for v0, v1 in zip(f0, f1)
+        )
+        return Position(latitude, longitude, alt, speed, time, age)
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'capacity={self.capacity!r}, '
+            f'max_extrapolation={self.max_extrapolation!r}, '
+            f'len={len(self)!r}'
+            ')'
+        )
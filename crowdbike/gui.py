@@ -0,0 +1,599 @@
+'''The tkinter GUI showing the measurements of a :class:`Recorder`.'''
+from __future__ import annotations
+
+import logging
+import math
+import os
+import queue
+import threading
+from collections.abc import Callable
+from tkinter import Button
+from tkinter import DISABLED
+from tkinter import E
+from tkinter import font
+from tkinter import HORIZONTAL
+from tkinter import Label
+from tkinter import messagebox
+from tkinter import NORMAL
+from tkinter import Scale
+from tkinter import Tk
+from tkinter import W
+from tkinter.ttk import Progressbar
+from tkinter.ttk import Separator
+from typing import Any
+from typing import Optional
+from typing import Union
+
+from crowdbike.helpers import get_ip
+from crowdbike.recorder import Recorder
+from crowdbike.upload import CANCELLED
+from crowdbike.upload import upload_to_cloud
+from crowdbike.upload import UploadResult
+from crowdbike.writer import Sample
+
+# the upload thread sends the progress per file, the results when it is done
+# or the exception it failed with
+UploadEvent = Union[
+    tuple[int, int, UploadResult], list[UploadResult], Exception,
+]
+
+# how the fields of a sample are shown
+_FORMATS: dict[str, Callable[[Any], str]] = {
+    'speed': '{:.1f} km/h'.format,
+    'raspberry_time': str,
+    'altitude': '{:.3f} m ASL'.format,
+    'latitude': '{:.6f} °N'.format,
+    'longitude': '{:.6f} °E'.format,
+    'gps_time': str,
+    'temperature': '{:.1f} °C'.format,
+    'rel_humidity': '{:.1f} %'.format,
+    'vapour_pressure': '{:.3f} kPa'.format,
+    'pm10': '{:.1f} \u03BCg/m\u00B3'.format,
+    'pm2_5': '{:.1f} \u03BCg/m\u00B3'.format,
+}
+
+
+def _same(a: Any, b: Any) -> bool:
+    '''compare two values, treating NaN as equal to NaN'''
+    if isinstance(a, float) and isinstance(b, float):
+        return a == b or (math.isnan(a) and math.isnan(b))
+    return bool(a == b)
+
+
+class CrowdbikeGUI:
+    def __init__(
+            self,
+            recorder: Recorder,
+            config: dict[str, Any],
+            theme: dict[str, Any],
+            logger: logging.Logger,
+            *,
+            window_title: str,
+    ) -> None:
+        self.recorder = recorder
+        self.config = config
+        self.theme = theme
+        self.logger = logger
+        # set while an upload is running, to cancel it
+        self.upload_cancel: Optional[threading.Event] = None
+        # rows written to the logfile, kept after the recording stopped
+        self.counter = 0
+        # seconds between two refreshes of the displayed values
+        self.display_rate: float = theme.get('display_rate', 1)
+        # the options last set per label and the text last formatted per
+        # field, so unchanged labels are not redrawn
+        self._options: dict[str, dict[str, str]] = {}
+        self._formatted: dict[str, tuple[Any, str]] = {}
+        studentname = config['user']['studentname']
+
+        # define widgets
+        self.master = Tk()
+        self.master.protocol('WM_DELETE_WINDOW', self.exit_program)
+        self.master.configure(background=theme['bg_col'])
+        default_font = font.nametofont('TkDefaultFont')
+        default_font.configure(
+            size=theme['font_size'], family=theme['f_family'],
+        )
+        self.master.title(window_title)
+        Label(
+            self.master, text=' Name', fg=theme['fg_header'],
+            bg=theme['bg_col'],
+        ).grid(row=0, column=0, sticky=W)
+        Label(
+            self.master, text=studentname + "'s Crowdbike",
+            fg=theme['fg_header'], bg=theme['bg_col'],
+        ).grid(row=0, column=1, sticky=W, columnspan=2)
+        Label(
+            self.master, text=f'IP: {get_ip()}', fg=theme['fg_header'],
+            bg=theme['bg_col'],
+        ).grid(row=1, column=1, sticky=E, columnspan=2)
+        Label(
+            self.master, text=' PM-Sensor', fg=theme['fg_header'],
+            bg=theme['bg_col'],
+        ).grid(row=1, column=0, sticky=W, columnspan=2)
+        Separator(self.master, orient=HORIZONTAL).grid(
+            row=2, columnspan=3, sticky='ew', pady=(10, 10),
+        )
+        # define labels
+        label_speed = Label(
+            self.master, text=' Speed',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_speed.grid(row=3, column=0, sticky=W)
+
+        label_counter = Label(
+            self.master, text=' Counter',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_counter.grid(row=4, column=0, sticky=W)
+
+        label_ctime = Label(
+            self.master, text=' Time',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_ctime.grid(row=5, column=0, sticky=W)
+
+        label_altitude = Label(
+            self.master, text=' Altitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_altitude.grid(row=6, column=0, sticky=W)
+
+        label_latitude = Label(
+            self.master, text=' Latitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_latitude.grid(row=7, column=0, sticky=W)
+
+        label_longitude = Label(
+            self.master, text=' Longitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_longitude.grid(row=8, column=0, sticky=W)
+
+        label_time = Label(
+            self.master, text=' GPS Time',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_time.grid(row=9, column=0, sticky=W)
+
+        label_temperature = Label(
+            self.master, text=' Temperature',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_temperature.grid(row=10, column=0, sticky=W)
+
+        label_humidity = Label(
+            self.master, text=' Rel. Humidity',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_humidity.grid(row=11, column=0, sticky=W)
+
+        label_vappress = Label(
+            self.master, text=' Vap. Pressure   ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_vappress.grid(row=12, column=0, sticky=W)
+
+        # labels for pm sensor
+        label_pm10 = Label(
+            self.master, text=' PM 10 ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_pm10.grid(row=13, column=0, sticky=W)
+
+        label_pm2_5 = Label(
+            self.master, text=' PM 2.5 ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        label_pm2_5.grid(row=14, column=0, sticky=W)
+
+        # define values (constructed also as labels, the text is set by _show)
+        self.value_speed = Label(
+            self.master, text=' Speed',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_speed.grid(row=3, column=1, sticky=W, columnspan=2)
+
+        self.value_counter = Label(
+            self.master, text=' Counter', bg='red', fg=theme['fg_col'],
+        )
+        self.value_counter.grid(row=4, column=1, sticky=W, columnspan=2)
+
+        self.value_ctime = Label(
+            self.master, text=' Time',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_ctime.grid(row=5, column=1, sticky=W, columnspan=2)
+
+        self.value_altitude = Label(
+            self.master, text=' Altitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_altitude.grid(row=6, column=1, sticky=W, columnspan=2)
+
+        self.value_latitude = Label(
+            self.master, text=' Latitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_latitude.grid(row=7, column=1, sticky=W, columnspan=2)
+
+        self.value_longitude = Label(
+            self.master, text=' Longitude',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_longitude.grid(row=8, column=1, sticky=W, columnspan=2)
+
+        self.value_time = Label(
+            self.master, text='GPS Time ---------------',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_time.grid(row=9, column=1, sticky=W, columnspan=2)
+
+        self.value_temperature = Label(
+            self.master, text=' Temperature',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_temperature.grid(row=10, column=1, sticky=W, columnspan=2)
+
+        self.value_humidity = Label(
+            self.master, text=' Rel. Humidity',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_humidity.grid(row=11, column=1, sticky=W, columnspan=2)
+
+        self.value_vappress = Label(
+            self.master, text=' Vap. Pressure ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_vappress.grid(row=12, column=1, sticky=W, columnspan=2)
+
+        self.value_pm10 = Label(
+            self.master, text=' PM 10 ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_pm10.grid(row=13, column=1, sticky=W, columnspan=2)
+        self.value_pm2_5 = Label(
+            self.master, text=' PM 2.5 ',
+            bg=theme['bg_col'], fg=theme['fg_col'],
+        )
+        self.value_pm2_5.grid(row=14, column=1, sticky=W, columnspan=2)
+
+        self.values = {
+            'speed': self.value_speed,
+            'raspberry_time': self.value_ctime,
+            'altitude': self.value_altitude,
+            'latitude': self.value_latitude,
+            'longitude': self.value_longitude,
+            'gps_time': self.value_time,
+            'temperature': self.value_temperature,
+            'rel_humidity': self.value_humidity,
+            'vapour_pressure': self.value_vappress,
+            'pm10': self.value_pm10,
+            'pm2_5': self.value_pm2_5,
+        }
+        # initialize self.value_counter
+        self.start_display(self.value_counter)
+        Separator(self.master, orient=HORIZONTAL).grid(
+            row=15, columnspan=3, sticky='ew', pady=(10, 0),
+        )
+        Label(
+            self.master, text='',
+            bg=theme['bg_col'], font=(theme['f_family'], 10),
+        ).grid(row=16, pady=(10, 0))
+        Label(
+            self.master, text='',
+            bg=theme['bg_col'], font=(theme['f_family'], 14),
+        ).grid(row=17, pady=(0, 10))
+
+        # define buttons
+        self.b_record = Button(
+            self.master,
+            text='Record',
+            width=7,
+            state=DISABLED,
+            bg=theme['b_col'],
+            fg=theme['fg_col'],
+            font=(theme['f_family'], 12, 'bold'),
+            disabledforeground=theme['b_disabled'],
+            command=self.record_data,
+            activeforeground=theme['fg_col'],
+            activebackground=theme['b_hover'],
+            highlightcolor=theme['b_hl_border'],
+            highlightbackground=theme['b_hl_border'],
+            highlightthickness=1,
+
+        )
+        self.b_record.grid(
+            row=18, column=0, sticky=W, padx=(20, 0), pady=(0, 20),
+        )
+
+        self.b_stop = Button(
+            self.master,
+            text='Stop',
+            width=7,
+            bg=theme['b_col'],
+            fg=theme['fg_col'],
+            font=(theme['f_family'], 12, 'bold'),
+            state=DISABLED, command=self.stop_data,
+            disabledforeground=theme['b_disabled'],
+            activeforeground=theme['fg_col'],
+            activebackground=theme['b_hover'],
+            highlightcolor=theme['b_hl_border'],
+            highlightbackground=theme['b_hl_border'],
+            highlightthickness=1,
+        )
+        self.b_stop.grid(
+            row=18, column=1, sticky=W, padx=(20, 40), pady=(0, 20),
+        )
+
+        self.b_exit = Button(
+            self.master,
+            text='Exit',
+            width=7,
+            bg=theme['b_col'],
+            fg=theme['fg_col'],
+            font=(theme['f_family'], 12, 'bold'),
+            state=NORMAL, command=self.exit_program,
+            activeforeground=theme['fg_col'],
+            activebackground=theme['b_hover'],
+            highlightcolor=theme['b_hl_border'],
+            highlightbackground=theme['b_hl_border'],
+            highlightthickness=1,
+        )
+        self.b_exit.grid(row=18, column=2, sticky=W, pady=(0, 20))
+
+        self.b_upload = Button(
+            self.master,
+            text='upload',
+            width=7,
+            state=DISABLED,
+            command=self.start_upload,
+            fg=theme['fg_col'],
+            bg=theme['b_col'],
+            font=(theme['f_family'], 12, 'bold'),
+            disabledforeground=theme['b_disabled'],
+            activeforeground=theme['fg_col'],
+            activebackground=theme['b_hover'],
+            highlightcolor=theme['b_hl_border'],
+            highlightbackground=theme['b_hl_border'],
+            highlightthickness=1,
+        )
+        self.b_upload.grid(
+            row=18, column=0, sticky=E, padx=(0, 20), pady=(0, 20),
+        )
+
+        # slider
+        self.pm_slider = Scale(
+            orient=HORIZONTAL, length=80, to=1, label='',
+            showvalue=False, sliderlength=40, troughcolor='#666666',
+            width=30, command=self.set_pm_status,
+            fg=theme['fg_col'],
+            bg=theme['b_col'],
+            activebackground=theme['b_hover'],
+            highlightcolor=theme['b_hl_border'],
+            highlightbackground=theme['b_hl_border'],
+            highlightthickness=1,
+        )
+        if self.recorder.pm_status:
+            self.pm_slider['troughcolor'] = '#20ff20'
+        else:
+            self.pm_slider['troughcolor'] = '#c10000'
+
+        self.pm_slider.set(int(self.recorder.pm_status))
+        self.pm_slider.grid(row=1, column=1, sticky=W)
+
+    def run(self) -> None:
+        '''start recording and run the mainloop until the window is closed'''
+        self.record_data()
+        self.master.mainloop()
+
+    def exit_program(self) -> None:
+        self.logger.info('exiting program...')
+        if self.upload_cancel is not None:
+            self.upload_cancel.set()
+        self.master.destroy()
+
+    def record_data(self) -> None:
+        self.b_stop.config(state=NORMAL)
+        self.b_record.config(state=DISABLED)
+        self.b_upload.config(state=DISABLED)
+        self.recorder.start_recording()
+
+    def stop_data(self) -> None:
+        self.recorder.stop_recording()
+        self.b_record.config(state=NORMAL)
+        self.b_stop.config(state=DISABLED)
+        self.b_upload.config(state=NORMAL)
+
+    # tkinter button slider function
+    def set_pm_status(self, value: str) -> None:
+        if value == '1':
+            self.pm_slider['troughcolor'] = '#20ff20'
+            self.recorder.set_pm(True)
+        else:
+            self.pm_slider['troughcolor'] = '#c10000'
+            self.recorder.set_pm(False)
+
+    def _upload_worker(
+            self,
+            events: queue.Queue[UploadEvent],
+            cancel: threading.Event,
+    ) -> None:
+        '''runs in a separate thread, so the GUI and measurements continue'''
+        try:
+            results = upload_to_cloud(
+                verbose=False,
+                config=self.config,
+                logger=self.logger,
+                progress=lambda done, total, r: events.put((done, total, r)),
+                cancel=cancel,
+            )
+            events.put(results)
+        except Exception as e:
+            events.put(e)
+
+    def start_upload(self) -> None:
+        if self.upload_cancel is not None:
+            # the upload button cancels a running upload
+            self.upload_cancel.set()
+            self.b_upload.config(state=DISABLED)
+            self.logger.warning('upload cancelled')
+            return
+
+        self.upload_cancel = threading.Event()
+        events: queue.Queue[UploadEvent] = queue.Queue()
+        self.b_record.config(state=DISABLED)
+        self.b_upload.config(text='cancel')
+        pb = Progressbar(
+            self.master,
+            orient='horizontal',
+            mode='determinate',
+            length=500,
+        )
+        pb.grid(row=16, column=0, columnspan=3)
+        progress_txt = Label(
+            self.master, text='preparing upload...',
+            bg=self.theme['bg_col'],
+            fg=self.theme['fg_col'],
+            font=(self.theme['f_family'], 14),
+        )
+        progress_txt.grid(row=17, columnspan=3, pady=(0, 10))
+        threading.Thread(
+            target=self._upload_worker,
+            args=(events, self.upload_cancel),
+            name='upload',
+            daemon=True,
+        ).start()
+        self.master.after(100, self.poll_upload, events, pb, progress_txt)
+
+    def poll_upload(
+            self,
+            events: queue.Queue[UploadEvent],
+            pb: Progressbar,
+            progress_txt: Label,
+    ) -> None:
+        '''process the events of the upload thread in the tkinter mainloop'''
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                self.master.after(
+                    100, self.poll_upload, events, pb, progress_txt,
+                )
+                return
+
+            if isinstance(event, tuple):
+                done, total, result = event
+                name = os.path.basename(result.path)
+                if result.ok:
+                    progress_txt.config(
+                        text=f'uploaded: {name} ({done}/{total})',
+                    )
+                else:
+                    progress_txt.config(
+                        text=f'failed: {name} ({done}/{total})',
+                    )
+                pb['value'] = (done * 100) / total
+                continue
+
+            # the upload finished
+            pb.grid_forget()
+            progress_txt.grid_forget()
+            self.upload_cancel = None
+            self.b_upload.config(text='upload', state=NORMAL)
+            self.b_record.config(state=NORMAL)
+            if isinstance(event, Exception):
+                messagebox.showerror(
+                    title='Error',
+                    message=f'An error occurred while uploading:\n{event}',
+                )
+            elif not event:
+                messagebox.showinfo(
+                    title='upload',
+                    message=(
+                        'Everything up to date. There are no files to upload'
+                    ),
+                )
+            else:
+                failed = sum(not r.ok for r in event)
+                cancelled = sum(r.error == CANCELLED for r in event)
+                if cancelled > 0:
+                    messagebox.showinfo(
+                        title='upload cancelled',
+                        message=(
+                            f'uploaded {len(event) - failed} of '
+                            f'{len(event)} files'
+                        ),
+                    )
+                elif failed == 0:
+                    messagebox.showinfo(
+                        title='upload successfull',
+                        message=f'successfully uploaded {len(event)} files',
+                    )
+                else:
+                    messagebox.showerror(
+                        title='upload failed',
+                        message=(
+                            f'failed uploading {failed} of {len(event)} files'
+                        ),
+                    )
+            return
+
+    def start_display(self, label: Label) -> None:
+        '''show the latest measurement every ``display_rate`` seconds,
+        independent of the sampling'''
+        shown: Optional[tuple[Sample, float]] = None
+        delay = int(self.display_rate * 1000)
+
+        def refresh() -> None:
+            nonlocal shown
+            current = self.recorder.latest
+            if current is not None and current is not shown:
+                shown = current
+                self._show(label, *current)
+            label.after(delay, refresh)
+
+        refresh()
+
+    def _config(self, label: Label, **options: str) -> None:
+        '''only reconfigure the options of a label that changed, every
+        change causes a redraw'''
+        current = self._options.setdefault(str(label), {})
+        changed = {k: v for k, v in options.items() if current.get(k) != v}
+        if changed:
+            label.config(**changed)
+            current.update(changed)
+
+    def _text(self, field: str, value: Any) -> str:
+        '''format the value of a field, reusing the text if it is unchanged'''
+        cached = self._formatted.get(field)
+        if cached is not None and _same(cached[0], value):
+            return cached[1]
+        text = _FORMATS[field](value)
+        self._formatted[field] = (value, text)
+        return text
+
+    def _show(self, label: Label, row: Sample, f_mode: float) -> None:
+        if f_mode == 2:
+            self._config(self.value_counter, bg='orange')
+        elif f_mode > 2:
+            self._config(self.value_counter, bg='#20ff20')
+        else:
+            self._config(self.value_counter, bg='red')
+
+        for field, value_label in self.values.items():
+            self._config(
+                value_label, text=self._text(field, getattr(row, field)),
+            )
+
+        writer = self.recorder.writer
+        if writer is not None:
+            self.counter = writer.counter
+        counter_txt = str(self.counter)
+        if writer is not None:
+            if writer.dropped > 0:
+                counter_txt += f' ({writer.dropped} dropped)'
+        if self.recorder.scheduler.missed > 0:
+            counter_txt += f' ({self.recorder.scheduler.missed} missed)'
+        self._config(label, text=counter_txt)
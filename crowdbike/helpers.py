@@ -1,41 +1,41 @@
 from __future__ import annotations
 
-import importlib.resources
+import functools
 import logging
 import math
 import os
-import re
-import shutil
 import socket
-import subprocess
 import uuid
-from tkinter import Label
-from tkinter import messagebox
-from tkinter import Tk
-from tkinter import ttk
-from typing import Any
-
-import RPi.GPIO as GPIO
 
 
 CONFIG_DIR = os.path.expanduser('~/.config/crowdbike')
+NET_DIR = '/sys/class/net'
 
 
-# set GPIOs at import time
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(23, GPIO.OUT)
-GPIO.setup(24, GPIO.OUT)
-GPIO.setup(25, GPIO.OUT)
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read().strip()
 
 
+@functools.lru_cache(maxsize=None)
 def get_wlan_macaddr() -> str:
-    ifconfig = subprocess.check_output(args=('ifconfig', '-a')).decode('utf-8')
-    match = re.search(r'(?:ether\s)([0-9a-f:]+)', ifconfig)
-    if match is not None:
-        mac_address = match.groups()[0]
-    else:
-        mac_address = str(uuid.getnode())
-    return mac_address
+    '''the MAC address of the first ethernet or wlan interface, in the order
+    ``ifconfig -a`` lists them (by name)'''
+    try:
+        names = sorted(os.listdir(NET_DIR))
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            # 1 is ARPHRD_ETHER, which includes wlan interfaces
+            if _read(os.path.join(NET_DIR, name, 'type')) != '1':
+                continue
+            address = _read(os.path.join(NET_DIR, name, 'address'))
+        except OSError:
+            continue
+        if address != '00:00:00:00:00:00':
+            return address
+    return str(uuid.getnode())
 
 
 def get_ip() -> str:
@@ -68,27 +68,6 @@ def vappressure(
     return vappress
 
 
-def update_led(
-        red: bool | None = None,
-        yellow: bool | None = None,
-        green: bool | None = None,
-) -> None:
-    if red is True:
-        GPIO.output(23, GPIO.HIGH)
-    else:
-        GPIO.output(23, GPIO.LOW)
-
-    if yellow is True:
-        GPIO.output(24, GPIO.HIGH)
-    else:
-        GPIO.output(24, GPIO.LOW)
-
-    if green is True:
-        GPIO.output(25, GPIO.HIGH)
-    else:
-        GPIO.output(25, GPIO.LOW)
-
-
 def setup_config() -> None:
     if os.path.exists(CONFIG_DIR):
         choice = input(
@@ -104,6 +83,9 @@ def setup_config() -> None:
 
 
 def _make_config_dirs() -> None:
+    # only needed by `crowdbike init`
+    import importlib.resources
+
     os.makedirs(CONFIG_DIR, exist_ok=True)
     cfg = importlib.resources.read_text('crowdbike.resources', 'config.json')
     calib = importlib.resources.read_text(
@@ -140,161 +122,3 @@ def create_logger(
     logger.addHandler(file_handler)
     logger.setLevel(loglevel)
     return logger
-
-
-def upload_to_cloud(
-        verbose: bool,
-        config: dict[str, Any],
-        logger: logging.Logger,
-        *,
-        root: Tk | None = None,
-        theme: dict[str, str] | None = None,
-) -> None:
-    if root is not None and theme is not None:
-        pb = ttk.Progressbar(
-            root,
-            orient='horizontal',
-            mode='determinate',
-            length=500,
-        )
-        pb.grid(row=16, column=0, columnspan=3)
-        progress_txt = Label(
-            root, text='',
-            bg=theme['bg_col'],
-            fg=theme['fg_col'],
-            font=(theme['f_family'], 14),
-        )
-        progress_txt.grid(row=17, columnspan=3,  pady=(0, 10))
-        pb.start()
-
-    try:
-        log_dir = config['user']['logfile_path']
-        archive_dir = os.path.join(log_dir, 'archive')
-        folder_token = config['cloud']['folder_token']
-        passwd = config['cloud']['passwd']
-        base_url = config['cloud']['base_url']
-        # we need a trailing slash for the url to be valid
-        if not base_url[-1] == '/':
-            base_url += '/'
-
-        os.makedirs(archive_dir, exist_ok=True)
-
-        files_present = False
-        for element in os.listdir(log_dir):
-            if os.path.isfile(os.path.join(log_dir, element)):
-                files_present = True
-                break
-
-        if verbose:
-            first_args = '-vT'
-        else:
-            first_args = '-T'
-
-        if files_present:
-            files = os.listdir(log_dir)
-            # the archive directory counts here and must be subtracted
-            nr_files = len(files) - 1
-            for idx, log in enumerate(files):
-                if os.path.splitext(log)[1].lower() == '.csv':
-                    status = f'uploading: {log} to the cloud'
-                    if root is not None:
-                        progress_txt.config(text=status)
-                        pb['value'] = ((idx + 1) * 100) / nr_files
-                        root.update_idletasks()
-
-                    logger.info(status)
-                    print(status)
-                    curl_call = [
-                        'curl', first_args, '--max-time', '30',
-                        os.path.join(log_dir, log), '-u', f'{folder_token}:{passwd}',  # noqa: E501
-                        '-H', 'X-Requested-With:XMLHttpRequest',
-                        f'{base_url}public.php/webdav/{log}',
-                    ]
-                    logger.debug(f'curl call sent: {curl_call}')
-                    if verbose:
-                        c = subprocess.run(args=curl_call, capture_output=True)
-                        stdoutput = c.stdout.decode('utf-8')
-                        stderr = c.stderr.decode('utf-8')
-                        logging.debug(stderr)
-                        print(stderr)
-                        err = stderr.split('curl:')
-
-                        if c.returncode == 0:
-                            shutil.move(
-                                os.path.join(log_dir, log),
-                                archive_dir,
-                            )
-                        else:
-                            logger.warning(' error '.center(79, '='))
-                            print(' error '.center(79, '='))
-                            logger.warning(stdoutput)
-                            print(stdoutput)
-                            logger.warning(err)
-                            print(err)
-                            break
-
-                    else:
-                        c = subprocess.run(args=curl_call, capture_output=True)
-                        stdoutput = c.stdout.decode('utf-8')
-                        stderr = c.stderr.decode('utf-8')
-                        err = stderr.split('curl:')
-
-                        if c.returncode == 0:
-                            shutil.move(
-                                os.path.join(log_dir, log),
-                                archive_dir,
-                            )
-                        else:
-                            logger.warning(' error '.center(79, '='))
-                            print(' error '.center(79, '='))
-                            logger.warning(stdoutput)
-                            print(stdoutput)
-                            logger.warning(err)
-                            print(err)
-                            break
-
-            if root is not None:
-                progress_txt.config(text='')
-                pb.stop()
-                pb.grid_forget()
-                if c.returncode == 0:
-                    messagebox.showinfo(
-                        title='upload successfull',
-                        message=f'successfully uploaded {nr_files} files',
-                    )
-                else:
-                    messagebox.showerror(
-                        title='upload failed',
-                        message=f'failed uploading {nr_files} files',
-                    )
-
-        elif not files_present:
-            nothing_to_do = (
-                f'Everything up to date. '
-                f'There are no files to upload in "{log_dir}"'
-            )
-            if root is not None:
-                pb.grid_forget()
-                messagebox.showinfo(title='test', message=nothing_to_do)
-
-            logger.info(nothing_to_do)
-            print(nothing_to_do)
-        else:
-            raise Exception(
-                f'An unknown error occurred. {files_present} is not a boolean',
-            )
-    except Exception as e:
-        err_msg = f'An error occurred while uploading:\n{e}'
-        if root is not None:
-            pb.grid_forget()
-            messagebox.showerror(title='Error', message=err_msg)
-        else:
-            logger.error(err_msg)
-            print(err_msg)
-    finally:
-        if root is not None:
-            pb.stop()
-            pb.grid_forget()
-            progress_txt.grid_forget()
-        else:
-            pass
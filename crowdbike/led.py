@@ -0,0 +1,165 @@
+'''The status light: one LED per sensor, switched from a single thread.'''
+from __future__ import annotations
+
+import threading
+from types import ModuleType
+from typing import Optional
+from typing import Protocol
+
+# BCM numbers of the pins the LEDs are connected to
+PINS = {'red': 23, 'yellow': 24, 'green': 25}
+
+
+class Backend(Protocol):
+    def setup(self, pins: list[int]) -> None: ...
+    def output(self, pin: int, on: bool) -> None: ...
+    def cleanup(self) -> None: ...
+
+
+class GPIOBackend:
+    '''the GPIOs of the Raspberry Pi, ``RPi.GPIO`` is imported by setup'''
+
+    def __init__(self) -> None:
+        self._gpio: Optional[ModuleType] = None
+
+    def setup(self, pins: list[int]) -> None:
+        import RPi.GPIO as GPIO
+
+        GPIO.setmode(GPIO.BCM)
+        for pin in pins:
+            GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+        self._gpio = GPIO
+
+    def output(self, pin: int, on: bool) -> None:
+        assert self._gpio is not None
+        self._gpio.output(pin, self._gpio.HIGH if on else self._gpio.LOW)
+
+    def cleanup(self) -> None:
+        if self._gpio is not None:
+            self._gpio.cleanup()
+            self._gpio = None
+
+
+class NullBackend:
+    '''for computers without GPIOs, nothing is switched'''
+
+    def setup(self, pins: list[int]) -> None:
+        pass
+
+    def output(self, pin: int, on: bool) -> None:
+        pass
+
+    def cleanup(self) -> None:
+        pass
+
+
+def default_backend() -> Backend:
+    '''the GPIOs if ``RPi.GPIO`` works on this computer, otherwise no-op'''
+    try:
+        import RPi.GPIO  # noqa: F401
+    except (ImportError, RuntimeError):
+        # RPi.GPIO raises a RuntimeError if this is not a Raspberry Pi
+        return NullBackend()
+    return GPIOBackend()
+
+
+class LedManager:
+    '''Own the state of the LEDs and switch them from a single thread.
+
+    :meth:`set` only records the requested state of the given LEDs, the
+    others keep theirs. A background thread, started on first use, applies
+    all changes that accumulated since it last woke up and only writes the
+    pins whose state actually changed. The backend (by default the GPIOs) is
+    also only set up then, so importing this does not touch the hardware.
+    '''
+
+    def __init__(
+            self,
+            backend: Optional[Backend] = None,
+            pins: Optional[dict[str, int]] = None,
+    ) -> None:
+        self._backend = backend
+        self.pins = PINS if pins is None else pins
+        self._desired = dict.fromkeys(self.pins, False)
+        self._applied: dict[str, bool] = {}
+        self._changed = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closing = False
+        # number of pin writes
+        self.writes = 0
+
+    @property
+    def backend(self) -> Backend:
+        if self._backend is None:
+            self._backend = default_backend()
+        return self._backend
+
+    def set(self, **states: bool) -> None:
+        '''switch LEDs on or off, e.g. ``set(red=True)``'''
+        for led in states:
+            if led not in self.pins:
+                raise ValueError(
+                    f'unknown LED {led!r}, must be one of '
+                    f'{", ".join(self.pins)}',
+                )
+        with self._changed:
+            self._desired.update(states)
+            if self._thread is None:
+                self._closing = False
+                self._thread = threading.Thread(
+                    target=self._run, name='leds', daemon=True,
+                )
+                self._thread.start()
+            self._changed.notify()
+
+    def _pending(self) -> dict[str, bool]:
+        return {
+            led: on for led, on in self._desired.items()
+            if self._applied.get(led) != on
+        }
+
+    def _apply(self, changes: dict[str, bool]) -> None:
+        if not self._applied:
+            self.backend.setup(list(self.pins.values()))
+        for led, on in changes.items():
+            self.backend.output(self.pins[led], on)
+            self._applied[led] = on
+        self.writes += len(changes)
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: bool(self._pending()) or self._closing,
+                )
+                if self._closing:
+                    return
+                changes = self._pending()
+            self._apply(changes)
+
+    def close(self) -> None:
+        '''switch all LEDs off and release the pins'''
+        with self._changed:
+            self._closing = True
+            self._changed.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        if self._applied:
+            self._desired = dict.fromkeys(self.pins, False)
+            self._apply(self._pending())
+            self.backend.cleanup()
+            self._applied.clear()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'backend={type(self._backend).__name__}, '
+            f'state={self._desired!r}, '
+            f'writes={self.writes!r}'
+            ')'
+        )
+
+
+# the status light, shared by the sensor threads
+leds = LedManager()
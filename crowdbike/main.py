@@ -1,649 +1,655 @@
+'''The ``crowdbike`` command.
+
+Only the modules a command needs are imported by it, so e.g. ``crowdbike
+upload`` does not load the sensor drivers, numpy or tkinter.
+'''
+from __future__ import annotations
+
 import argparse
-import importlib.metadata
 import json
+import logging
 import os
-import sys
-from datetime import datetime
-from tkinter import Button
-from tkinter import DISABLED
-from tkinter import E
-from tkinter import font
-from tkinter import HORIZONTAL
-from tkinter import Label
-from tkinter import mainloop
-from tkinter import NORMAL
-from tkinter import Scale
-from tkinter import Tk
-from tkinter import W
-from tkinter.ttk import Separator
-from typing import NoReturn
+import signal
+import threading
+import time
+from collections.abc import Sequence
+from types import FrameType
+from typing import Any
 from typing import Optional
+from typing import TYPE_CHECKING
 from typing import Union
 
-import RPi.GPIO as GPIO
-from serial.serialutil import SerialException
-
 from crowdbike.helpers import CONFIG_DIR
 from crowdbike.helpers import create_logger
-from crowdbike.helpers import get_ip
-from crowdbike.helpers import get_wlan_macaddr
-from crowdbike.helpers import sat_vappressure
-from crowdbike.helpers import setup_config
-from crowdbike.helpers import upload_to_cloud
-from crowdbike.helpers import vappressure
-from crowdbike.sensors import DHT22
-from crowdbike.sensors import GPS
-from crowdbike.sensors import PmSensor
-from crowdbike.sensors import SHT85
-
-
-class ArgumentParser(argparse.ArgumentParser):
-    def exit(self, status: int = 0, message: Optional[str] = None) -> NoReturn:
-        GPIO.cleanup()
-        if message:
-            self._print_message(message, sys.stderr)
-        exit(status)
-
-
-parser = ArgumentParser()
-version = importlib.metadata.version('crowdbike')
-parser.add_argument('command', choices=['init', 'run', 'upload'])
-parser.add_argument(
-    '-V', '--version',
-    action='version',
-    version=f'%(prog)s {version}',
-)
-parser.add_argument(
-    '--logfile',
-    type=str,
-    default=os.path.expanduser('~/crowdbike.log'),
-    help='file to write the system logs to',
-)
-parser.add_argument(
-    '--loglevel',
-    type=str,
-    default='WARNING',
-    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
-)
-parser.add_argument(
-    '--stationary',
-    action='store_true',
-    help=(
-        'indicate that this sensor is deployed in a stationary setup. With '
-        'this flag set, no GPS signal is required to log data'
-    ),
-)
-args = parser.parse_args()
-if args.command == 'init':
+
+if TYPE_CHECKING:
+    from crowdbike.metrics import MetricsServer
+    from crowdbike.recorder import Recorder
+    from crowdbike.scheduler import Scheduler
+    from crowdbike.scheduler import Tick
+
+# interval of the status messages in headless mode, in seconds
+STATUS_INTERVAL = 60
+
+
+def _version() -> str:
+    import importlib.metadata
+
+    return importlib.metadata.version('crowdbike')
+
+
+class _VersionAction(argparse.Action):
+    '''like ``action='version'``, but only looks up the version if used'''
+
+    def __init__(self, option_strings: Sequence[str], dest: str) -> None:
+        super().__init__(
+            option_strings,
+            dest,
+            nargs=0,
+            default=argparse.SUPPRESS,
+            help="show program's version number and exit",
+        )
+
+    def __call__(
+            self,
+            parser: argparse.ArgumentParser,
+            namespace: argparse.Namespace,
+            values: Union[str, Sequence[Any], None],
+            option_string: Optional[str] = None,
+    ) -> None:
+        parser.exit(message=f'{parser.prog} {_version()}\n')
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-V', '--version', action=_VersionAction)
+    # options shared by all commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '--logfile',
+        type=str,
+        default=os.path.expanduser('~/crowdbike.log'),
+        help='file to write the system logs to',
+    )
+    common.add_argument(
+        '--loglevel',
+        type=str,
+        default='WARNING',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+    )
+    common.add_argument(
+        '--profile',
+        action='store_true',
+        help=(
+            'profile the main thread and the sensor threads and write the '
+            'results to --profile-dir at exit'
+        ),
+    )
+    common.add_argument(
+        '--profile-dir',
+        type=str,
+        default=os.path.expanduser('~/crowdbike/profiles'),
+        help='directory for the profiles, default: ~/crowdbike/profiles',
+    )
+    common.add_argument(
+        '--profile-seconds',
+        type=float,
+        default=None,
+        help=(
+            'only profile the first N seconds with the sampling profiler. '
+            '`run` also profiles the next N seconds (default: 60) when it '
+            'receives SIGUSR1'
+        ),
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser(
+        'init',
+        parents=[common],
+        help='create the configuration files',
+    )
+    run_parser = subparsers.add_parser(
+        'run',
+        parents=[common],
+        help='start measuring',
+    )
+    run_parser.add_argument(
+        '--stationary',
+        action='store_true',
+        help=(
+            'indicate that this sensor is deployed in a stationary setup. '
+            'With this flag set, no GPS signal is required to log data'
+        ),
+    )
+    run_parser.add_argument(
+        '--headless',
+        action='store_true',
+        help=(
+            'run without the GUI, e.g. as a service. Measurements are '
+            'recorded until SIGTERM or SIGINT is received'
+        ),
+    )
+    subparsers.add_parser(
+        'upload',
+        parents=[common],
+        help='upload the logfiles to the cloud',
+    )
+    export_parser = subparsers.add_parser(
+        'export',
+        parents=[common],
+        help='convert binary logfiles to csv',
+    )
+    export_parser.add_argument('files', nargs='+', help='binary logfiles')
+    export_parser.add_argument(
+        '-o', '--output-dir',
+        type=str,
+        default=None,
+        help='directory for the csv files, defaults to the input directory',
+    )
+    process_parser = subparsers.add_parser(
+        'process',
+        parents=[common],
+        help=(
+            'apply the calibration to logfiles again and add the dew point '
+            'and absolute humidity'
+        ),
+    )
+    process_parser.add_argument(
+        'files',
+        nargs='+',
+        help='csv or binary logfiles',
+    )
+    process_parser.add_argument(
+        '-o', '--output-dir',
+        type=str,
+        default=None,
+        help=(
+            'directory for the processed csv files, defaults to the input '
+            'directory'
+        ),
+    )
+    process_parser.add_argument(
+        '-c', '--calibration',
+        type=str,
+        default=None,
+        help='calibration file, defaults to the one in the config directory',
+    )
+    process_parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='number of files to process in parallel, default: 1',
+    )
+    calibrate_parser = subparsers.add_parser(
+        'calibrate',
+        parents=[common],
+        help=(
+            'fit the calibration of the temperature and humidity sensors '
+            'from a climate chamber log'
+        ),
+    )
+    calibrate_parser.add_argument(
+        'files',
+        nargs='+',
+        help=(
+            'csv files with the columns date, temperature, humidity, '
+            'sensor_nr and serial_nr as written by calib/read_multiple.py'
+        ),
+    )
+    reference = calibrate_parser.add_mutually_exclusive_group(required=True)
+    reference.add_argument(
+        '--reference',
+        type=str,
+        default=None,
+        help='csv file with the reference measurements',
+    )
+    reference.add_argument(
+        '--reference-sensor',
+        type=str,
+        default=None,
+        help='sensor_nr of the sensor in the chamber log used as reference',
+    )
+    calibrate_parser.add_argument(
+        '--reference-columns',
+        type=str,
+        default='date,temperature,humidity',
+        help=(
+            'date, temperature and humidity column of the reference file, '
+            'default: %(default)s'
+        ),
+    )
+    calibrate_parser.add_argument(
+        '--reference-offset',
+        type=float,
+        default=0,
+        help=(
+            'seconds added to the dates of the reference file, e.g. -3600 '
+            'if it is in UTC+1, default: %(default)s'
+        ),
+    )
+    calibrate_parser.add_argument(
+        '--interval',
+        type=float,
+        default=600,
+        help='averaging interval in seconds, default: %(default)s',
+    )
+    calibrate_parser.add_argument(
+        '--start',
+        type=str,
+        default=None,
+        help='ignore measurements before, e.g. 2020-05-26 16:00:00',
+    )
+    calibrate_parser.add_argument(
+        '--end',
+        type=str,
+        default=None,
+        help='ignore measurements from then on',
+    )
+    calibrate_parser.add_argument(
+        '--model',
+        choices=('linear', 'poly', 'piecewise'),
+        default='linear',
+        help=(
+            'model fitted in addition to the linear calibration, '
+            'default: %(default)s'
+        ),
+    )
+    calibrate_parser.add_argument(
+        '--degree',
+        type=int,
+        default=2,
+        help='degree of the poly model, default: %(default)s',
+    )
+    calibrate_parser.add_argument(
+        '--temp-breakpoints',
+        type=str,
+        default='',
+        help='temperatures where the piecewise model may bend, e.g. 0,20',
+    )
+    calibrate_parser.add_argument(
+        '--hum-breakpoints',
+        type=str,
+        default='',
+        help='humidities where the piecewise model may bend, e.g. 40,80',
+    )
+    calibrate_parser.add_argument(
+        '-o', '--output-dir',
+        type=str,
+        default='.',
+        help='directory for the calibration files, default: %(default)s',
+    )
+    return parser
+
+
+def run_headless(recorder: Recorder, logger: logging.Logger) -> None:
+    '''record until SIGTERM or SIGINT is received'''
+    stop = threading.Event()
+
+    def _stop(signum: int, frame: Optional[FrameType]) -> None:
+        logger.warning(f'received {signal.Signals(signum).name}, stopping...')
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    logfile = recorder.start_recording()
+    print(f'recording to {logfile}, stop with SIGTERM or SIGINT (Ctrl+C)')
+    while not stop.wait(STATUS_INTERVAL):
+        writer = recorder.writer
+        if writer is not None:
+            logger.info(
+                f'{writer.counter} rows written, {writer.dropped} dropped, '
+                f'{recorder.scheduler.missed} ticks missed',
+            )
+
+
+def _load_config(logger: logging.Logger) -> dict[str, Any]:
+    with open(os.path.join(CONFIG_DIR, 'config.json')) as cfg:
+        config: dict[str, Any] = json.load(cfg)
+        logger.info(f'configuration loaded: {json.dumps(config, indent=2)}')
+    return config
+
+
+def init(args: argparse.Namespace) -> int:
+    from crowdbike.helpers import setup_config
+
     setup_config()
-    GPIO.cleanup()
-    exit(0)
+    return 0
 
-logger = create_logger(logdir=args.logfile, loglevel=args.loglevel)
-logger.info('started crowdbike...')
-logger.info(f'arguments passed: {args}')
 
-# load config files
-with open(os.path.join(CONFIG_DIR, 'config.json')) as cfg:
-    config = json.load(cfg)
-    logger.info(f'configuration loaded: {json.dumps(config, indent=2)}')
+def upload(args: argparse.Namespace, logger: logging.Logger) -> int:
+    from crowdbike.upload import upload_to_cloud
 
-if args.command == 'upload':
+    config = _load_config(logger)
     if args.loglevel == 'DEBUG':
         verbose = True
     else:
         verbose = False
 
-    upload_to_cloud(verbose=verbose, config=config, logger=logger)
-    GPIO.cleanup()
-    exit(0)
-
-pi_id = config['user']['bike_nr']
-studentname = config['user']['studentname']
-mac = get_wlan_macaddr()
-
-with open(os.path.join(CONFIG_DIR, 'calibration.json')) as cal:
-    calib = json.load(cal)
-    logger.info(f'calibration loaded: {json.dumps(calib, indent=2)}')
-
-# calibration params
-temperature_cal_a1 = calib['temp_cal_a1']
-temperature_cal_a0 = calib['temp_cal_a0']
-hum_cal_a1 = calib['hum_cal_a1']
-hum_cal_a0 = calib['hum_cal_a0']
-
-window_title = f'Crowdbike {pi_id} - v{version}'
-logfile_path = config['user']['logfile_path']
-os.makedirs(logfile_path, exist_ok=True)
-
-counter = 0
-
-# initialize threads
-gpsp = GPS(logger)
-gpsp.start()
-
-temp_hum_sensor: Union[DHT22, SHT85]
-sensor_type = config['user']['sensor_type']
-if sensor_type == 'SHT85':
-    temp_hum_sensor = SHT85(logger)
-    logger.info('using SHT85 sensor')
-elif sensor_type == 'DHT22':
-    temp_hum_sensor = DHT22(logger)
-    logger.info('using DHT22 sensor')
-else:
-    raise NameError('sensor type unknown, must be either SHT85 or DHT22')
-
-temp_hum_sensor.start()
-nova_pm = PmSensor(dev='/dev/ttyUSB0', logger=logger)
-
-# global variables
-logfile = ''
-with open(os.path.join(CONFIG_DIR, 'theme.json')) as t:
-    theme = json.load(t)
-    logger.info(f'theme loaded: {json.dumps(theme, indent=2)}')
-
-recording = False
-
-pm_status = nova_pm.running = config['user']['pm_sensor']
-# switch off sensor if it is running prior to starting the app
-if pm_status is False:
     try:
-        nova_pm.sensor_sleep()
-    except SerialException:
-        logger.warning('could not set PM sensor to sleep mode (startup)')
-
-sampling_rate = config['user']['sampling_rate']
-
-cnames = [
-    'id',
-    'record',
-    'raspberry_time',
-    'gps_time',
-    'altitude',
-    'latitude',
-    'longitude',
-    'speed',
-    'temperature',
-    'temperature_raw',
-    'rel_humidity',
-    'rel_humidity_raw',
-    'vapour_pressure',
-    'pm10',
-    'pm2_5',
-    'mac',
-    'sensor_id',
-    'software_version',
-]
-
-
-def exit_program() -> None:
-    logger.info('exiting program...')
-    master.destroy()
-    gpsp.running = False
-    gpsp.stop()
-    gpsp.join()
-    temp_hum_sensor.running = False
-    temp_hum_sensor.join()
-    nova_pm.running = False
-    # only try joining the thread if it was running
-    if nova_pm.is_alive():
-        nova_pm.join()
-    GPIO.cleanup()
-    exit(0)
-
-
-def record_data() -> None:
-    global recording
-    global logfile
-    global counter
-    counter = 0
-    recording = True
-    b_stop.config(state=NORMAL)
-    b_record.config(state=DISABLED)
-    b_upload.config(state=DISABLED)
-    log_time = datetime.utcnow().strftime('%Y-%m-%d_%H%M%S')
-    logfile_name = f"{pi_id}_{studentname.replace(' ', '_')}_{log_time}.csv"
-    logfile = os.path.join(logfile_path, logfile_name)
-    logger.warning(f'writing measurement logs to {logfile}')
-
-    if os.path.isfile(logfile):
-        return
+        upload_to_cloud(verbose=verbose, config=config, logger=logger)
+    except Exception as e:
+        err_msg = f'An error occurred while uploading:\n{e}'
+        logger.error(err_msg)
+        print(err_msg)
+    return 0
+
+
+def export(args: argparse.Namespace, logger: logging.Logger) -> int:
+    from crowdbike.binlog import export_csv
+
+    for binfile in args.files:
+        out_dir = args.output_dir or os.path.dirname(binfile)
+        csvfile = os.path.join(
+            out_dir,
+            f'{os.path.splitext(os.path.basename(binfile))[0]}.csv',
+        )
+        nr_rows = export_csv(binfile, csvfile)
+        logger.info(f'exported {nr_rows} rows from {binfile} to {csvfile}')
+        print(f'{binfile} -> {csvfile} ({nr_rows} rows)')
+    return 0
+
+
+def process(args: argparse.Namespace, logger: logging.Logger) -> int:
+    from crowdbike.process import Calibration
+    from crowdbike.process import process_files
+
+    calib_path = args.calibration or os.path.join(
+        CONFIG_DIR, 'calibration.json',
+    )
+    with open(calib_path) as cal:
+        calib = Calibration.from_dict(json.load(cal))
+        logger.info(f'calibration loaded from {calib_path}: {calib}')
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    total_rows = 0
+    start = time.perf_counter()
+    for result in process_files(args.files, args.output_dir, calib, args.jobs):
+        total_rows += result.rows
+        if not result.rows and not result.skipped:
+            print(f'{result.path}: no rows, skipped')
+            continue
+        msg = (
+            f'{result.path} -> {result.out_path} ({result.rows} rows, '
+            f'{result.rows / result.seconds:,.0f} rows/s)'
+        )
+        if result.skipped:
+            msg += f', skipped {result.skipped} incomplete rows'
+        logger.info(msg)
+        print(msg)
+    duration = time.perf_counter() - start
+    print(
+        f'processed {total_rows} rows in {duration:.1f}s '
+        f'({total_rows / duration:,.0f} rows/s)',
+    )
+    return 0
+
+
+def calibrate(args: argparse.Namespace, logger: logging.Logger) -> int:
+    from crowdbike.calibrate import Averages
+    from crowdbike.calibrate import calibrate as fit_calibration
+    from crowdbike.calibrate import Model
+    from crowdbike.calibrate import read_csv
+    from crowdbike.calibrate import REFERENCE
+    from crowdbike.calibrate import usable
+
+    start = time.perf_counter()
+    averages = Averages(args.interval)
+    for path in args.files:
+        read_csv(path, averages, start=args.start, end=args.end)
+    if args.reference is not None:
+        reference = REFERENCE
+        read_csv(
+            args.reference,
+            averages,
+            columns=args.reference_columns.split(','),
+            key=REFERENCE,
+            offset=args.reference_offset,
+            start=args.start,
+            end=args.end,
+        )
     else:
-        f0 = open(logfile, 'w')
-        for i in range(0, len(cnames)-1):
-            f0.write(f'{cnames[i]},')
-        f0.write(f'{cnames[len(cnames)-1]}\n')
-        f0.close()
-
-
-def stop_data() -> None:
-    global recording
-    recording = False
-    logger.warning('recording stopped')
-    b_record.config(state=NORMAL)
-    b_stop.config(state=DISABLED)
-    b_upload.config(state=NORMAL)
-
-
-# tkinter button slider function
-def set_pm_status(value: str) -> None:
-    global pm_slider
-    global pm_status
-    global nova_pm
-    if value == '1':
-        pm_status = True
-        pm_slider['troughcolor'] = '#20ff20'
+        reference = args.reference_sensor
+        if reference not in averages.keys():
+            print(f'reference sensor {reference!r} is not in the logs')
+            return 1
+    logger.info(
+        f'read {averages.rows} rows, skipped {averages.skipped} rows in '
+        f'{time.perf_counter() - start:.1f}s',
+    )
+
+    models = {}
+    for quantity, breakpoints in (
+            ('temperature', args.temp_breakpoints),
+            ('humidity', args.hum_breakpoints),
+    ):
+        if args.model == 'poly':
+            models[quantity] = Model(name='poly', degree=args.degree)
+        elif args.model == 'piecewise':
+            models[quantity] = Model(
+                name='piecewise',
+                breakpoints=tuple(
+                    float(b) for b in breakpoints.split(',') if b
+                ),
+            )
+        else:
+            models[quantity] = Model()
+    results = fit_calibration(averages, args.output_dir, reference, models)
+
+    print(
+        f"{'sensor_nr':>10} {'n':>5} {'temp_a1':>9} {'temp_a0':>9} "
+        f"{'temp_rmse':>9} {'hum_a1':>9} {'hum_a0':>9} {'hum_rmse':>9}",
+    )
+    for calib in results:
+        print(
+            f"{calib['sensor_nr']:>10} {calib['temp_fit']['n']:>5} "
+            f"{calib['temp_cal_a1']!s:>9} {calib['temp_cal_a0']!s:>9} "
+            f"{calib['temp_fit']['rmse_after']!s:>9} "
+            f"{calib['hum_cal_a1']!s:>9} {calib['hum_cal_a0']!s:>9} "
+            f"{calib['hum_fit']['rmse_after']!s:>9}",
+        )
+    skipped = [calib['sensor_nr'] for calib in results if not usable(calib)]
+    if skipped:
+        msg = (
+            f'too few intervals to calibrate sensor {", ".join(skipped)}, '
+            f'no calibration file written'
+        )
+        logger.warning(msg)
+        print(msg)
+    calibrated = len(results) - len(skipped)
+    logger.info(f'calibrated {calibrated} sensors in {args.output_dir}')
+    print(
+        f'calibrated {calibrated} sensors in '
+        f'{time.perf_counter() - start:.1f}s, written to {args.output_dir}',
+    )
+    return 0
+
+
+def _start_metrics(
+        config: dict[str, Any],
+        logger: logging.Logger,
+) -> tuple[Optional[MetricsServer], Optional[Scheduler]]:
+    '''serve the metrics and write the status file, if configured'''
+    from crowdbike.metrics import metrics
+    from crowdbike.metrics import MetricsServer
+    from crowdbike.scheduler import Scheduler
+
+    server = None
+    port = config['user'].get('metrics_port')
+    if port is not None:
         try:
-            nova_pm.sensor_wake()
-            # reinitialize thread so it gets a new PID
-            nova_pm = PmSensor(dev='/dev/ttyUSB0', logger=logger)
-            nova_pm.running = True
-            nova_pm.start()
-        except Exception as e:
-            logger.warning(f'failed reading the PM sensor (main): {e}')
-            pass
+            server = MetricsServer(port, logger)
+        except OSError as e:
+            logger.warning(f'failed serving the metrics on port {port}: {e}')
+        else:
+            server.start()
+            logger.info(f'serving metrics on http://127.0.0.1:{port}/metrics')
+
+    status = None
+    status_file = config['user'].get('status_file')
+    if status_file is not None:
+        status_file = os.path.expanduser(status_file)
+
+        def _write_status(tick: Tick) -> None:
+            metrics.write_status(status_file)
+
+        status = Scheduler(
+            config['user'].get('status_interval', 10),
+            _write_status,
+            logger,
+            name='status',
+        )
+        status.start()
+        logger.info(f'writing the status to {status_file}')
+    return server, status
+
+
+def run(args: argparse.Namespace, logger: logging.Logger) -> int:
+    from crowdbike.helpers import get_wlan_macaddr
+    from crowdbike.led import leds
+    from crowdbike.profiling import profile_on_signal
+    from crowdbike.recorder import Recorder
+    from crowdbike.sensors import DHT22
+    from crowdbike.sensors import GPS
+    from crowdbike.sensors import PmSensor
+    from crowdbike.sensors import SHT85
+    from crowdbike.simulation import from_config
+
+    config = _load_config(logger)
+    version = _version()
+    with open(os.path.join(CONFIG_DIR, 'calibration.json')) as cal:
+        calib = json.load(cal)
+        logger.info(f'calibration loaded: {json.dumps(calib, indent=2)}')
+
+    simulation = from_config(config)
+    if simulation is not None:
+        logger.warning(f'using simulated sensors: {simulation}')
+        print(f'using simulated sensors: {simulation}')
+
+    # initialize threads, only the driver of the configured sensor is loaded
+    gps_rate = config['user'].get('gps_rate', 1)
+    gps = GPS(
+        logger,
+        rate=gps_rate,
+        baudrate=config['user'].get('gps_baudrate'),
+        uart=(
+            simulation.gps_uart(gps_rate, '/dev/ttyS0', 9600, 2)
+            if simulation is not None else None
+        ),
+    )
+    temp_hum_sensor: Union[DHT22, SHT85]
+    sensor_type = config['user']['sensor_type']
+    if sensor_type == 'SHT85':
+        temp_hum_sensor = SHT85(
+            logger,
+            device=simulation.sht3x() if simulation is not None else None,
+        )
+        logger.info('using SHT85 sensor')
+    elif sensor_type == 'DHT22':
+        temp_hum_sensor = DHT22(
+            logger,
+            device=simulation.dht22() if simulation is not None else None,
+        )
+        logger.info('using DHT22 sensor')
     else:
-        pm_status = False
-        pm_slider['troughcolor'] = '#c10000'
-        try:
-            nova_pm.running = False
-            nova_pm.join()
-            nova_pm.sensor_sleep()
-        except Exception as e:
-            logger.warning(f'failed setting the PM to sleep mode (main) {e}')
-            pass
+        raise NameError('sensor type unknown, must be either SHT85 or DHT22')
+
+    def pm_factory() -> PmSensor:
+        return PmSensor(
+            dev='/dev/ttyUSB0',
+            logger=logger,
+            ser=(
+                simulation.pm_serial(9600, 5)
+                if simulation is not None else None
+            ),
+        )
 
+    recorder = Recorder(
+        config,
+        calib,
+        logger,
+        gps=gps,
+        temp_hum=temp_hum_sensor,
+        pm_factory=pm_factory,
+        mac=get_wlan_macaddr(),
+        version=version,
+        stationary=args.stationary,
+    )
+    recorder.start()
+    server, status = _start_metrics(config, logger)
+    profile_on_signal(args.profile_dir, args.profile_seconds or 60, logger)
+    try:
+        if args.headless:
+            run_headless(recorder, logger)
+        else:
+            # tkinter is only imported when the GUI is used
+            from crowdbike.gui import CrowdbikeGUI
+
+            with open(os.path.join(CONFIG_DIR, 'theme.json')) as t:
+                theme = json.load(t)
+                logger.info(f'theme loaded: {json.dumps(theme, indent=2)}')
+
+            gui = CrowdbikeGUI(
+                recorder,
+                config,
+                theme,
+                logger,
+                window_title=(
+                    f"Crowdbike {config['user']['bike_nr']} - v{version}"
+                ),
+            )
+            gui.run()
+    finally:
+        if server is not None:
+            server.stop()
+        if status is not None:
+            status.stop()
+        recorder.close()
+        leds.close()
+    return 0
+
+
+def _command(args: argparse.Namespace, logger: logging.Logger) -> int:
+    if args.command == 'upload':
+        return upload(args, logger)
+    elif args.command == 'export':
+        return export(args, logger)
+    elif args.command == 'process':
+        return process(args, logger)
+    elif args.command == 'calibrate':
+        return calibrate(args, logger)
+    else:
+        return run(args, logger)
 
-def start_counting(label: Label) -> None:
-    def count() -> None:
-        global counter
-        computer_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
 
-        # get sensor readings from DHT-sensor
-        try:
-            humidity = temp_hum_sensor.humidity or float('nan')
-            temperature = temp_hum_sensor.temperature or float('nan')
-        except Exception as e:
-            logger.warning(f'reading the temp sensor failed (main): {e}')
-            humidity = float('nan')
-            temperature = float('nan')
-
-        # calculate temperature with sensor calibration values
-        temperature_raw = round(temperature, 5)
-        temperature_calib = round(
-            temperature * temperature_cal_a1 + temperature_cal_a0,
-            3,
-        )
-        humidity_raw = round(humidity, 5)
-        humidity_calib = round(
-            humidity * hum_cal_a1 + hum_cal_a0,
-            3,
-        )
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'init':
+        return init(args)
 
-        saturation_vappress = sat_vappressure(temperature_calib)
-        vappress = round(
-            vappressure(
-                humidity_calib,
-                saturation_vappress,
-            ), 5,
-        )
+    logger = create_logger(logdir=args.logfile, loglevel=args.loglevel)
+    logger.info('started crowdbike...')
+    logger.info(f'arguments passed: {args}')
 
-        # read pm-sensor
-        if pm_status is True:
-            pm2_5 = nova_pm.pm2_5
-            pm10 = nova_pm.pm10
-        else:
-            pm2_5 = float('nan')
-            pm10 = float('nan')
-
-        if humidity > 100:
-            humidity = 100
-
-        # Get GPS position
-        gps_time = gpsp.timestamp
-        gps_altitude = gpsp.alt
-        gps_latitude = gpsp.latitude
-        gps_longitude = gpsp.longitude
-        gps_speed = round(gpsp.speed * 1.852, 2)
-        f_mode = gpsp.satellites  # store number of satellites
-        has_fix = False  # assume no fix
-
-        if f_mode == 2:
-            value_counter.config(bg='orange')
-        elif f_mode > 2:
-            has_fix = True
-            value_counter.config(bg='#20ff20')
-        else:
-            value_counter.config(bg='red')
-
-        # __format value display in gui__
-        value_ctime.config(text=computer_time)
-        value_altitude.config(text=f'{gps_altitude:.3f} m ASL')
-        value_latitude.config(text=f'{gps_latitude:.6f} °N')
-        value_longitude.config(text=f'{gps_longitude:.6f} °E')
-        value_speed.config(text=f'{gps_speed:.1f} km/h')
-        value_time.config(text=gps_time)
-        value_temperature.config(
-            text='{:.1f} °C'.format(
-                temperature_calib,
-            ),
-        )
-        value_humidity.config(text=f'{humidity_calib:.1f} %')
-        value_vappress.config(text=f'{vappress:.3f} kPa')
-
-        value_pm10.config(text=f'{pm10:.1f} \u03BCg/m\u00B3')
-        value_pm2_5.config(text=f'{pm2_5:.1f} \u03BCg/m\u00B3')
-
-        label.config(text=str(counter))
-        label.after(1000 * sampling_rate, count)
-
-        if recording and (has_fix or args.stationary):
-            with open(logfile, 'a+') as f0:
-                f0.seek(0)
-                counter = len(f0.readlines()) - 1
-                f0.write(f'{pi_id},')
-                f0.write(f'{counter},')
-                f0.write(f'{computer_time},')
-
-                f0.write(f'{gps_time},')
-                f0.write(f'{gps_altitude:.3f}' + ',')
-                f0.write(f'{gps_latitude:.6f}' + ',')
-                f0.write(f'{gps_longitude:.6f}' + ',')
-                f0.write(f'{gps_speed:.1f}' + ',')
-
-                f0.write(f'{temperature_calib},')
-                f0.write(f'{temperature_raw},')
-
-                f0.write(f'{humidity_calib},')
-                f0.write(f'{humidity_raw},')
-
-                f0.write(f'{vappress},')
-
-                f0.write(f'{pm10},')
-                f0.write(f'{pm2_5},')
-
-                f0.write(f'{mac},')
-                f0.write(f"{config['user']['sensor_id']},")
-                f0.write(f'{version}\n')
-
-    count()
-
-
-# define widgets
-master = Tk()
-master.protocol('WM_DELETE_WINDOW', exit_program)
-master.configure(background=theme['bg_col'])
-default_font = font.nametofont('TkDefaultFont')
-default_font.configure(size=theme['font_size'], family=theme['f_family'])
-master.title(window_title)
-Label(
-    master, text=' Name', fg=theme['fg_header'],
-    bg=theme['bg_col'],
-).grid(row=0, column=0, sticky=W)
-Label(
-    master, text=studentname + "'s Crowdbike", fg=theme['fg_header'],
-    bg=theme['bg_col'],
-).grid(row=0, column=1, sticky=W, columnspan=2)
-Label(
-    master, text=f'IP: {get_ip()}', fg=theme['fg_header'], bg=theme['bg_col'],
-).grid(row=1, column=1, sticky=E, columnspan=2)
-Label(
-    master, text=' PM-Sensor', fg=theme['fg_header'],
-    bg=theme['bg_col'],
-).grid(row=1, column=0, sticky=W, columnspan=2)
-Separator(master, orient=HORIZONTAL).grid(
-    row=2, columnspan=3, sticky='ew', pady=(10, 10),
-)
-# define labels
-label_speed = Label(
-    master, text=' Speed',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_speed.grid(row=3, column=0, sticky=W)
-
-label_counter = Label(
-    master, text=' Counter',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_counter.grid(row=4, column=0, sticky=W)
-
-label_ctime = Label(
-    master, text=' Time',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_ctime.grid(row=5, column=0, sticky=W)
-
-label_altitude = Label(
-    master, text=' Altitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_altitude.grid(row=6, column=0, sticky=W)
-
-label_latitude = Label(
-    master, text=' Latitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_latitude.grid(row=7, column=0, sticky=W)
-
-label_longitude = Label(
-    master, text=' Longitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_longitude.grid(row=8, column=0, sticky=W)
-
-label_time = Label(
-    master, text=' GPS Time',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_time.grid(row=9, column=0, sticky=W)
-
-label_temperature = Label(
-    master, text=' Temperature',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_temperature.grid(row=10, column=0, sticky=W)
-
-label_humidity = Label(
-    master, text=' Rel. Humidity',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_humidity.grid(row=11, column=0, sticky=W)
-
-label_vappress = Label(
-    master, text=' Vap. Pressure   ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_vappress.grid(row=12, column=0, sticky=W)
-
-# labels for pm sensor
-label_pm10 = Label(
-    master, text=' PM 10 ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_pm10.grid(row=13, column=0, sticky=W)
-
-label_pm2_5 = Label(
-    master, text=' PM 2.5 ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-label_pm2_5.grid(row=14, column=0, sticky=W)
-
-# define values (constructed also as labels, text will be modified in count)
-value_speed = Label(
-    master, text=' Speed',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_speed.grid(row=3, column=1, sticky=W, columnspan=2)
-
-value_counter = Label(master, text=' Counter', bg='red', fg=theme['fg_col'])
-value_counter.grid(row=4, column=1, sticky=W, columnspan=2)
-
-value_ctime = Label(
-    master, text=' Time',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_ctime.grid(row=5, column=1, sticky=W, columnspan=2)
-
-value_altitude = Label(
-    master, text=' Altitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_altitude.grid(row=6, column=1, sticky=W, columnspan=2)
-
-value_latitude = Label(
-    master, text=' Latitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_latitude.grid(row=7, column=1, sticky=W, columnspan=2)
-
-value_longitude = Label(
-    master, text=' Longitude',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_longitude.grid(row=8, column=1, sticky=W, columnspan=2)
-
-value_time = Label(
-    master, text='GPS Time ---------------',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_time.grid(row=9, column=1, sticky=W, columnspan=2)
-
-value_temperature = Label(
-    master, text=' Temperature',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_temperature.grid(row=10, column=1, sticky=W, columnspan=2)
-
-value_humidity = Label(
-    master, text=' Rel. Humidity',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_humidity.grid(row=11, column=1, sticky=W, columnspan=2)
-
-value_vappress = Label(
-    master, text=' Vap. Pressure ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_vappress.grid(row=12, column=1, sticky=W, columnspan=2)
-
-value_pm10 = Label(
-    master, text=' PM 10 ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_pm10.grid(row=13, column=1, sticky=W, columnspan=2)
-value_pm2_5 = Label(
-    master, text=' PM 2.5 ',
-    bg=theme['bg_col'], fg=theme['fg_col'],
-)
-value_pm2_5.grid(row=14, column=1, sticky=W, columnspan=2)
-
-# initialize value_counter
-start_counting(value_counter)
-Separator(master, orient=HORIZONTAL).grid(
-    row=15, columnspan=3, sticky='ew', pady=(10, 0),
-)
-Label(
-    master, text='',
-    bg=theme['bg_col'], font=(theme['f_family'], 10),
-).grid(row=16, pady=(10, 0))
-Label(
-    master, text='',
-    bg=theme['bg_col'], font=(theme['f_family'], 14),
-).grid(row=17, pady=(0, 10))
-
-# define buttons
-b_record = Button(
-    master,
-    text='Record',
-    width=7,
-    state=DISABLED,
-    bg=theme['b_col'],
-    fg=theme['fg_col'],
-    font=(theme['f_family'], 12, 'bold'),
-    disabledforeground=theme['b_disabled'],
-    command=record_data,
-    activeforeground=theme['fg_col'],
-    activebackground=theme['b_hover'],
-    highlightcolor=theme['b_hl_border'],
-    highlightbackground=theme['b_hl_border'],
-    highlightthickness=1,
-
-)
-b_record.grid(row=18, column=0, sticky=W, padx=(20, 0), pady=(0, 20))
-
-b_stop = Button(
-    master,
-    text='Stop',
-    width=7,
-    bg=theme['b_col'],
-    fg=theme['fg_col'],
-    font=(theme['f_family'], 12, 'bold'),
-    state=DISABLED, command=stop_data,
-    disabledforeground=theme['b_disabled'],
-    activeforeground=theme['fg_col'],
-    activebackground=theme['b_hover'],
-    highlightcolor=theme['b_hl_border'],
-    highlightbackground=theme['b_hl_border'],
-    highlightthickness=1,
-)
-b_stop.grid(row=18, column=1, sticky=W, padx=(20, 40), pady=(0, 20))
-
-b_exit = Button(
-    master,
-    text='Exit',
-    width=7,
-    bg=theme['b_col'],
-    fg=theme['fg_col'],
-    font=(theme['f_family'], 12, 'bold'),
-    state=NORMAL, command=exit_program,
-    activeforeground=theme['fg_col'],
-    activebackground=theme['b_hover'],
-    highlightcolor=theme['b_hl_border'],
-    highlightbackground=theme['b_hl_border'],
-    highlightthickness=1,
-)
-b_exit.grid(row=18, column=2, sticky=W, pady=(0, 20))
-
-b_upload = Button(
-    master,
-    text='upload',
-    width=7,
-    state=DISABLED,
-    command=lambda: upload_to_cloud(
-        verbose=False, config=config, logger=logger, root=master, theme=theme,
-    ),
-    fg=theme['fg_col'],
-    bg=theme['b_col'],
-    font=(theme['f_family'], 12, 'bold'),
-    disabledforeground=theme['b_disabled'],
-    activeforeground=theme['fg_col'],
-    activebackground=theme['b_hover'],
-    highlightcolor=theme['b_hl_border'],
-    highlightbackground=theme['b_hl_border'],
-    highlightthickness=1,
-)
-b_upload.grid(row=18, column=0, sticky=E, padx=(0, 20), pady=(0, 20))
-
-# slider
-pm_slider = Scale(
-    orient=HORIZONTAL, length=80, to=1, label='',
-    showvalue=False, sliderlength=40, troughcolor='#666666',
-    width=30, command=set_pm_status,
-    fg=theme['fg_col'],
-    bg=theme['b_col'],
-    activebackground=theme['b_hover'],
-    highlightcolor=theme['b_hl_border'],
-    highlightbackground=theme['b_hl_border'],
-    highlightthickness=1,
-)
-if pm_status:
-    pm_slider['troughcolor'] = '#20ff20'
-else:
-    pm_slider['troughcolor'] = '#c10000'
-
-pm_slider.set(int(pm_status))
-pm_slider.grid(row=1, column=1, sticky=W)
-
-recording = True
-record_data()
-mainloop()
+    if not args.profile:
+        return _command(args, logger)
+
+    from crowdbike.profiling import Profiler
+
+    # cProfile cannot be stopped in the other threads, so only the sampling
+    # profiler is used for a limited time
+    profiler = Profiler(
+        args.profile_dir,
+        logger,
+        deterministic=args.profile_seconds is None,
+    )
+    profiler.start(args.profile_seconds)
+    try:
+        return _command(args, logger)
+    finally:
+        path = profiler.stop()
+        print(f'profile written to {path}')
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
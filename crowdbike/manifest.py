@@ -0,0 +1,134 @@
+'''Persistent index of the logfiles and their upload state.'''
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Iterator
+from typing import Any
+
+FILENAME = '.upload_manifest.json'
+
+# the logfile was closed and its size and hash are known
+RECORDED = 'recorded'
+# some chunks of the logfile were uploaded
+PARTIAL = 'partial'
+# the logfile was uploaded, but not moved to the archive yet
+UPLOADED = 'uploaded'
+
+
+def file_info(path: str) -> tuple[int, int]:
+    '''get the size and modification time (ns) to detect changed files'''
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def sha256_file(path: str, size: int | None = None) -> hashlib._Hash:
+    '''hash the first ``size`` bytes of a file, to continue hashing it'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = os.path.getsize(path) if size is None else size
+        while remaining > 0:
+            chunk = f.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h
+
+
+class UploadManifest:
+    '''Keep track of the logfiles in a directory and their upload state.
+
+    Entries are keyed by the file name and hold the ``size``, ``mtime_ns``,
+    ``sha256`` and ``state`` of a logfile, partial uploads additionally the
+    ``upload_id`` and the number of confirmed ``chunks``.
+
+    The manifest is stored as JSON next to the logfiles and replaced
+    atomically. Every change re-reads it while holding an exclusive
+    ``flock`` on ``<manifest>.lock``, so several writers (e.g. the logging
+    and the upload, in one or more processes) do not overwrite each other's
+    entries.
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        '''exclusive access to the manifest across threads and processes'''
+        # every call opens the file, flock does not exclude the same open file
+        with open(f'{self.path}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @classmethod
+    def for_dir(cls, log_dir: str) -> UploadManifest:
+        return cls(os.path.join(log_dir, FILENAME))
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                entries: dict[str, dict[str, Any]] = json.load(f)
+                return entries
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # a corrupt manifest only means files are uploaded from scratch
+            return {}
+
+    def _save(self, entries: dict[str, dict[str, Any]]) -> None:
+        fd, tmp = tempfile.mkstemp(
+            prefix=f'{os.path.basename(self.path)}.',
+            suffix='.tmp',
+            dir=os.path.dirname(self.path),
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, name: str) -> dict[str, Any] | None:
+        # the manifest is replaced atomically, so reading needs no lock
+        return self._load().get(name)
+
+    def update(self, name: str, **fields: Any) -> None:
+        with self._locked():
+            entries = self._load()
+            entries.setdefault(name, {}).update(fields)
+            self._save(entries)
+
+    def reset(self, name: str, **fields: Any) -> None:
+        '''replace the entry of a file'''
+        with self._locked():
+            entries = self._load()
+            entries[name] = fields
+            self._save(entries)
+
+    def record(self, path: str, sha256: str) -> None:
+        '''add a closed logfile, replacing the entry of a previous upload'''
+        size, mtime_ns = file_info(path)
+        self.reset(
+            os.path.basename(path),
+            state=RECORDED,
+            size=size,
+            mtime_ns=mtime_ns,
+            sha256=sha256,
+        )
+
+    def remove(self, name: str) -> None:
+        with self._locked():
+            entries = self._load()
+            if entries.pop(name, None) is not None:
+                self._save(entries)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(path={self.path!r})'
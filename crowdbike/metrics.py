@@ -0,0 +1,355 @@
+'''Runtime metrics of the sensors, the sampling, the writer and the upload.
+
+The metrics are updated by the threads doing the work, which only costs a
+lock and a few additions per reading or tick. They are formatted on demand:
+:class:`MetricsServer` serves them in the Prometheus text format on
+localhost and :meth:`Metrics.write_status` writes them to a json file.
+'''
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from collections.abc import Sequence
+from typing import Any
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+)
+PREFIX = 'crowdbike'
+
+
+class Histogram:
+    '''Count observations in buckets, like a Prometheus histogram.'''
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # the last one counts the observations larger than all buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        '''the ``le`` label and the number of observations up to it'''
+        result = []
+        total = 0
+        for bound, count in zip((*self.buckets, math.inf), self.counts):
+            total += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            result.append((le, total))
+        return result
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'buckets': dict(self.cumulative()),
+        }
+
+
+class SensorStats:
+    def __init__(self) -> None:
+        self.latency = Histogram()
+        self.ok = 0
+        self.errors = 0
+        # time.monotonic() of the last good reading
+        self.last_ok: float | None = None
+        self.last_error: str | None = None
+
+
+class SchedulerStats:
+    def __init__(self) -> None:
+        # seconds between the deadline and the call of a tick
+        self.jitter = Histogram()
+        self.missed = 0
+
+
+class Metrics:
+    '''The metrics of one crowdbike process, see :data:`metrics`.
+
+    Values that already exist elsewhere, e.g. the depth of the writer queue,
+    are registered with :meth:`gauge` and only read when the metrics are
+    formatted.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.sensors: dict[str, SensorStats] = {}
+        self.schedulers: dict[str, SchedulerStats] = {}
+        self.upload_files = {True: 0, False: 0}
+        self.upload_bytes = 0
+        self.upload_seconds = 0.0
+        self._gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def sensor_read(
+            self,
+            sensor: str,
+            seconds: float,
+            error: Exception | None = None,
+    ) -> None:
+        '''record a reading of a sensor that took ``seconds``'''
+        with self._lock:
+            stats = self.sensors.get(sensor)
+            if stats is None:
+                stats = self.sensors[sensor] = SensorStats()
+            stats.latency.observe(seconds)
+            if error is None:
+                stats.ok += 1
+                stats.last_ok = time.monotonic()
+            else:
+                stats.errors += 1
+                stats.last_error = f'{type(error).__name__}: {error}'
+
+    def tick(self, scheduler: str, late: float, missed: int) -> None:
+        '''record a tick that was called ``late`` seconds after its
+        deadline, after ``missed`` ticks were skipped'''
+        with self._lock:
+            stats = self.schedulers.get(scheduler)
+            if stats is None:
+                stats = self.schedulers[scheduler] = SchedulerStats()
+            stats.jitter.observe(late)
+            stats.missed += missed
+
+    def upload(self, nbytes: int, seconds: float, ok: bool) -> None:
+        '''record a file that was uploaded in ``seconds``'''
+        with self._lock:
+            self.upload_files[ok] += 1
+            self.upload_bytes += nbytes
+            self.upload_seconds += seconds
+
+    def gauge(
+            self,
+            name: str,
+            help: str,
+            func: Callable[[], float],
+    ) -> None:
+        '''report the value returned by ``func`` as ``name``'''
+        with self._lock:
+            self._gauges[name] = (help, func)
+
+    def _gauge_values(self) -> dict[str, tuple[str, float]]:
+        values = {}
+        for name, (help, func) in self._gauges.items():
+            try:
+                values[name] = (help, float(func()))
+            except Exception:
+                values[name] = (help, math.nan)
+        return values
+
+    def status(self) -> dict[str, Any]:
+        '''all metrics as a json serializable dict'''
+        now = time.monotonic()
+        with self._lock:
+            sensors = {
+                name: {
+                    'reads_ok': s.ok,
+                    'reads_failed': s.errors,
+                    'error_rate': (
+                        s.errors / (s.ok + s.errors) if s.ok + s.errors
+                        else None
+                    ),
+                    'seconds_since_ok': (
+                        None if s.last_ok is None else now - s.last_ok
+                    ),
+                    'last_error': s.last_error,
+                    'read_seconds': s.latency.as_dict(),
+                }
+                for name, s in self.sensors.items()
+            }
+            schedulers = {
+                name: {'missed': s.missed, 'late_seconds': s.jitter.as_dict()}
+                for name, s in self.schedulers.items()
+            }
+            upload = {
+                'files_ok': self.upload_files[True],
+                'files_failed': self.upload_files[False],
+                'bytes': self.upload_bytes,
+                'seconds': self.upload_seconds,
+                'bytes_per_second': (
+                    self.upload_bytes / self.upload_seconds
+                    if self.upload_seconds else None
+                ),
+            }
+            gauges = self._gauge_values()
+        return {
+            'time': time.time(),
+            'uptime': now - self.started,
+            'sensors': sensors,
+            'schedulers': schedulers,
+            'upload': upload,
+            **{
+                name: None if math.isnan(value) else value
+                for name, (_, value) in gauges.items()
+            },
+        }
+
+    def prometheus(self) -> str:
+        '''all metrics in the Prometheus text format'''
+        lines: list[str] = []
+
+        def _metric(name: str, kind: str, help: str) -> str:
+            name = f'{PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            return name
+
+        def _histogram(name: str, label: str, h: Histogram) -> None:
+            for le, count in h.cumulative():
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{{label}}} {h.sum!r}')
+            lines.append(f'{name}_count{{{label}}} {h.count}')
+
+        now = time.monotonic()
+        with self._lock:
+            name = _metric(
+                'uptime_seconds', 'gauge', 'seconds since the start',
+            )
+            lines.append(f'{name} {now - self.started!r}')
+
+            name = _metric(
+                'sensor_read_seconds', 'histogram',
+                'time a reading of the sensor took',
+            )
+            for sensor, s in self.sensors.items():
+                _histogram(name, f'sensor="{sensor}"', s.latency)
+            name = _metric(
+                'sensor_reads_total', 'counter', 'readings of the sensor',
+            )
+            for sensor, s in self.sensors.items():
+                lines.append(f'{name}{{sensor="{sensor}",result="ok"}} {s.ok}')
+                lines.append(
+                    f'{name}{{sensor="{sensor}",result="error"}} {s.errors}',
+                )
+            name = _metric(
+                'sensor_seconds_since_ok', 'gauge',
+                'seconds since the last good reading of the sensor',
+            )
+            for sensor, s in self.sensors.items():
+                if s.last_ok is not None:
+                    lines.append(
+                        f'{name}{{sensor="{sensor}"}} {now - s.last_ok!r}',
+                    )
+
+            name = _metric(
+                'scheduler_late_seconds', 'histogram',
+                'time between the deadline of a tick and its call',
+            )
+            for scheduler, t in self.schedulers.items():
+                _histogram(name, f'scheduler="{scheduler}"', t.jitter)
+            name = _metric(
+                'scheduler_missed_ticks_total', 'counter',
+                'ticks that were skipped because the previous one was late',
+            )
+            for scheduler, t in self.schedulers.items():
+                lines.append(f'{name}{{scheduler="{scheduler}"}} {t.missed}')
+
+            name = _metric(
+                'upload_files_total', 'counter', 'files that were uploaded',
+            )
+            for ok, result in ((True, 'ok'), (False, 'error')):
+                lines.append(
+                    f'{name}{{result="{result}"}} {self.upload_files[ok]}',
+                )
+            name = _metric(
+                'upload_bytes_total', 'counter', 'bytes that were uploaded',
+            )
+            lines.append(f'{name} {self.upload_bytes}')
+            name = _metric(
+                'upload_seconds_total', 'counter', 'time spent uploading',
+            )
+            lines.append(f'{name} {self.upload_seconds!r}')
+
+            for gauge, (help, value) in self._gauge_values().items():
+                name = _metric(gauge, 'gauge', help)
+                lines.append(f'{name} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write_status(self, path: str) -> None:
+        '''replace the json file at ``path`` with the current status'''
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.status(), f, indent=2)
+            f.write('\n')
+        os.replace(tmp, path)
+
+
+class MetricsServer:
+    '''Serve ``/metrics`` (Prometheus) and ``/status`` (json) from a
+    background thread, only on localhost by default.
+
+    ``http.server`` is only imported when the server is created.
+    '''
+
+    def __init__(
+            self,
+            port: int,
+            logger: logging.Logger,
+            registry: Metrics | None = None,
+            host: str = '127.0.0.1',
+    ) -> None:
+        from http.server import BaseHTTPRequestHandler
+        from http.server import ThreadingHTTPServer
+
+        self.logger = logger
+        self.metrics = metrics if registry is None else registry
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path == '/metrics':
+                    body = server.metrics.prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/status':
+                    body = json.dumps(server.metrics.status()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                server.logger.debug(f'metrics: {format % args}')
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name='metrics', daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+        self.httpd.server_close()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(port={self.port!r})'
+
+
+# the metrics of this process, shared by all threads
+metrics = Metrics()
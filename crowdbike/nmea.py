@@ -0,0 +1,189 @@
+'''Parse the NMEA sentences of the GPS and build PMTK commands.
+
+Only the two sentences needed for a fix are parsed, all others are
+skipped without decoding them:
+
+- ``RMC``: time, date, position, speed and whether there is a fix
+- ``GGA``: altitude and number of satellites
+
+The MTK receivers send the ``GGA`` sentence of an epoch before its ``RMC``
+sentence, so a :class:`Fix` is completed by the ``RMC`` sentence.
+'''
+from __future__ import annotations
+
+import functools
+import operator
+from datetime import datetime
+from typing import NamedTuple
+from typing import Optional
+
+# a line that is longer than this without a line break is discarded
+MAX_LINE = 256
+_NAN = float('nan')
+
+
+class Fix(NamedTuple):
+    # time.monotonic() when the sentence completing the fix was received
+    received: float
+    # UTC time of the fix according to the GPS
+    time: Optional[datetime]
+    has_fix: bool
+    latitude: float
+    longitude: float
+    altitude: float
+    # speed in knots
+    speed: float
+    satellites: float
+
+
+def checksum(body: bytes) -> int:
+    '''XOR of all bytes between ``$`` and ``*``'''
+    return functools.reduce(operator.xor, body, 0)
+
+
+def command(body: str) -> bytes:
+    '''build a sentence e.g. ``$PMTK220,200*2C`` from ``PMTK220,200``'''
+    data = body.encode('ascii')
+    return b'$%s*%02X\r\n' % (data, checksum(data))
+
+
+def set_baudrate(baudrate: int) -> bytes:
+    return command(f'PMTK251,{baudrate}')
+
+
+def set_fix_rate(rate: float) -> bytes:
+    '''set the number of fixes per second, up to 10 Hz'''
+    return command(f'PMTK220,{round(1000 / rate)}')
+
+
+# only output the RMC and GGA sentences
+ONLY_RMC_GGA = command('PMTK314,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0')
+
+
+def _float(value: str) -> float:
+    return float(value) if value else _NAN
+
+
+def _coordinate(value: str, hemisphere: str) -> float:
+    '''convert ``dddmm.mmmm`` to decimal degrees'''
+    if not value:
+        return _NAN
+    degrees, minutes = divmod(float(value), 100)
+    coordinate = degrees + minutes / 60
+    return -coordinate if hemisphere in ('S', 'W') else coordinate
+
+
+def _time(hhmmss: str, ddmmyy: str) -> Optional[datetime]:
+    if len(hhmmss) < 6 or len(ddmmyy) != 6:
+        return None
+    seconds = float(hhmmss[4:])
+    return datetime(
+        year=2000 + int(ddmmyy[4:6]),
+        month=int(ddmmyy[2:4]),
+        day=int(ddmmyy[0:2]),
+        hour=int(hhmmss[0:2]),
+        minute=int(hhmmss[2:4]),
+        second=int(seconds),
+        microsecond=round(seconds % 1 * 1_000_000),
+    )
+
+
+class NmeaParser:
+    '''Parse the fixes from a stream of NMEA sentences.
+
+    The bytes can be fed in chunks of any size as they are read from the
+    UART, e.g. everything that is waiting. Incomplete lines are kept until
+    the rest arrives, lines with an invalid checksum are counted and
+    skipped.
+    '''
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        # RMC and GGA sentences that were parsed
+        self.sentences = 0
+        self.checksum_errors = 0
+        # other sentences and incomplete lines
+        self.ignored = 0
+        self._altitude = _NAN
+        self._satellites = _NAN
+
+    def feed(self, data: bytes, received: float) -> list[Fix]:
+        '''add bytes to the stream and return the fixes they completed
+
+        :param received: the ``time.monotonic()`` the data was read at
+        '''
+        buf = self._buf
+        buf += data
+        end = buf.rfind(b'\n')
+        if end < 0:
+            if len(buf) > MAX_LINE:
+                self.ignored += 1
+                buf.clear()
+            return []
+
+        lines = bytes(buf[:end]).split(b'\n')
+        del buf[:end + 1]
+        fixes = []
+        for line in lines:
+            # e.g. $GPRMC or $GNRMC
+            kind = line[3:6]
+            if line[:1] != b'$' or (kind != b'RMC' and kind != b'GGA'):
+                self.ignored += 1
+                continue
+
+            star = line.rfind(b'*')
+            if (
+                    star < 0 or
+                    line[star + 1:star + 3].upper() !=
+                    b'%02X' % checksum(line[1:star])
+            ):
+                self.checksum_errors += 1
+                continue
+
+            fields = line[7:star].decode('ascii').split(',')
+            self.sentences += 1
+            try:
+                if kind == b'GGA':
+                    self._altitude = _float(fields[8])
+                    self._satellites = _float(fields[6])
+                else:
+                    fixes.append(
+                        Fix(
+                            received=received,
+                            time=_time(fields[0], fields[8]),
+                            has_fix=fields[1] == 'A',
+                            latitude=_coordinate(fields[2], fields[3]),
+                            longitude=_coordinate(fields[4], fields[5]),
+                            altitude=self._altitude,
+                            speed=_float(fields[6]),
+                            satellites=self._satellites,
+                        ),
+                    )
+            except (IndexError, ValueError):
+                self.sentences -= 1
+                self.ignored += 1
+
+        # fixes that arrived in the same chunk were received earlier than
+        # the last one, estimate when using the time of the fixes
+        last = fixes[-1].time if fixes else None
+        if last is not None:
+            fixes = [
+                fix._replace(
+                    received=received - (last - fix.time).total_seconds(),
+                ) if fix.time is not None else fix
+                for fix in fixes
+            ]
+        return fixes
+
+    def reset(self) -> None:
+        '''drop an incomplete line e.g. after the baudrate was changed'''
+        self._buf.clear()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'sentences={self.sentences!r}, '
+            f'checksum_errors={self.checksum_errors!r}, '
+            f'ignored={self.ignored!r}'
+            ')'
+        )
@@ -0,0 +1,243 @@
+'''Reprocess logfiles, e.g. with a corrected calibration.
+
+The logfiles are read in chunks of rows. The calibration is applied to the
+raw temperature and humidity and the derived quantities are calculated for
+the whole chunk at once using numpy. The other columns are copied as they
+are.
+'''
+from __future__ import annotations
+
+import logging
+import os
+import time
+from collections.abc import Iterator
+from collections.abc import Sequence
+from typing import Any
+from typing import NamedTuple
+from typing import TypeVar
+
+import numpy as np
+import numpy.typing as npt
+
+from crowdbike.binlog import iter_rows
+from crowdbike.binlog import MAGIC
+
+# the columns that are calculated and their number of decimals
+CALCULATED = (
+    ('temperature', 3),
+    ('rel_humidity', 3),
+    ('vapour_pressure', 5),
+    ('dew_point', 3),
+    ('abs_humidity', 3),
+)
+# the columns that are added to the logfiles
+ADDED = ('dew_point', 'abs_humidity')
+
+# specific gas constant of water vapour in J/(kg K) and latent heat of
+# vaporization in J/kg, as used by :func:`crowdbike.helpers.sat_vappressure`
+R_V = 461.5
+L_V = 2501000.0
+T_0 = 273.15
+# saturation vapour pressure in kPa at T_0
+E_0 = 0.6113
+
+A = TypeVar('A', float, npt.NDArray[np.float64])
+
+
+def sat_vappressure(temp: A) -> A:
+    '''saturation vapour pressure in kPa of the temperature in °C'''
+    return E_0 * np.exp((L_V / R_V) * ((1 / T_0) - (1 / (temp + T_0))))
+
+
+def vappressure(humidity: A, saturation_vappress: A) -> A:
+    '''vapour pressure in kPa of the relative humidity in %'''
+    return (humidity / 100) * saturation_vappress
+
+
+def dew_point(vappress: A) -> A:
+    '''dew point in °C of the vapour pressure in kPa, the inverse of
+    :func:`sat_vappressure`'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 / (1 / T_0 - (R_V / L_V) * np.log(vappress / E_0)) - T_0
+
+
+def abs_humidity(vappress: A, temp: A) -> A:
+    '''absolute humidity in g/m³ of the vapour pressure in kPa and the
+    temperature in °C'''
+    return vappress * 1e6 / (R_V * (temp + T_0))
+
+
+def _round(
+        values: npt.NDArray[np.float64],
+        decimals: int,
+) -> npt.NDArray[np.float64]:
+    '''round as ``round()`` does during the recording
+
+    ``np.round`` scales the values before rounding, so the result can be off
+    by one in the last digit if a value is close to a tie. Those few values
+    are rounded again one by one.
+    '''
+    rounded = np.round(values, decimals)
+    scaled = values * 10.0 ** decimals
+    near_tie = np.abs(scaled - np.floor(scaled) - .5) < 1e-6
+    for i in np.flatnonzero(near_tie):
+        rounded[i] = round(float(values[i]), decimals)
+    return rounded
+
+
+class Calibration(NamedTuple):
+    temp_cal_a1: float
+    temp_cal_a0: float
+    hum_cal_a1: float
+    hum_cal_a0: float
+
+    @classmethod
+    def from_dict(cls, calib: dict[str, Any]) -> Calibration:
+        return cls(*(calib[f] for f in cls._fields))
+
+
+def calculate(
+        temperature_raw: npt.NDArray[np.float64],
+        humidity_raw: npt.NDArray[np.float64],
+        calib: Calibration,
+) -> dict[str, npt.NDArray[np.float64]]:
+    '''the calibrated and derived values, rounded as in the logfiles'''
+    temperature = _round(
+        temperature_raw * calib.temp_cal_a1 + calib.temp_cal_a0, 3,
+    )
+    humidity = _round(
+        humidity_raw * calib.hum_cal_a1 + calib.hum_cal_a0, 3,
+    )
+    vappress = vappressure(humidity, sat_vappressure(temperature))
+    values = {
+        'temperature': temperature,
+        'rel_humidity': humidity,
+        'vapour_pressure': vappress,
+        'dew_point': dew_point(vappress),
+        'abs_humidity': abs_humidity(vappress, temperature),
+    }
+    return {
+        name: _round(values[name], decimals)
+        for name, decimals in CALCULATED
+    }
+
+
+class Result(NamedTuple):
+    path: str
+    out_path: str
+    rows: int
+    # rows with a wrong number of fields, e.g. cut off by a power loss
+    skipped: int
+    seconds: float
+
+
+def _lines(path: str) -> Iterator[str]:
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        yield from iter_rows(path)
+    else:
+        with open(path) as f:
+            yield from f
+
+
+def _chunks(lines: Iterator[str], size: int) -> Iterator[list[str]]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def process_file(
+        path: str,
+        out_path: str,
+        calib: Calibration,
+        chunk_size: int = 10_000,
+) -> Result:
+    '''write the logfile (csv or binary) with the calibration applied and
+    the derived quantities added as csv'''
+    start = time.perf_counter()
+    lines = _lines(path)
+    first = next(lines, None)
+    if first is None:
+        # e.g. a ride that was aborted before the logfile was written to
+        logging.getLogger('crowdbike').warning(f'{path} is empty, skipped')
+        return Result(
+            path=path,
+            out_path=out_path,
+            rows=0,
+            skipped=0,
+            seconds=time.perf_counter() - start,
+        )
+    header = first.rstrip('\n').split(',')
+    columns = header + [c for c in ADDED if c not in header]
+    index = {name: i for i, name in enumerate(columns)}
+    rows = skipped = 0
+    with open(out_path, 'w') as f:
+        f.write(f"{','.join(columns)}\n")
+        for chunk in _chunks(lines, chunk_size):
+            split = [line.rstrip('\n').split(',') for line in chunk]
+            fields = [r for r in split if len(r) == len(header)]
+            skipped += len(split) - len(fields)
+            if not fields:
+                continue
+            # one sequence per column, the added ones are filled below
+            cols: list[Sequence[str]] = list(zip(*fields))
+            cols += [()] * (len(columns) - len(header))
+            values = calculate(
+                np.array(cols[index['temperature_raw']], dtype=np.float64),
+                np.array(cols[index['rel_humidity_raw']], dtype=np.float64),
+                calib,
+            )
+            for name, column in values.items():
+                # formatted as by the LogWriter
+                cols[index[name]] = list(map(str, column.tolist()))
+            f.write(''.join(f"{','.join(row)}\n" for row in zip(*cols)))
+            rows += len(fields)
+    return Result(
+        path=path,
+        out_path=out_path,
+        rows=rows,
+        skipped=skipped,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def output_path(path: str, out_dir: str | None) -> str:
+    '''``ride.cbin`` -> ``<out_dir>/ride_processed.csv``'''
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(
+        out_dir or os.path.dirname(path),
+        f'{name}_processed.csv',
+    )
+
+
+def process_files(
+        paths: Sequence[str],
+        out_dir: str | None,
+        calib: Calibration,
+        jobs: int = 1,
+        chunk_size: int = 10_000,
+) -> Iterator[Result]:
+    '''process the files using ``jobs`` processes, the results are returned
+    as the files are done'''
+    args = [
+        (path, output_path(path, out_dir), calib, chunk_size)
+        for path in paths
+    ]
+    if jobs == 1:
+        for a in args:
+            yield process_file(*a)
+        return
+
+    from concurrent.futures import as_completed
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(process_file, *a) for a in args]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,299 @@
+'''Profile the main thread and the sensor threads.
+
+:class:`Profiler` combines two profilers:
+
+- a sampling profiler, which records the stacks of all threads every
+  ``interval`` seconds. It measures wall-clock time, so the time spent
+  waiting for a sensor or the SD card shows up as well. It can be started
+  at any time, e.g. on a signal while crowdbike is running.
+- :mod:`cProfile` for the thread starting the profiler and every thread
+  started after it (``deterministic=True``). This counts every call, but
+  only sees threads that are started later. On Python 3.12+ only one of
+  these can be active at a time, so only the first thread is profiled.
+  A profile can only be disabled by its own thread, so the profile of a
+  thread is only written if the thread ended before :meth:`Profiler.stop`.
+
+When the profiler stops, the results are written to a new directory:
+
+- ``<thread>.prof``: the cProfile stats of a thread, e.g. for ``pstats``
+  or ``snakeviz``
+- ``samples.txt``: the sampled stacks as ``thread;frame;... count``, the
+  input of ``flamegraph.pl`` or speedscope
+- ``summary.txt``: the functions most time was spent in, per thread
+'''
+from __future__ import annotations
+
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable
+from datetime import datetime
+from types import CodeType
+from types import FrameType
+from typing import Optional
+
+# seconds between two samples of the stacks
+SAMPLE_INTERVAL = .01
+# the signal that starts profiling a running crowdbike
+SIGNAL = signal.SIGUSR1
+
+
+class Profiler:
+    '''Profile all threads until :meth:`stop` is called or ``seconds``
+    passed and write the results to a new directory in ``out_dir``.'''
+
+    def __init__(
+            self,
+            out_dir: str,
+            logger: logging.Logger,
+            *,
+            deterministic: bool = True,
+            interval: float = SAMPLE_INTERVAL,
+    ) -> None:
+        self.out_dir = out_dir
+        self.logger = logger
+        self.deterministic = deterministic
+        self.interval = interval
+        # the number of times a stack of a thread was sampled
+        self.samples: Counter[tuple[str, tuple[str, ...]]] = Counter()
+        self.nr_samples = 0
+        self.path: Optional[str] = None
+        self._profiles: dict[str, cProfile.Profile] = {}
+        # the profiles that are still enabled
+        self._enabled: set[str] = set()
+        self._labels: dict[CodeType, str] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._owner: Optional[str] = None
+        self._thread_start = threading.Thread.start
+        self._deadline: Optional[float] = None
+        self._start = 0.0
+        self._started_at = datetime.now()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and not self._stopped.is_set()
+
+    def start(self, seconds: Optional[float] = None) -> None:
+        '''start profiling, stop after ``seconds`` if given
+
+        With ``deterministic=True``, :meth:`stop` must be called by the
+        thread that started profiling.
+        '''
+        if self.deterministic and seconds is not None:
+            raise ValueError('cProfile can only be stopped by stop()')
+        self._started_at = datetime.now()
+        self._start = time.monotonic()
+        if seconds is not None:
+            self._deadline = self._start + seconds
+        # started first, so it is not profiled by cProfile itself
+        self._thread = threading.Thread(
+            target=self._run, name='profiler', daemon=True,
+        )
+        self._thread.start()
+        if self.deterministic:
+            self._owner = self._enable()
+            self._patch_thread_start()
+        self.logger.info(f'profiling started: {self!r}')
+
+    def _patch_thread_start(self) -> None:
+        '''profile every thread that is started from now on'''
+        thread_start = self._thread_start
+        profiled = self._profiled
+
+        def start(thread: threading.Thread) -> None:
+            thread.run = profiled(thread.run)  # type: ignore[method-assign]
+            thread_start(thread)
+
+        setattr(threading.Thread, 'start', start)
+
+    def _profiled(self, run: Callable[[], None]) -> Callable[[], None]:
+        '''wrap the ``run`` of a thread, so the thread enables and disables
+        its own profile'''
+        def _run() -> None:
+            key = self._enable()
+            try:
+                run()
+            finally:
+                if key is not None:
+                    self._disable(key)
+
+        return _run
+
+    def _enable(self) -> Optional[str]:
+        '''profile the current thread with cProfile, returns the key of the
+        profile'''
+        name = threading.current_thread().name
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # another profiler is active, Python 3.12+ allows only one
+            self.logger.info(f'not profiling thread {name}: {e}')
+            return None
+        with self._lock:
+            key = name
+            nr = 1
+            # e.g. the PM sensor gets a new thread every time it is enabled
+            while key in self._profiles:
+                nr += 1
+                key = f'{name}-{nr}'
+            self._profiles[key] = profile
+            self._enabled.add(key)
+        return key
+
+    def _disable(self, key: str) -> None:
+        '''disable a profile, only works in the thread that enabled it'''
+        self._profiles[key].disable()
+        with self._lock:
+            self._enabled.discard(key)
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (
+                f'{code.co_name} '
+                f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            )
+        return label
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, top in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                frame: Optional[FrameType] = top
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                name = names.get(ident, str(ident))
+                self.samples[(name, tuple(stack))] += 1
+            self.nr_samples += 1
+            deadline = self._deadline
+            if deadline is not None and time.monotonic() > deadline:
+                self._stopped.set()
+        self._write()
+
+    def stop(self) -> Optional[str]:
+        '''stop profiling, returns the directory the results were written to
+        '''
+        if self._thread is None:
+            return None
+        if self.deterministic:
+            setattr(threading.Thread, 'start', self._thread_start)
+            if self._owner is not None:
+                self._disable(self._owner)
+        self._stopped.set()
+        self._thread.join()
+        return self.path
+
+    def _write(self) -> None:
+        seconds = time.monotonic() - self._start
+        path = os.path.join(
+            self.out_dir, self._started_at.strftime('%Y-%m-%d_%H%M%S'),
+        )
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            # profiles that are enabled are still changed by their thread
+            profiles = {
+                name: profile for name, profile in self._profiles.items()
+                if name not in self._enabled
+            }
+            running = sorted(self._enabled)
+        for name in running:
+            self.logger.warning(
+                f'thread {name} is still running, its profile is not written',
+            )
+        for name, profile in profiles.items():
+            profile.dump_stats(os.path.join(path, f'{_filename(name)}.prof'))
+
+        with open(os.path.join(path, 'samples.txt'), 'w') as f:
+            for (name, stack), count in self.samples.most_common():
+                f.write(f"{';'.join((name, *stack))} {count}\n")
+        with open(os.path.join(path, 'summary.txt'), 'w') as f:
+            f.write(
+                f'profiled for {seconds:.1f}s, {self.nr_samples} samples '
+                f'every {self.interval}s\n',
+            )
+            f.write(summary(self.samples, self.nr_samples))
+        self.path = path
+        self.logger.warning(
+            f'profile of {seconds:.1f}s written to {path}',
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'out_dir={self.out_dir!r}, '
+            f'deterministic={self.deterministic!r}, '
+            f'interval={self.interval!r}, '
+            f'running={self.running!r}'
+            ')'
+        )
+
+
+def summary(
+        samples: Counter[tuple[str, tuple[str, ...]]],
+        nr_samples: int,
+        top: int = 15,
+) -> str:
+    '''the functions with the most samples per thread, in % of the samples
+
+    ``self`` counts the samples the function was running in, ``total`` the
+    ones it was on the stack.
+    '''
+    threads: dict[str, tuple[Counter[str], Counter[str]]] = {}
+    for (name, stack), count in samples.items():
+        self_, total = threads.setdefault(name, (Counter(), Counter()))
+        if stack:
+            self_[stack[-1]] += count
+        for label in set(stack):
+            total[label] += count
+
+    lines = []
+    for name, (self_, total) in sorted(threads.items()):
+        lines.append(f'\nthread {name}\n')
+        lines.append(f"{'total %':>8} {'self %':>8}  function\n")
+        for label, count in total.most_common(top):
+            lines.append(
+                f'{100 * count / nr_samples:>8.1f} '
+                f'{100 * self_[label] / nr_samples:>8.1f}  {label}\n',
+            )
+    return ''.join(lines)
+
+
+def _filename(name: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+
+
+def profile_on_signal(
+        out_dir: str,
+        seconds: float,
+        logger: logging.Logger,
+        signum: int = SIGNAL,
+) -> None:
+    '''profile the next ``seconds`` whenever ``signum`` is received
+
+    The threads are already running, so only the sampling profiler is used.
+    '''
+    current: list[Profiler] = []
+
+    def _handler(signum: int, frame: Optional[FrameType]) -> None:
+        if current and current[0].running:
+            logger.warning('received a signal to profile, already profiling')
+            return
+        profiler = Profiler(out_dir, logger, deterministic=False)
+        current[:] = [profiler]
+        profiler.start(seconds)
+
+    signal.signal(signum, _handler)
@@ -0,0 +1,384 @@
+'''Sample the sensors and write the measurements to the logfiles.'''
+from __future__ import annotations
+
+import functools
+import logging
+import math
+import os
+import time
+from collections.abc import Callable
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import TYPE_CHECKING
+from typing import Union
+
+from crowdbike.binlog import BinaryLogWriter
+from crowdbike.helpers import sat_vappressure
+from crowdbike.helpers import vappressure
+from crowdbike.manifest import UploadManifest
+from crowdbike.metrics import metrics
+from crowdbike.ringbuffer import RingBuffer
+from crowdbike.scheduler import Scheduler
+from crowdbike.scheduler import Tick
+from crowdbike.writer import BackgroundWriter
+from crowdbike.writer import finalize_parts
+from crowdbike.writer import LOG_FORMATS
+from crowdbike.writer import LogWriter
+from crowdbike.writer import PRECISE_TIME_FMT
+from crowdbike.writer import ROTATE_INTERVALS
+from crowdbike.writer import RotatingLogWriter
+from crowdbike.writer import Sample
+from crowdbike.writer import TIME_FMT
+
+if TYPE_CHECKING:
+    from crowdbike.sensors import DHT22
+    from crowdbike.sensors import GPS
+    from crowdbike.sensors import PmSensor
+    from crowdbike.sensors import SHT85
+
+
+class Recorder:
+    '''Take a measurement every ``sampling_rate`` seconds and log it.
+
+    This is shared by the GUI and the headless mode and does not depend on
+    tkinter. The sensors are passed in, the PM sensor as a factory, since a
+    new thread is needed every time it is switched on.
+
+    :attr:`latest` holds the latest measurement and the number of satellites
+    for displaying them, it is replaced as a whole on every tick.
+    '''
+
+    def __init__(
+            self,
+            config: dict[str, Any],
+            calib: dict[str, Any],
+            logger: logging.Logger,
+            *,
+            gps: GPS,
+            temp_hum: Union[DHT22, SHT85],
+            pm_factory: Callable[[], PmSensor],
+            mac: str,
+            version: str,
+            stationary: bool = False,
+    ) -> None:
+        user = config['user']
+        self.config = config
+        self.logger = logger
+        self.mac = mac
+        self.version = version
+        self.stationary = stationary
+        self.pi_id = user['bike_nr']
+        self.studentname = user['studentname']
+        self.sensor_id = user['sensor_id']
+        self.logfile_path = user['logfile_path']
+        os.makedirs(self.logfile_path, exist_ok=True)
+        # segments of a previous run that did not finish e.g. a power loss
+        finalize_parts(
+            self.logfile_path,
+            logger,
+            UploadManifest.for_dir(self.logfile_path),
+        )
+
+        self.log_format = user.get('log_format', 'csv')
+        if self.log_format not in LOG_FORMATS:
+            raise NameError(
+                f'log format unknown, must be one of {", ".join(LOG_FORMATS)}',
+            )
+
+        # start a new logfile after this many rows, bytes or seconds
+        self.rotate_rows: int | None = user.get('rotate_rows')
+        self.rotate_bytes: int | None = user.get('rotate_bytes')
+        rotate_interval = user.get('rotate_interval')
+        self.rotate_interval: float | None
+        if isinstance(rotate_interval, str):
+            if rotate_interval not in ROTATE_INTERVALS:
+                raise NameError(
+                    f'rotate interval unknown, must be a number of seconds '
+                    f'or one of {", ".join(ROTATE_INTERVALS)}',
+                )
+            self.rotate_interval = ROTATE_INTERVALS[rotate_interval]
+        else:
+            self.rotate_interval = rotate_interval
+
+        # calibration params
+        self.temperature_cal_a1 = calib['temp_cal_a1']
+        self.temperature_cal_a0 = calib['temp_cal_a0']
+        self.hum_cal_a1 = calib['hum_cal_a1']
+        self.hum_cal_a0 = calib['hum_cal_a0']
+
+        self.sampling_rate = user['sampling_rate']
+        # sub-second sampling needs sub-second timestamps to tell rows apart
+        if float(self.sampling_rate).is_integer():
+            self.time_fmt = TIME_FMT
+        else:
+            self.time_fmt = PRECISE_TIME_FMT
+
+        self.gps = gps
+        self.gps.time_fmt = self.time_fmt
+        self.temp_hum = temp_hum
+        sensor_interval = user.get('sensor_interval', temp_hum.interval)
+        if sensor_interval < temp_hum.min_interval:
+            logger.warning(
+                f'sensor_interval {sensor_interval} is too short for the '
+                f'{type(temp_hum).__name__}, using {temp_hum.min_interval}',
+            )
+            sensor_interval = temp_hum.min_interval
+        self.temp_hum.interval = sensor_interval
+        self._pm_factory = pm_factory
+        self.pm_sensor = pm_factory()
+        self.pm_status: bool = user['pm_sensor']
+
+        # log the aggregates of all readings per sampling interval
+        self.aggregate: bool = user.get('aggregate', False)
+        # the readings of one interval fit twice, in case a row is delayed
+        buffer_size = 2 * math.ceil(self.sampling_rate / temp_hum.interval)
+        self.temp_hum_buffer = RingBuffer(
+            buffer_size, ('temperature_raw', 'rel_humidity_raw'),
+        )
+        self.pm_buffer = RingBuffer(buffer_size, ('pm10', 'pm2_5'))
+        # log the age of the GPS fix the position was interpolated from
+        self.log_fix_age: bool = user.get('gps_fix_age', False)
+        self.extra_columns: list[tuple[str, int]] = []
+        if self.log_fix_age:
+            self.extra_columns.append(('gps_fix_age', 3))
+        if self.aggregate:
+            self.extra_columns.extend(self.temp_hum_buffer.columns(5))
+            self.extra_columns.extend(self.pm_buffer.columns(2))
+            self.temp_hum.buffer = self.temp_hum_buffer
+
+        self.writer: BackgroundWriter | None = None
+        self.latest: tuple[Sample, float] | None = None
+        self.scheduler = Scheduler(
+            self.sampling_rate, self.sample, logger, name='sampling',
+        )
+        for name, attr, help in (
+            (
+                'writer_queue_depth', 'queue_depth',
+                'rows waiting to be written to the logfile',
+            ),
+            (
+                'writer_max_queue_depth', 'max_queue_depth',
+                'most rows that waited to be written to the logfile',
+            ),
+            ('writer_rows', 'counter', 'rows written since recording started'),
+            (
+                'writer_dropped_rows', 'dropped',
+                'rows dropped because the writer queue was full',
+            ),
+        ):
+            metrics.gauge(name, help, functools.partial(self._writer, attr))
+
+    @property
+    def recording(self) -> bool:
+        return self.writer is not None
+
+    def _writer(self, attr: str) -> float:
+        '''a value of the writer for the metrics, 0 if not recording'''
+        writer = self.writer
+        return 0 if writer is None else getattr(writer, attr)
+
+    def start(self) -> None:
+        '''start reading the sensors and sampling'''
+        self.gps.start()
+        self.temp_hum.start()
+        # switch off the PM sensor if it is running prior to starting the app
+        self.set_pm(self.pm_status)
+        self.scheduler.start()
+
+    def set_pm(self, enabled: bool) -> None:
+        '''switch the PM sensor on or off'''
+        self.pm_status = enabled
+        if enabled:
+            if self.pm_sensor.running:
+                return
+            try:
+                self.pm_sensor.sensor_wake()
+                # a thread can only be started once, so create a new one
+                self.pm_sensor = self._pm_factory()
+                if self.aggregate:
+                    self.pm_sensor.buffer = self.pm_buffer
+                self.pm_sensor.start()
+            except Exception as e:
+                self.logger.warning(f'failed reading the PM sensor: {e}')
+        else:
+            try:
+                self.pm_sensor.stop()
+                self.pm_sensor.sensor_sleep()
+            except Exception as e:
+                self.logger.warning(f'failed setting the PM to sleep mode {e}')
+
+    def _logfile(self) -> str:
+        '''path of a new logfile, named after the current time'''
+        log_time = datetime.utcnow().strftime('%Y-%m-%d_%H%M%S')
+        logfile_name = (
+            f"{self.pi_id}_{self.studentname.replace(' ', '_')}_{log_time}"
+            f'{LOG_FORMATS[self.log_format]}'
+        )
+        return os.path.join(self.logfile_path, logfile_name)
+
+    def _sink(self, path: str) -> Union[LogWriter, BinaryLogWriter]:
+        if self.log_format == 'binary':
+            return BinaryLogWriter(
+                path,
+                pi_id=self.pi_id,
+                mac=self.mac,
+                sensor_id=self.sensor_id,
+                version=self.version,
+                time_format=self.time_fmt,
+                extra_columns=self.extra_columns,
+            )
+        else:
+            return LogWriter(
+                path,
+                pi_id=self.pi_id,
+                mac=self.mac,
+                sensor_id=self.sensor_id,
+                version=self.version,
+                extra_columns=self.extra_columns,
+            )
+
+    def start_recording(self) -> str:
+        '''start writing the measurements to a new logfile'''
+        if self.writer is not None:
+            self.writer.close()
+
+        user = self.config['user']
+        # even without limits, the logfile is written as .part and only
+        # renamed once it is closed, so it is not uploaded while it is open
+        sink = RotatingLogWriter(
+            self._logfile,
+            self._sink,
+            self.logger,
+            manifest=UploadManifest.for_dir(self.logfile_path),
+            max_rows=self.rotate_rows,
+            max_bytes=self.rotate_bytes,
+            interval=self.rotate_interval,
+        )
+        sink.open()
+        logfile = sink.path
+        self.logger.warning(f'writing measurement logs to {logfile}')
+        writer = BackgroundWriter(
+            sink,
+            self.logger,
+            commit_rows=user.get('commit_rows', 32),
+            commit_interval=user.get('commit_interval', 1),
+            fsync=user.get('fsync', 'interval'),
+            fsync_interval=user.get('fsync_interval', 5),
+        )
+        writer.start()
+        self.writer = writer
+        return logfile
+
+    def stop_recording(self) -> None:
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            self.logger.warning('recording stopped')
+
+    def sample(self, tick: Tick) -> None:
+        '''take a measurement, called by the scheduler on every tick'''
+        computer_time = datetime.utcnow().strftime(self.time_fmt)
+        now = time.monotonic()
+
+        # take a snapshot of every sensor, so all values of a sensor in a
+        # row come from the same reading
+        temp_hum = self.temp_hum.snapshot
+        gps = self.gps.snapshot
+        pm = self.pm_sensor.snapshot
+
+        humidity = temp_hum.humidity
+        temperature = temp_hum.temperature
+
+        # calculate temperature with sensor calibration values
+        temperature_raw = round(temperature, 5)
+        temperature_calib = round(
+            temperature * self.temperature_cal_a1 + self.temperature_cal_a0,
+            3,
+        )
+        humidity_raw = round(humidity, 5)
+        humidity_calib = round(
+            humidity * self.hum_cal_a1 + self.hum_cal_a0,
+            3,
+        )
+
+        saturation_vappress = sat_vappressure(temperature_calib)
+        vappress = round(
+            vappressure(
+                humidity_calib,
+                saturation_vappress,
+            ), 5,
+        )
+
+        # read pm-sensor
+        if self.pm_status is True:
+            pm2_5 = pm.pm2_5
+            pm10 = pm.pm10
+        else:
+            pm2_5 = float('nan')
+            pm10 = float('nan')
+
+        # Get GPS position, interpolated to the time of this sample
+        f_mode = gps.satellites  # store number of satellites
+        has_fix = f_mode > 2
+        position = self.gps.position_at(now)
+        # the GPS time of the interpolated position, not of the latest fix
+        if math.isnan(position.time):
+            gps_time = gps.gps_time
+        else:
+            gps_time = datetime.fromtimestamp(
+                position.time, tz=timezone.utc,
+            ).strftime(self.time_fmt)
+
+        extra: list[float] = []
+        if self.log_fix_age:
+            extra.append(position.age)
+        # aggregate all readings since the last row
+        if self.aggregate:
+            extra.extend(
+                value
+                for buffer in (self.temp_hum_buffer, self.pm_buffer)
+                for stats in buffer.aggregate().values()
+                for value in stats
+            )
+
+        row = Sample(
+            raspberry_time=computer_time,
+            gps_time=gps_time,
+            altitude=position.alt,
+            latitude=position.latitude,
+            longitude=position.longitude,
+            speed=round(position.speed * 1.852, 2),
+            temperature=temperature_calib,
+            temperature_raw=temperature_raw,
+            rel_humidity=humidity_calib,
+            rel_humidity_raw=humidity_raw,
+            vapour_pressure=vappress,
+            pm10=pm10,
+            pm2_5=pm2_5,
+            extra=tuple(extra),
+        )
+        self.latest = (row, f_mode)
+
+        writer = self.writer
+        if writer is not None and (has_fix or self.stationary):
+            writer.submit(row)
+
+    def close(self) -> None:
+        '''stop sampling, close the logfile and stop the sensors'''
+        self.logger.info('stopping the recorder...')
+        self.scheduler.stop()
+        self.stop_recording()
+        self.gps.stop()
+        self.temp_hum.stop()
+        self.pm_sensor.stop()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'sampling_rate={self.sampling_rate!r}, '
+            f'recording={self.recording!r}, '
+            f'pm_status={self.pm_status!r}, '
+            f'scheduler={self.scheduler!r}'
+            ')'
+        )
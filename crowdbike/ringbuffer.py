@@ -0,0 +1,112 @@
+'''Aggregate all readings of a sensor between two log ticks.'''
+from __future__ import annotations
+
+import threading
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import numpy as np
+
+# the aggregates per field, in the order they are logged
+STATS = ('mean', 'min', 'max', 'std', 'n')
+
+
+class Stats(NamedTuple):
+    mean: float
+    min: float
+    max: float
+    std: float
+    # number of valid (not NaN) readings
+    n: int
+
+
+class RingBuffer:
+    '''Fixed-size buffer of the readings since the last :meth:`aggregate`.
+
+    The readings are stored in a preallocated array with one column per
+    field, so memory stays constant no matter how long the sensor runs. If
+    more than ``capacity`` readings are appended between two aggregations,
+    the oldest ones are overwritten and counted in :attr:`overwritten`.
+
+    :meth:`append` is called from the sensor thread and :meth:`aggregate`
+    from the logging, both are thread-safe.
+    '''
+
+    def __init__(self, capacity: int, fields: Sequence[str]) -> None:
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.fields = tuple(fields)
+        self.overwritten = 0
+        self._data = np.full((capacity, len(self.fields)), np.nan)
+        self._pos = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def columns(self, decimals: int) -> list[tuple[str, int]]:
+        '''names and decimals of the logfile columns of the aggregates'''
+        return [
+            (f'{field}_{stat}', 0 if stat == 'n' else decimals)
+            for field in self.fields
+            for stat in STATS
+        ]
+
+    def append(self, values: Sequence[float]) -> None:
+        '''add a reading, ``values`` must be in the order of ``fields``'''
+        with self._lock:
+            self._data[self._pos] = values
+            self._pos = (self._pos + 1) % self.capacity
+            if self._size < self.capacity:
+                self._size += 1
+            else:
+                self.overwritten += 1
+
+    def aggregate(self) -> dict[str, Stats]:
+        '''aggregate the readings per field and empty the buffer
+
+        Readings that are NaN are ignored. Fields without any valid readings
+        have NaN aggregates and ``n == 0``.
+        '''
+        with self._lock:
+            # the order of the readings does not matter for the aggregates,
+            # so the filled rows can be used without unrolling the ring
+            data = self._data[:self._size].copy()
+            self._pos = 0
+            self._size = 0
+
+        valid = ~np.isnan(data)
+        n = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, data, 0).sum(axis=0) / n
+            var = np.where(valid, (data - mean) ** 2, 0).sum(axis=0) / n
+        if len(data):
+            # fmin/fmax ignore NaN, unless all values are NaN
+            minimum = np.fmin.reduce(data, axis=0)
+            maximum = np.fmax.reduce(data, axis=0)
+        else:
+            minimum = maximum = np.full(len(self.fields), np.nan)
+
+        return {
+            field: Stats(*values)
+            for field, *values in zip(
+                self.fields,
+                mean.tolist(),
+                minimum.tolist(),
+                maximum.tolist(),
+                np.sqrt(var).tolist(),
+                n.tolist(),
+            )
+        }
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'capacity={self.capacity!r}, '
+            f'fields={self.fields!r}, '
+            f'size={self._size!r}, '
+            f'overwritten={self.overwritten!r}'
+            ')'
+        )
@@ -0,0 +1,118 @@
+'''Call a function at a fixed rate, without drifting.'''
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections.abc import Callable
+from typing import NamedTuple
+
+from crowdbike.metrics import metrics
+
+
+class Tick(NamedTuple):
+    # number of the tick since the scheduler started
+    number: int
+    # time.monotonic() the tick was due at
+    deadline: float
+    # seconds between the deadline and the call
+    late: float
+    # number of ticks skipped right before this one
+    missed: int
+
+
+class Scheduler(threading.Thread):
+    '''Call ``callback`` every ``interval`` seconds from a dedicated thread.
+
+    The deadlines are absolute (``start + index * interval``) on the
+    monotonic clock, so the time the callback takes does not add up and the
+    series does not drift. The interval can be fractional e.g. ``0.2``.
+
+    If a tick is more than ``interval`` late, e.g. because the callback took
+    too long, the ticks that were missed are skipped instead of being called
+    in a burst. They are counted in :attr:`missed`, ticks that are called
+    more than ``late_threshold`` seconds after their deadline in
+    :attr:`late`.
+    '''
+
+    def __init__(
+            self,
+            interval: float,
+            callback: Callable[[Tick], None],
+            logger: logging.Logger,
+            *,
+            late_threshold: float | None = None,
+            name: str = 'scheduler',
+    ) -> None:
+        threading.Thread.__init__(self, name=name, daemon=True)
+        if interval <= 0:
+            raise ValueError('interval must be greater than 0')
+        self.interval = interval
+        self.callback = callback
+        self.logger = logger
+        if late_threshold is None:
+            late_threshold = interval / 10
+        self.late_threshold = late_threshold
+        self.ticks = 0
+        self.missed = 0
+        self.late = 0
+        self.max_late = 0.0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        start = time.monotonic()
+        index = 0
+        while True:
+            deadline = start + index * self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0 and self._stopped.wait(delay):
+                break
+            if self._stopped.is_set():
+                break
+
+            now = time.monotonic()
+            missed = int((now - deadline) // self.interval)
+            if missed > 0:
+                index += missed
+                deadline += missed * self.interval
+                self.missed += missed
+                self.logger.warning(
+                    f'{self.name}: missed {missed} ticks '
+                    f'({self.missed} in total)',
+                )
+
+            late = now - deadline
+            if late > self.late_threshold:
+                self.late += 1
+                self.logger.debug(
+                    f'{self.name}: tick {index} was {late:.3f}s late',
+                )
+            self.max_late = max(self.max_late, late)
+            metrics.tick(self.name, late, missed)
+
+            try:
+                self.callback(Tick(index, deadline, late, missed))
+            except Exception:
+                self.logger.exception(f'{self.name}: tick {index} failed')
+            self.ticks += 1
+            index += 1
+
+    def stop(self, timeout: float | None = None) -> None:
+        '''stop calling the callback and wait for the current call'''
+        self._stopped.set()
+        if self.ident is not None and self is not threading.current_thread():
+            self.join(timeout)
+        self.logger.info(
+            f'{self.name}: stopped after {self.ticks} ticks, {self.missed} '
+            f'missed, {self.late} late, max. {self.max_late:.3f}s late',
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'interval={self.interval!r}, '
+            f'ticks={self.ticks!r}, '
+            f'missed={self.missed!r}, '
+            f'late={self.late!r}'
+            ')'
+        )
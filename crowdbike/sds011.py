@@ -0,0 +1,111 @@
+'''Protocol of the Nova SDS011 particulate matter sensor.
+
+The sensor sends a 10 byte data frame once per second::
+
+    0xAA 0xC0 PM2.5-LSB PM2.5-MSB PM10-LSB PM10-MSB ID1 ID2 checksum 0xAB
+
+The checksum is the sum of the six data bytes modulo 256.
+'''
+from __future__ import annotations
+
+import struct
+from typing import NamedTuple
+
+HEADER = b'\xaa\xc0'
+TAIL = 0xAB
+FRAME_SIZE = 10
+# pm2.5, pm10, device id, checksum, tail
+_DATA = struct.Struct('<HHHBB')
+
+
+class Frame(NamedTuple):
+    pm2_5: float
+    pm10: float
+    device_id: int
+
+
+def command(data: bytes, device_id: bytes = b'\xff\xff') -> bytes:
+    '''build a 19 byte command frame, ``0xFFFF`` addresses all sensors'''
+    payload = b'\xb4' + data.ljust(13, b'\x00') + device_id
+    checksum = sum(payload[1:]) % 256
+    return b'\xaa' + payload + bytes((checksum, TAIL))
+
+
+def data_frame(pm2_5: float, pm10: float, device_id: int = 0x2b4e) -> bytes:
+    '''encode a data frame as the sensor sends it, e.g. for a simulation'''
+    data = _DATA.pack(round(pm2_5 * 10), round(pm10 * 10), device_id, 0, TAIL)
+    return HEADER + data[:6] + bytes((sum(data[:6]) % 256, TAIL))
+
+
+# set the sensor to sleep (fan and laser off) or to work
+SLEEP = command(b'\x06\x01\x00')
+WAKE = command(b'\x06\x01\x01')
+
+
+class FrameParser:
+    '''Parse the data frames from a stream of bytes.
+
+    The bytes can be fed in chunks of any size as they are read, a frame may
+    be split across several chunks and a chunk may contain several frames.
+    The stream is synchronized on the ``0xAA 0xC0`` header, so bytes that do
+    not belong to a data frame (e.g. command replies or a partial frame at
+    the start) are skipped. If a frame is invalid, the search for the next
+    header starts at the following byte, so a single corrupted byte only
+    costs the frame it is in.
+    '''
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self.frames = 0
+        # frames with a wrong checksum or tail
+        self.checksum_errors = 0
+        # bytes skipped while searching for a header
+        self.skipped = 0
+
+    def feed(self, data: bytes) -> list[Frame]:
+        '''add bytes to the stream and return the frames they completed'''
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(HEADER, pos)
+            if start < 0:
+                # a trailing 0xAA may be the first byte of the next header
+                end = len(buf) - 1 if buf.endswith(HEADER[:1]) else len(buf)
+                self.skipped += max(end - pos, 0)
+                pos = max(end, pos)
+                break
+
+            self.skipped += start - pos
+            if len(buf) - start < FRAME_SIZE:
+                pos = start
+                break
+
+            pm2_5, pm10, device_id, checksum, tail = _DATA.unpack_from(
+                buf, start + 2,
+            )
+            if tail != TAIL or sum(buf[start + 2:start + 8]) % 256 != checksum:
+                self.checksum_errors += 1
+                pos = start + 1
+                continue
+
+            frames.append(Frame(pm2_5 / 10, pm10 / 10, device_id))
+            pos = start + FRAME_SIZE
+
+        del buf[:pos]
+        self.frames += len(frames)
+        return frames
+
+    def reset(self) -> None:
+        '''drop a partial frame e.g. after the port was reopened'''
+        self._buf.clear()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'frames={self.frames!r}, '
+            f'checksum_errors={self.checksum_errors!r}, '
+            f'skipped={self.skipped!r}'
+            ')'
+        )
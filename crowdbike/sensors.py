@@ -1,65 +1,284 @@
 import logging
 import threading
 import time
+from collections import deque
+from datetime import timezone
+from typing import Any
+from typing import Generic
+from typing import NamedTuple
 from typing import Optional
-from typing import Union
+from typing import Protocol
+from typing import TypeVar
 
-import adafruit_dht
-import adafruit_gps
-import board
-import serial
-from sensirion_i2c_driver import I2cConnection
-from sensirion_i2c_driver.linux_i2c_transceiver import LinuxI2cTransceiver
-from sensirion_i2c_sht.sht3x import Sht3xI2cDevice
+from crowdbike.fixhistory import FixHistory
+from crowdbike.fixhistory import Position
+from crowdbike.led import leds
+from crowdbike.metrics import metrics
+from crowdbike.nmea import Fix
+from crowdbike.nmea import NmeaParser
+from crowdbike.nmea import ONLY_RMC_GGA
+from crowdbike.nmea import set_baudrate
+from crowdbike.nmea import set_fix_rate
+from crowdbike.ringbuffer import RingBuffer
+from crowdbike.sds011 import Frame
+from crowdbike.sds011 import FrameParser
+from crowdbike.sds011 import SLEEP
+from crowdbike.sds011 import WAKE
+from crowdbike.writer import TIME_FMT
 
-from crowdbike.helpers import update_led
 
+class TempHumReading(NamedTuple):
+    seq: int
+    # time.monotonic() when the reading was taken
+    timestamp: float
+    temperature: float
+    humidity: float
+
+
+class PmReading(NamedTuple):
+    seq: int
+    timestamp: float
+    pm2_5: float
+    pm10: float
+
+
+class GPSReading(NamedTuple):
+    seq: int
+    timestamp: float
+    has_fix: bool
+    latitude: float
+    longitude: float
+    alt: float
+    # speed in knots
+    speed: float
+    satellites: float
+    gps_time: str
+    # UTC time of the fix as a POSIX timestamp, NaN if unknown
+    utc: float
+
+
+class SerialPort(Protocol):
+    '''the parts of ``serial.Serial`` that are used'''
+    port: Optional[str]
+    baudrate: int
+
+    @property
+    def in_waiting(self) -> int: ...
+    def open(self) -> None: ...
+    def isOpen(self) -> bool: ...
+    def close(self) -> None: ...
+    def read(self, size: int = 1) -> bytes: ...
+    def write(self, data: bytes) -> Optional[int]: ...
+    def flush(self) -> None: ...
+    def reset_input_buffer(self) -> None: ...
+
+
+R = TypeVar('R', TempHumReading, PmReading, GPSReading)
+
+
+class SensorThread(threading.Thread, Generic[R]):
+    '''Base class of the sensors, reading them in a background thread.
+
+    The drivers are imported when a sensor is created, so only the ones of
+    the sensors that are actually used are loaded.
+
+    Every reading is published as a new immutable snapshot (a ``NamedTuple``)
+    with an increasing sequence number ``seq`` and the monotonic
+    ``timestamp`` it was taken at. :attr:`snapshot` can be read from any
+    thread without locking and always contains the values of a single
+    reading. Use :meth:`wait_for` to block until a new reading is available.
+
+    If a :attr:`buffer` is set, the ``buffered`` fields of every reading are
+    also appended to it, so they can be aggregated per log interval.
+
+    Subclasses implement :meth:`read` and :meth:`close`.
+    '''
+    # the LED that flashes after a successful reading
+    led: Optional[str] = None
+    # time between two readings in seconds
+    interval = .2
+    # the shortest interval the sensor can deliver new readings at
+    min_interval = 0.
+    # the fields of a reading that are appended to the buffer
+    buffered: tuple[str, ...] = ()
+    buffer: Optional[RingBuffer] = None
+
+    def __init__(self, logger: logging.Logger, initial: R) -> None:
+        threading.Thread.__init__(self, name=type(self).__name__, daemon=True)
+        self.logger = logger
+        self._snapshot: R = initial
+        self._changed = threading.Condition()
+        self._stopped = threading.Event()
+
+    @property
+    def snapshot(self) -> R:
+        '''the latest reading'''
+        return self._snapshot
+
+    @property
+    def running(self) -> bool:
+        return self.is_alive() and not self._stopped.is_set()
+
+    def read(self, seq: int, timestamp: float) -> R:
+        '''take a reading from the sensor, raise if it failed'''
+        raise NotImplementedError
+
+    def indicate(self, reading: R) -> bool:
+        '''whether the LED should flash for this reading'''
+        return True
+
+    def close(self) -> None:
+        '''release the hardware after the thread stopped'''
+
+    def _publish(self, reading: R) -> None:
+        with self._changed:
+            self._snapshot = reading
+            self._changed.notify_all()
+        if self.buffer is not None:
+            self.buffer.append([getattr(reading, f) for f in self.buffered])
+
+    def wait_for(self, seq: int, timeout: Optional[float] = None) -> R:
+        '''wait for a reading newer than ``seq`` and return the latest one
+
+        After ``timeout`` seconds or once the sensor was stopped, the latest
+        reading is returned, even if it is not newer.
+        '''
+        with self._changed:
+            self._changed.wait_for(
+                lambda: (
+                    self._snapshot.seq > seq or
+                    self._stopped.is_set()
+                ),
+                timeout=timeout,
+            )
+            return self._snapshot
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            start = time.perf_counter()
+            try:
+                reading = self.read(
+                    self._snapshot.seq + 1,
+                    time.monotonic(),
+                )
+            except Exception as e:
+                metrics.sensor_read(
+                    self.name, time.perf_counter() - start, error=e,
+                )
+                self.logger.warning(f'failed reading {self.name}: {e}')
+                self._stopped.wait(self.interval)
+                continue
+
+            metrics.sensor_read(self.name, time.perf_counter() - start)
+            self._publish(reading)
+            if self.led is not None and self.indicate(reading):
+                leds.set(**{self.led: True})
+                self._stopped.wait(self.interval / 2)
+                leds.set(**{self.led: False})
+                self._stopped.wait(self.interval / 2)
+            else:
+                self._stopped.wait(self.interval)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        '''stop reading the sensor, wait for the thread and close it'''
+        self._stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self.ident is not None:
+            self.join(timeout)
+        self.close()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'running={self.running!r}, '
+            f'snapshot={self.snapshot!r}'
+            ')'
+        )
+
+
+class PmSensor(SensorThread[PmReading]):
+    '''Nova SDS011 connected via USB.
+
+    The port is kept open while the sensor is running. Everything that is
+    available is read at once and fed to a :class:`FrameParser`, every frame
+    is published as a separate reading. If reading fails, the port is closed
+    and reopened for the next reading, e.g. after the sensor was unplugged.
+
+    ``ser`` replaces the serial port, e.g. by a simulated one.
+    '''
+    led = 'yellow'
+    buffered = ('pm10', 'pm2_5')
 
-class PmSensor(threading.Thread):
     def __init__(
             self,
             dev: str,
             logger: logging.Logger,
             baudrate: int = 9600,
+            ser: Optional[SerialPort] = None,
     ) -> None:
-        threading.Thread.__init__(self)
-        self.running = False
-        self.ser = serial.Serial(
-            baudrate=baudrate,
-            timeout=5,
-            write_timeout=5,
+        super().__init__(
+            logger,
+            PmReading(0, time.monotonic(), float('nan'), float('nan')),
         )
+        if ser is None:
+            import serial
+
+            ser = serial.Serial(
+                baudrate=baudrate,
+                timeout=5,
+                write_timeout=5,
+            )
+        self.ser = ser
         # initialize later so no connection is established at initialization
         self.ser.port = dev
-        self.pm2_5 = float('nan')
-        self.pm10 = float('nan')
-        self.logger = logger
+        self.parser = FrameParser()
+        # frames that were read, but not published yet
+        self._frames: deque[Frame] = deque()
 
-    def run(self) -> None:
-        while self.running:
-            try:
-                if not self.ser.isOpen():
-                    self.ser.open()
-
-                data = self.ser.read(10)
-                assert data[0] == ord(b'\xaa')
-                assert data[1] == ord(b'\xc0')
-                assert data[9] == ord(b'\xab')
-                checksum = sum(v for v in data[2:8]) % 256
-                assert checksum == data[8]
-
-                self.pm2_5 = (data[3] * 256 + data[2]) / 10.0
-                self.pm10 = (data[5] * 256 + data[4]) / 10.0
+    def read(self, seq: int, timestamp: float) -> PmReading:
+        try:
+            if not self.ser.isOpen():
+                self.ser.open()
+                self.parser.reset()
+
+            while not self._frames:
+                # block for at least one byte, then take all that is waiting
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+                if not data:
+                    raise TimeoutError('no data received')
+                self._frames.extend(self.parser.feed(data))
+        except Exception:
+            self.ser.close()
+            # do not keep showing the values of the last valid reading
+            self._publish(
+                PmReading(seq, timestamp, float('nan'), float('nan')),
+            )
+            raise
+
+        frame = self._frames.popleft()
+        return PmReading(
+            seq=seq,
+            timestamp=timestamp,
+            pm2_5=frame.pm2_5,
+            pm10=frame.pm10,
+        )
+
+    def close(self) -> None:
+        self.ser.close()
+        self.logger.info(f'PM sensor stopped: {self.parser}')
+
+    def _command(self, cmd: bytes) -> None:
+        '''send a command, the port is only closed again if it was closed'''
+        was_open = self.ser.isOpen()
+        if not was_open:
+            self.ser.open()
+        try:
+            self.ser.write(cmd)
+            self.ser.flush()
+        finally:
+            if not was_open:
                 self.ser.close()
-                update_led(yellow=True)
-            except Exception as e:
-                self.logger.warning(f'failed reading PM-sensor: {e}')
-                self.pm10 = float('nan')
-                self.pm2_5 = float('nan')
-            finally:
-                time.sleep(.1)
-                update_led(yellow=False)
-                time.sleep(.1)
 
     def sensor_sleep(self) -> None:
         '''
@@ -67,18 +286,7 @@ class PmSensor(threading.Thread):
         originally from
         https://github.com/luetzel/sds011/blob/master/sds011_pylab.py
         '''
-        if not self.ser.isOpen():
-            self.ser.open()
-
-        sleep_bytes = [
-            b'\xaa', b'\xb4', b'\x06', b'\x01', b'\x00', b'\x00', b'\x00',
-            b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00',
-            b'\x00', b'\xff', b'\xff', b'\x05', b'\xab',
-        ]
-        for b in sleep_bytes:
-            self.ser.write(b)
-
-        self.ser.close()
+        self._command(SLEEP)
         self.logger.info('set PM sensor to sleep mode')
 
     def sensor_wake(self) -> None:
@@ -87,159 +295,231 @@ class PmSensor(threading.Thread):
         originally from
         https://github.com/luetzel/sds011/blob/master/sds011_pylab.py
         '''
-        if not self.ser.isOpen():
-            self.ser.open()
-        wake_bytes = [
-            b'\xaa', b'\xb4', b'\x06', b'\x01', b'\x01', b'\x00', b'\x00',
-            b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00', b'\x00',
-            b'\x00', b'\xff', b'\xff', b'\x06', b'\xab',
-        ]
-        for b in wake_bytes:
-            self.ser.write(b)
-
-        self.ser.close()
+        self._command(WAKE)
         self.logger.info('set PM sensor to awake mode')
 
 
-class DHT22(threading.Thread):
-    def __init__(self, logger: logging.Logger) -> None:
-        threading.Thread.__init__(self)
-        self.dht_22 = adafruit_dht.DHT22(board.D4)
-        self.running = True
-        self.humidity: Optional[float] = None
-        self.temperature: Optional[float] = None
-        self.logger = logger
+def _nan_if_none(value: Optional[float]) -> float:
+    return float('nan') if value is None else value
 
-    def run(self) -> None:
-        while self.running:
-            try:
-                self.humidity = self.dht_22.temperature
-                self.temperature = self.dht_22.humidity
-                # XXX: The DHT library kinda sucks, if the sensor throws
-                # errors, because it was disconnected, self._temperature
-                # stays at the old value so measurements remain the same
-                # this way the LED is kinda useless!
-                if self.temperature is not None:
-                    update_led(red=True)
-            except Exception as e:
-                self.logger.warning(f'failed reading DHT22-sensor: {e}')
-                continue
-            finally:
-                time.sleep(.1)
-                update_led(red=False)
-                time.sleep(.1)
-
-
-class SHT85(threading.Thread):
-    def __init__(self, logger: logging.Logger) -> None:
-        threading.Thread.__init__(self)
-        con = I2cConnection(LinuxI2cTransceiver('/dev/i2c-1'))
-        self.sht_85 = Sht3xI2cDevice(con)
-        self.running = True
-        self.humidity = None
-        self.temperature = None
-        self.logger = logger
 
-    def run(self) -> None:
-        while self.running:
-            try:
-                temp, hum = self.sht_85.single_shot_measurement()
-                self.temperature = temp.degrees_celsius
-                self.humidity = hum.percent_rh
-                update_led(red=True)
-            except Exception as e:
-                self.logger.warning(f'failed reading SHT85-sensor: {e}')
-                continue
-            finally:
-                time.sleep(.1)
-                update_led(red=False)
-                time.sleep(.1)
-
-
-class GPS(threading.Thread):
-    '''Class for reading the adafruit gps'''
-
-    def __init__(self, logger: logging.Logger) -> None:
-        threading.Thread.__init__(self)
-        self.uart = serial.Serial('/dev/ttyS0', baudrate=9600, timeout=10)
-        self.gps = adafruit_gps.GPS(self.uart, debug=False)
-        self.gps.send_command(b'PMTK314,0,1,0,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0')
-        self.gps.send_command(b'PMTK220,1000')
-        self.running = True
-
-        self.has_fix: Optional[bool] = None
-        self.latitude: Optional[float] = None
-        self.longitude: Optional[float] = None
-        self.satellites: Union[int, float] = float('nan')
-        self.timestamp: str = 'nan'
-        self.alt: Optional[float] = None
-        self.speed: Union[int, float] = float('nan')
-        self.logger = logger
+class DHT22(SensorThread[TempHumReading]):
+    led = 'red'
+    buffered = ('temperature', 'humidity')
+    # the DHT22 measures at most every 2 seconds
+    interval = 2.
+    min_interval = 2.
 
-    def run(self) -> None:
-        '''start thread and get values'''
-        while self.running:
-            try:
-                self.gps.update()
-                self.has_fix = self.gps.has_fix
-                if self.gps.satellites is not None:
-                    self.satellites = self.gps.satellites
-                else:
-                    self.satellites = float('nan')
-
-                if self.gps.latitude is not None:
-                    self.latitude = self.gps.latitude
-                else:
-                    self.latitude = float('nan')
-
-                if self.gps.longitude is not None:
-                    self.longitude = self.gps.longitude
-                else:
-                    self.longitude = float('nan')
-
-                if self.gps.altitude_m is not None:
-                    self.alt = self.gps.altitude_m
-                else:
-                    self.alt = float('nan')
-
-                if self.gps.speed_knots is not None:
-                    self.speed = self.gps.speed_knots
-                else:
-                    self.speed = float('nan')
-
-                if self.gps.timestamp_utc is not None:
-                    self.timestamp = time.strftime(
-                        '%Y-%m-%d %H:%M:%S',
-                        self.gps.timestamp_utc,
-                    )
-                if self.has_fix is True:
-                    update_led(green=True)
-            except Exception as e:
-                self.logger.warning(f'failed reading GPS: {e}')
-                continue
-            finally:
-                time.sleep(.1)
-                update_led(green=False)
-                time.sleep(.1)
+    def __init__(
+            self,
+            logger: logging.Logger,
+            device: Optional[Any] = None,
+    ) -> None:
+        super().__init__(
+            logger,
+            TempHumReading(0, time.monotonic(), float('nan'), float('nan')),
+        )
+        if device is None:
+            import adafruit_dht
+            import board
 
-    def stop(self) -> None:
-        '''close uart port when terminating'''
-        self.uart.close()
-        self.logger.info('closed GPS UART port')
+            device = adafruit_dht.DHT22(board.D4)
+        self.dht_22 = device
 
-    def __repr__(self) -> str:
-        return (
-            f'{type(self).__name__}('
-            f'uart={self.uart!r}, '
-            f'gps={self.gps!r}, '
-            f'running={self.running!r}, '
-            f'has_fix={self.has_fix!r}, '
-            f'latitude={self.latitude!r}, '
-            f'longitude={self.longitude!r}, '
-            f'satellites={self.satellites!r}, '
-            f'timestamp={self.timestamp!r}, '
-            f'alt={self.alt!r}, '
-            f'speed={self.speed!r}, '
-            f'logger={self.logger!r}'
-            ')'
+    def read(self, seq: int, timestamp: float) -> TempHumReading:
+        return TempHumReading(
+            seq=seq,
+            timestamp=timestamp,
+            temperature=_nan_if_none(self.dht_22.temperature),
+            humidity=_nan_if_none(self.dht_22.humidity),
         )
+
+    def indicate(self, reading: TempHumReading) -> bool:
+        # XXX: The DHT library kinda sucks, if the sensor throws
+        # errors, because it was disconnected, self._temperature
+        # stays at the old value so measurements remain the same
+        # this way the LED is kinda useless!
+        return reading.temperature == reading.temperature
+
+    def close(self) -> None:
+        self.dht_22.exit()
+
+
+class SHT85(SensorThread[TempHumReading]):
+    led = 'red'
+    buffered = ('temperature', 'humidity')
+
+    def __init__(
+            self,
+            logger: logging.Logger,
+            device: Optional[Any] = None,
+    ) -> None:
+        super().__init__(
+            logger,
+            TempHumReading(0, time.monotonic(), float('nan'), float('nan')),
+        )
+        if device is None:
+            from sensirion_i2c_driver import I2cConnection
+            from sensirion_i2c_driver.linux_i2c_transceiver import (
+                LinuxI2cTransceiver,
+            )
+            from sensirion_i2c_sht.sht3x import Sht3xI2cDevice
+
+            con = I2cConnection(LinuxI2cTransceiver('/dev/i2c-1'))
+            device = Sht3xI2cDevice(con)
+        self.sht_85 = device
+
+    def read(self, seq: int, timestamp: float) -> TempHumReading:
+        temp, hum = self.sht_85.single_shot_measurement()
+        return TempHumReading(
+            seq=seq,
+            timestamp=timestamp,
+            temperature=temp.degrees_celsius,
+            humidity=hum.percent_rh,
+        )
+
+
+class GPS(SensorThread[GPSReading]):
+    '''Adafruit Ultimate GPS (MTK3339) connected to the UART.
+
+    The receiver is configured to only send the RMC and GGA sentences,
+    ``rate`` times per second (up to 10 Hz). Above 1 Hz, 9600 baud are not
+    enough for this, so the baudrate is increased.
+
+    On every wakeup, all sentences waiting in the UART buffer are parsed and
+    every fix is published with the monotonic time it was received at. If
+    reading fails, the port is reopened for the next reading.
+
+    ``uart`` replaces the serial port opened at ``dev`` with 9600 baud, e.g.
+    by a simulated one.
+    '''
+    led = 'green'
+
+    def __init__(
+            self,
+            logger: logging.Logger,
+            rate: float = 1,
+            baudrate: Optional[int] = None,
+            dev: str = '/dev/ttyS0',
+            uart: Optional[SerialPort] = None,
+    ) -> None:
+        super().__init__(
+            logger,
+            GPSReading(
+                seq=0,
+                timestamp=time.monotonic(),
+                has_fix=False,
+                latitude=float('nan'),
+                longitude=float('nan'),
+                alt=float('nan'),
+                speed=float('nan'),
+                satellites=float('nan'),
+                gps_time='nan',
+                utc=float('nan'),
+            ),
+        )
+        if baudrate is None:
+            baudrate = 9600 if rate <= 1 else 115200
+        self.rate = rate
+        # wake up at least twice per fix
+        self.interval = min(self.interval, 1 / rate / 2)
+        # the format of gps_time, set to the format of the logfile
+        self.time_fmt = TIME_FMT
+        self.parser = NmeaParser()
+        # extrapolate for up to two missed fixes
+        self.history = FixHistory(max_extrapolation=2 / rate)
+        if uart is None:
+            import serial
+
+            # the receiver starts with 9600 baud after a cold start
+            uart = serial.Serial(dev, baudrate=9600, timeout=2)
+        self.uart = uart
+        if baudrate != 9600:
+            self.uart.write(set_baudrate(baudrate))
+            self.uart.flush()
+            time.sleep(.1)
+            self.uart.baudrate = baudrate
+            self.uart.reset_input_buffer()
+        self.uart.write(ONLY_RMC_GGA + set_fix_rate(rate))
+        self.uart.flush()
+
+    def _reading(self, seq: int, fix: Fix) -> GPSReading:
+        if fix.time is not None:
+            gps_time = fix.time.strftime(self.time_fmt)
+            utc = fix.time.replace(tzinfo=timezone.utc).timestamp()
+        else:
+            # keep the last known time
+            gps_time = self.snapshot.gps_time
+            utc = float('nan')
+
+        return GPSReading(
+            seq=seq,
+            timestamp=fix.received,
+            has_fix=fix.has_fix,
+            latitude=fix.latitude,
+            longitude=fix.longitude,
+            alt=fix.altitude,
+            speed=fix.speed,
+            satellites=fix.satellites,
+            gps_time=gps_time,
+            utc=utc,
+        )
+
+    def _publish(self, reading: GPSReading) -> None:
+        if reading.has_fix:
+            self.history.append(
+                reading.timestamp,
+                reading.latitude,
+                reading.longitude,
+                reading.alt,
+                reading.speed,
+                reading.utc,
+            )
+        super()._publish(reading)
+
+    def position_at(self, timestamp: float) -> Position:
+        '''the position interpolated to ``timestamp`` (``time.monotonic()``)
+        or the values of the latest reading if there is no fix'''
+        reading = self.snapshot
+        if not reading.has_fix:
+            return Position(
+                latitude=reading.latitude,
+                longitude=reading.longitude,
+                alt=reading.alt,
+                speed=reading.speed,
+                time=reading.utc,
+                age=float('nan'),
+            )
+        return self.history.at(timestamp)
+
+    def read(self, seq: int, timestamp: float) -> GPSReading:
+        fixes: list[Fix] = []
+        try:
+            if not self.uart.isOpen():
+                self.uart.open()
+                self.parser.reset()
+
+            while not fixes:
+                # block for at least one byte, then take all that is waiting
+                data = self.uart.read(max(self.uart.in_waiting, 1))
+                if not data:
+                    raise TimeoutError('no data received')
+                fixes = self.parser.feed(data, time.monotonic())
+        except OSError:
+            # e.g. the receiver was disconnected, serial errors are OSErrors
+            self.uart.close()
+            raise
+
+        # fixes that queued up are published as well, the newest is returned
+        for fix in fixes[:-1]:
+            self._publish(self._reading(seq, fix))
+            seq += 1
+        return self._reading(seq, fixes[-1])
+
+    def indicate(self, reading: GPSReading) -> bool:
+        return reading.has_fix
+
+    def close(self) -> None:
+        '''close uart port when terminating'''
+        self.uart.close()
+        self.logger.info(f'closed GPS UART port: {self.parser}')
@@ -0,0 +1,469 @@
+'''Simulated sensors, to run crowdbike without the hardware.
+
+The simulated devices replace the serial ports of the GPS and the SDS011
+and the drivers of the SHT85 and the DHT22, everything else runs as on the
+Raspberry Pi. They replay recordings or, if none is given, generated data,
+optionally faster than real time and with injected faults. The simulation
+is configured by the ``simulation`` section of ``config.json`` or by a JSON
+file the ``CROWDBIKE_SIMULATION`` environment variable points to::
+
+    {
+        "speed": 100,
+        "nmea": "ride.nmea",
+        "sds011": "sds011.bin",
+        "temp_hum": "temp_hum.csv",
+        "temp_hum_interval": 1,
+        "faults": {"garbage": 0.01, "stall": 0.001, "disconnect": 0.001},
+        "seed": 0
+    }
+
+All keys are optional. The NMEA and SDS011 recordings are raw byte streams
+as read from the ports (e.g. ``cat /dev/ttyS0 > ride.nmea``), the
+temperature and humidity are a csv file with the columns ``temperature``
+and ``humidity``, one row per ``temp_hum_interval`` seconds.
+'''
+from __future__ import annotations
+
+import csv
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections.abc import Sequence
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import NamedTuple
+from typing import Optional
+
+from crowdbike.nmea import command
+from crowdbike.sds011 import data_frame
+from crowdbike.sds011 import HEADER
+
+ENV_VAR = 'CROWDBIKE_SIMULATION'
+
+
+class Faults(NamedTuple):
+    '''probabilities of the faults, per chunk of data or per reading'''
+    # random bytes inserted into the stream
+    garbage: float = 0
+    # a chunk that is lost
+    drop: float = 0
+    # no data for ``stall_seconds`` (real time), so reading times out
+    stall: float = 0
+    stall_seconds: float = 6
+    # the device disappears, reading raises until the port is reopened
+    disconnect: float = 0
+    # a failed reading of the temperature and humidity sensor
+    error: float = 0
+
+
+class SimulatedSerial:
+    '''A serial port replaying a recorded stream.
+
+    The stream is split into ``chunks`` (e.g. one GPS epoch or one SDS011
+    frame), one of them becomes available every ``interval / speed``
+    seconds. After the last one, the recording starts over. Only the parts
+    of the ``serial.Serial`` interface crowdbike uses are implemented, the
+    bytes that are written are kept in :attr:`written`.
+    '''
+
+    def __init__(
+            self,
+            chunks: Sequence[bytes],
+            interval: float,
+            *,
+            speed: float = 1,
+            faults: Faults = Faults(),
+            port: Optional[str] = None,
+            baudrate: int = 9600,
+            timeout: Optional[float] = None,
+            seed: Optional[int] = None,
+    ) -> None:
+        if not chunks:
+            raise ValueError('the recording is empty')
+        self.chunks = chunks
+        self.interval = interval
+        self.speed = speed
+        self.faults = faults
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.written: list[bytes] = []
+        self._random = random.Random(seed)
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+        self._released = 0
+        self._start = 0.
+        self._disconnected = False
+        self.is_open = False
+        self.port = port
+        if port is not None:
+            # as serial.Serial, the port is opened if it is given
+            self.open()
+
+    def open(self) -> None:
+        if self.is_open:
+            raise OSError('port is already open')
+        self.is_open = True
+        self._disconnected = False
+        self._buf.clear()
+        # continue the recording where it stopped
+        self._start = (
+            time.monotonic() - self._released * self.interval / self.speed
+        )
+
+    def isOpen(self) -> bool:
+        return self.is_open
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def _check_open(self) -> None:
+        if not self.is_open:
+            raise OSError('attempting to use a port that is not open')
+
+    def _next_release(self) -> float:
+        '''the monotonic time the next chunk becomes available at'''
+        return self._start + self._released * self.interval / self.speed
+
+    def _release(self) -> None:
+        '''make the chunks that are due available'''
+        faults = self.faults
+        rnd = self._random
+        now = time.monotonic()
+        while not self._disconnected and self._next_release() <= now:
+            chunk = self.chunks[self._released % len(self.chunks)]
+            self._released += 1
+            if rnd.random() < faults.drop:
+                continue
+            if rnd.random() < faults.garbage:
+                pos = rnd.randrange(len(chunk) + 1)
+                garbage = rnd.randbytes(rnd.randint(1, 16))
+                chunk = chunk[:pos] + garbage + chunk[pos:]
+            self._buf += chunk
+            if rnd.random() < faults.stall:
+                self._start += faults.stall_seconds
+            if rnd.random() < faults.disconnect:
+                self._disconnected = True
+
+    @property
+    def in_waiting(self) -> int:
+        with self._lock:
+            self._check_open()
+            self._release()
+            return len(self._buf)
+
+    def read(self, size: int = 1) -> bytes:
+        '''block until ``size`` bytes are available or the timeout'''
+        deadline = (
+            math.inf if self.timeout is None
+            else time.monotonic() + self.timeout
+        )
+        while True:
+            with self._lock:
+                self._check_open()
+                self._release()
+                if self._disconnected and not self._buf:
+                    self.is_open = False
+                    raise OSError('device disconnected')
+                now = time.monotonic()
+                if len(self._buf) >= size or now >= deadline:
+                    data = bytes(self._buf[:size])
+                    del self._buf[:size]
+                    return data
+                wait = min(self._next_release(), deadline) - now
+            time.sleep(max(wait, 0))
+
+    def write(self, data: bytes) -> int:
+        self._check_open()
+        self.written.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        self._check_open()
+
+    def reset_input_buffer(self) -> None:
+        with self._lock:
+            self._buf.clear()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'port={self.port!r}, '
+            f'open={self.is_open!r}, '
+            f'released={self._released!r}, '
+            f'speed={self.speed!r}'
+            ')'
+        )
+
+
+class _Series:
+    '''a replayed series of temperature and humidity'''
+
+    def __init__(
+            self,
+            series: Sequence[tuple[float, float]],
+            interval: float,
+            speed: float,
+            faults: Faults,
+            seed: Optional[int],
+    ) -> None:
+        if not series:
+            raise ValueError('the recording is empty')
+        self.series = series
+        self.interval = interval
+        self.speed = speed
+        self.faults = faults
+        self._random = random.Random(seed)
+        self._start = time.monotonic()
+
+    def failed(self) -> bool:
+        return self._random.random() < self.faults.error
+
+    def value(self) -> tuple[float, float]:
+        elapsed = (time.monotonic() - self._start) * self.speed
+        return self.series[int(elapsed / self.interval) % len(self.series)]
+
+
+class Temperature(NamedTuple):
+    degrees_celsius: float
+
+
+class Humidity(NamedTuple):
+    percent_rh: float
+
+
+class SimulatedSht3x(_Series):
+    '''replaces ``sensirion_i2c_sht.sht3x.Sht3xI2cDevice``'''
+
+    def single_shot_measurement(self) -> tuple[Temperature, Humidity]:
+        if self.failed():
+            raise OSError('I2C transfer failed')
+        temp, hum = self.value()
+        return Temperature(temp), Humidity(hum)
+
+
+class SimulatedDHT22(_Series):
+    '''replaces ``adafruit_dht.DHT22``'''
+
+    @property
+    def temperature(self) -> Optional[float]:
+        if self.failed():
+            # as the driver, which often fails reading the sensor
+            raise RuntimeError('Checksum did not validate. Try again.')
+        return self.value()[0]
+
+    @property
+    def humidity(self) -> Optional[float]:
+        return self.value()[1]
+
+    def exit(self) -> None:
+        pass
+
+
+def _dm(value: float, width: int) -> str:
+    '''decimal degrees to ``dddmm.mmmm``'''
+    degrees = int(abs(value))
+    minutes = (abs(value) - degrees) * 60
+    return f'{degrees:0{width}d}{minutes:07.4f}'
+
+
+def synthetic_nmea(seconds: int, rate: float = 10) -> bytes:
+    '''a ride at ~20 km/h, with GGA, GSA, GSV and RMC every epoch'''
+    log = bytearray()
+    start = datetime(2024, 6, 1, 12, 0, 0)
+    per_second = max(round(rate), 1)
+    for i in range(round(seconds * rate)):
+        t = start + timedelta(seconds=i / rate)
+        hhmmss = f'{t:%H%M%S}.{t.microsecond // 1000:03d}'
+        lat = 51.4440 + i * 1e-6 * math.cos(i / 500)
+        lon = 7.2600 + i * 1e-6 * math.sin(i / 500)
+        lat_s, lon_s = _dm(lat, 2), _dm(lon, 3)
+        log += command(
+            f'GPGGA,{hhmmss},{lat_s},N,{lon_s},E,1,9,0.92,'
+            f'{110 + math.sin(i / 100):.1f},M,47.0,M,,',
+        )
+        log += command('GPGSA,A,3,10,07,05,02,29,04,08,13,16,1.72,1.03,1.38')
+        if i % per_second == 0:
+            log += command(
+                'GPGSV,3,1,11,10,63,137,17,07,61,098,15,05,59,290,20,08,54,'
+                '157,30',
+            )
+            log += command(
+                'GPGSV,3,2,11,02,39,223,19,13,28,070,17,26,23,252,,04,14,'
+                '186,14',
+            )
+            log += command('GPGSV,3,3,11,29,09,301,24,16,09,020,,36,,,')
+        log += command(
+            f'GPRMC,{hhmmss},A,{lat_s},N,{lon_s},E,10.80,'
+            f'{i / 10 % 360:.2f},{t:%d%m%y},,,A',
+        )
+    return bytes(log)
+
+
+def synthetic_sds011(frames: int, seed: Optional[int] = None) -> bytes:
+    '''slowly varying particulate matter concentrations'''
+    rnd = random.Random(seed)
+    return b''.join(
+        data_frame(
+            pm2_5=round(8 + 4 * math.sin(i / 60) + rnd.random(), 1),
+            pm10=round(15 + 6 * math.sin(i / 60) + rnd.random() * 2, 1),
+        )
+        for i in range(frames)
+    )
+
+
+def synthetic_temp_hum(
+        readings: int,
+        seed: Optional[int] = None,
+) -> list[tuple[float, float]]:
+    '''a slow daily cycle with some noise'''
+    rnd = random.Random(seed)
+    series = []
+    for i in range(readings):
+        cycle = math.sin(i / readings * 2 * math.pi)
+        series.append((
+            round(18 + 6 * cycle + rnd.gauss(0, .1), 2),
+            round(60 - 15 * cycle + rnd.gauss(0, .5), 2),
+        ))
+    return series
+
+
+def nmea_epochs(stream: bytes) -> list[bytes]:
+    '''split an NMEA stream after every RMC sentence, the end of an epoch'''
+    epochs = []
+    start = end = 0
+    for line in stream.splitlines(keepends=True):
+        end += len(line)
+        # e.g. $GPRMC or $GNRMC
+        if line[3:7] == b'RMC,':
+            epochs.append(stream[start:end])
+            start = end
+    if start < len(stream):
+        epochs.append(stream[start:])
+    return epochs
+
+
+def sds011_frames(stream: bytes) -> list[bytes]:
+    '''split a SDS011 stream before every header'''
+    starts = []
+    pos = stream.find(HEADER)
+    while pos >= 0:
+        starts.append(pos)
+        pos = stream.find(HEADER, pos + 1)
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return [
+        stream[start:end]
+        for start, end in zip(starts, starts[1:] + [len(stream)])
+        if start < end
+    ]
+
+
+def load_temp_hum(path: str) -> list[tuple[float, float]]:
+    with open(path, newline='') as f:
+        return [
+            (float(row['temperature']), float(row['humidity']))
+            for row in csv.DictReader(f)
+        ]
+
+
+def _read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Simulation:
+    '''Create the simulated devices from the ``simulation`` configuration.
+
+    Every device gets its own random generator, derived from ``seed``, so a
+    simulation with the same configuration injects the same faults.
+    '''
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.config = config
+        self.speed: float = config.get('speed', 1)
+        self.faults = Faults(**config.get('faults', {}))
+        self.seed: Optional[int] = config.get('seed')
+        self._devices = 0
+
+    def _seed(self) -> Optional[int]:
+        self._devices += 1
+        return None if self.seed is None else self.seed + self._devices
+
+    def gps_uart(
+            self,
+            rate: float,
+            port: str,
+            baudrate: int,
+            timeout: float,
+    ) -> SimulatedSerial:
+        path = self.config.get('nmea')
+        stream = _read(path) if path else synthetic_nmea(600, rate)
+        return SimulatedSerial(
+            nmea_epochs(stream),
+            1 / rate,
+            speed=self.speed,
+            faults=self.faults,
+            port=port,
+            baudrate=baudrate,
+            timeout=timeout,
+            seed=self._seed(),
+        )
+
+    def pm_serial(self, baudrate: int, timeout: float) -> SimulatedSerial:
+        path = self.config.get('sds011')
+        stream = _read(path) if path else synthetic_sds011(600, self.seed)
+        return SimulatedSerial(
+            sds011_frames(stream),
+            1,
+            speed=self.speed,
+            faults=self.faults,
+            baudrate=baudrate,
+            timeout=timeout,
+            seed=self._seed(),
+        )
+
+    def _temp_hum(self) -> tuple[list[tuple[float, float]], float]:
+        path = self.config.get('temp_hum')
+        if path:
+            series = load_temp_hum(path)
+        else:
+            series = synthetic_temp_hum(3600, self.seed)
+        return series, self.config.get('temp_hum_interval', 1)
+
+    def sht3x(self) -> SimulatedSht3x:
+        series, interval = self._temp_hum()
+        return SimulatedSht3x(
+            series, interval, self.speed, self.faults, self._seed(),
+        )
+
+    def dht22(self) -> SimulatedDHT22:
+        series, interval = self._temp_hum()
+        return SimulatedDHT22(
+            series, interval, self.speed, self.faults, self._seed(),
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'speed={self.speed!r}, '
+            f'faults={self.faults!r}, '
+            f'seed={self.seed!r}'
+            ')'
+        )
+
+
+def from_config(config: dict[str, Any]) -> Optional[Simulation]:
+    '''the simulation if one is configured, the environment variable takes
+    precedence over ``config.json``'''
+    path = os.environ.get(ENV_VAR)
+    if path:
+        with open(path) as f:
+            return Simulation(json.load(f))
+    section = config.get('simulation')
+    if section is None:
+        return None
+    return Simulation(section)
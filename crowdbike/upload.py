@@ -0,0 +1,626 @@
+'''Upload logfiles to the public WebDAV endpoint of a Nextcloud share.'''
+from __future__ import annotations
+
+import base64
+import http.client
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from collections.abc import Callable
+from collections.abc import Iterator
+from collections.abc import Sequence
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import BinaryIO
+from typing import NamedTuple
+
+from crowdbike.manifest import file_info
+from crowdbike.manifest import PARTIAL
+from crowdbike.manifest import RECORDED
+from crowdbike.manifest import UPLOADED
+from crowdbike.manifest import UploadManifest
+from crowdbike.metrics import metrics
+
+# file extensions of logfiles that are uploaded
+UPLOAD_EXTENSIONS = frozenset(('.csv', '.cbin'))
+# status codes worth retrying, all other errors fail the file immediately
+_RETRY_STATUS = frozenset((408, 429, 500, 502, 503, 504))
+_BLOCKSIZE = 64 * 1024
+# error of files that were skipped, because the upload was cancelled
+CANCELLED = 'cancelled'
+# supported compressions and the file extension they add
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+# the server does not support chunked uploads (for public shares)
+_NO_CHUNKING_STATUS = frozenset((404, 405, 501))
+
+
+class UploadError(Exception):
+    def __init__(
+            self,
+            msg: str,
+            retry: bool = True,
+            status: int | None = None,
+    ) -> None:
+        super().__init__(msg)
+        self.retry = retry
+        self.status = status
+
+
+class UploadResult(NamedTuple):
+    path: str
+    ok: bool
+    attempts: int
+    nbytes: int
+    error: str | None = None
+
+
+def iter_compressed(f: BinaryIO, compression: str) -> Iterator[bytes]:
+    '''read and compress a file chunk by chunk'''
+    compressor: Any
+    if compression == 'gzip':
+        # wbits=31 writes the gzip container
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                'zstd compression requires the zstandard package, install it '
+                'using: pip install crowdbike[zstd]',
+            )
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    else:
+        raise ValueError(
+            f'compression must be one of {", ".join(COMPRESSIONS)}',
+        )
+
+    for chunk in iter(lambda: f.read(_BLOCKSIZE), b''):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_file(path: str, dest: str, compression: str) -> None:
+    '''compress a file, ``dest`` is only created once it is complete'''
+    tmp = f'{dest}.part'
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        for data in iter_compressed(src, compression):
+            dst.write(data)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, dest)
+
+
+class WebDavUploader:
+    '''Upload files with a small pool of workers.
+
+    Every worker keeps its own keep-alive connection to the server, so the
+    TLS handshake is only done once per worker and not once per file. Failed
+    uploads are retried with an exponential backoff. A file is moved to the
+    archive directory only after it was uploaded successfully, a failed file
+    does not stop the upload of the others.
+
+    With ``compression``, files are compressed while they are sent, without
+    creating a compressed copy first. The remote file name gets the extension
+    of the compression. With ``archive_compression``, files are compressed
+    when they are moved to the archive.
+    '''
+
+    def __init__(
+            self,
+            base_url: str,
+            folder_token: str,
+            passwd: str,
+            logger: logging.Logger,
+            *,
+            workers: int = 2,
+            retries: int = 3,
+            backoff: float = 1,
+            timeout: float = 30,
+            compression: str = 'none',
+            archive_compression: str = 'none',
+            chunk_size: int = 10 * 1024 * 1024,
+            manifest: UploadManifest | None = None,
+            verbose: bool = False,
+    ) -> None:
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError(f'invalid base_url: {base_url!r}')
+        for c in (compression, archive_compression):
+            if c not in COMPRESSIONS:
+                raise ValueError(
+                    f'compression must be one of {", ".join(COMPRESSIONS)}',
+                )
+
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        # we need a trailing slash for the url to be valid
+        root = url.path.rstrip('/')
+        self.dav_path = f'{root}/public.php/webdav/'
+        self.uploads_path = f'{root}/public.php/dav/uploads/{folder_token}/'
+        netloc = self.host if self.port is None else f'{self.host}:{self.port}'
+        # the ``Destination`` of the chunked upload must be an absolute url
+        self.files_url = (
+            f'{url.scheme}://{netloc}{root}/public.php/dav/files/'
+            f'{folder_token}/'
+        )
+        self.logger = logger
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.compression = compression
+        self.archive_compression = archive_compression
+        self.chunk_size = chunk_size
+        self.manifest = manifest
+        self.verbose = verbose
+        # set to ``False`` once the server rejected a chunked upload
+        self.chunking = True
+        credentials = base64.b64encode(f'{folder_token}:{passwd}'.encode())
+        self.headers = {
+            'Authorization': f'Basic {credentials.decode()}',
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        self._local = threading.local()
+        self._connections: list[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        '''get the keep-alive connection of the current worker thread'''
+        conn: http.client.HTTPConnection | None = getattr(
+            self._local, 'conn', None,
+        )
+        if conn is None:
+            if self.scheme == 'https':
+                conn = http.client.HTTPSConnection(
+                    self.host, self.port, timeout=self.timeout,
+                    blocksize=_BLOCKSIZE,
+                )
+            else:
+                conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout,
+                    blocksize=_BLOCKSIZE,
+                )
+            if self.verbose:
+                conn.set_debuglevel(1)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _reset_connection(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def request(
+            self,
+            method: str,
+            path: str,
+            body: Any = None,
+            headers: dict[str, str] | None = None,
+    ) -> http.client.HTTPResponse:
+        '''send a request to the server and read the response'''
+        conn = self._connection()
+        try:
+            conn.request(
+                method,
+                urllib.parse.quote(path),
+                body=body,
+                headers={**self.headers, **(headers or {})},
+            )
+            resp = conn.getresponse()
+            # the body must be consumed before the connection can be reused
+            resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            self._reset_connection()
+            raise UploadError(f'{type(e).__name__}: {e}') from e
+
+        if resp.will_close:
+            self._reset_connection()
+        if resp.status >= 300:
+            raise UploadError(
+                f'{method} {path} failed: {resp.status} {resp.reason}',
+                retry=resp.status in _RETRY_STATUS,
+                status=resp.status,
+            )
+        return resp
+
+    def _entry(self, path: str) -> dict[str, Any] | None:
+        '''get the manifest entry of a file, if it still matches the file'''
+        if self.manifest is None:
+            return None
+        entry = self.manifest.get(os.path.basename(path))
+        if entry is None:
+            return None
+        size, mtime_ns = file_info(path)
+        if entry.get('size') != size or entry.get('mtime_ns') != mtime_ns:
+            return None
+        return entry
+
+    def _checksum(self, entry: dict[str, Any] | None) -> dict[str, str]:
+        '''header to let the server verify the uncompressed content'''
+        if (
+                entry is None or
+                'sha256' not in entry or
+                self.compression != 'none'
+        ):
+            return {}
+        return {'OC-Checksum': f'SHA256:{entry["sha256"]}'}
+
+    def put(
+            self,
+            path: str,
+            remote_name: str,
+            entry: dict[str, Any] | None = None,
+    ) -> int:
+        '''upload a single file, returns the number of bytes sent
+
+        :param entry: the manifest entry of the file
+        '''
+        if self.chunking and os.path.getsize(path) > self.chunk_size:
+            try:
+                return self.put_chunked(path, remote_name, entry)
+            except UploadError as e:
+                if (
+                        e.status not in _NO_CHUNKING_STATUS or
+                        entry is not None and entry.get('state') == PARTIAL
+                ):
+                    raise
+                self.logger.info(
+                    f'chunked uploads are not supported ({e}), uploading '
+                    f'files in a single request',
+                )
+                self.chunking = False
+
+        remote_path = f'{self.dav_path}{remote_name}'
+        with open(path, 'rb') as f:
+            if self.compression == 'none':
+                size = os.path.getsize(path)
+                self.request(
+                    'PUT',
+                    remote_path,
+                    body=f,
+                    headers={
+                        'Content-Length': str(size),
+                        **self._checksum(entry),
+                    },
+                )
+                return size
+
+            sent = 0
+
+            def _count(chunks: Iterator[bytes]) -> Iterator[bytes]:
+                nonlocal sent
+                for chunk in chunks:
+                    sent += len(chunk)
+                    yield chunk
+
+            # without a Content-Length, the body is sent chunked
+            self.request(
+                'PUT',
+                f'{remote_path}{COMPRESSIONS[self.compression]}',
+                body=_count(iter_compressed(f, self.compression)),
+            )
+            return sent
+
+    def _iter_chunks(self, path: str, skip: int) -> Iterator[bytes]:
+        '''read the (compressed) file in chunks, skipping the first ones'''
+        with open(path, 'rb') as f:
+            if self.compression == 'none':
+                f.seek(skip * self.chunk_size)
+                yield from iter(lambda: f.read(self.chunk_size), b'')
+                return
+
+            # compression is deterministic, so the same chunks are created
+            # again when resuming, but only the missing ones are sent
+            buf = bytearray()
+            index = 0
+            for data in iter_compressed(f, self.compression):
+                buf += data
+                while len(buf) >= self.chunk_size:
+                    if index >= skip:
+                        yield bytes(buf[:self.chunk_size])
+                    del buf[:self.chunk_size]
+                    index += 1
+            if buf and index >= skip:
+                yield bytes(buf)
+
+    def put_chunked(
+            self,
+            path: str,
+            remote_name: str,
+            entry: dict[str, Any] | None = None,
+    ) -> int:
+        '''upload a file in chunks, resuming a previous partial upload
+
+        :param entry: the manifest entry of the file
+        '''
+        name = os.path.basename(path)
+        destination = (
+            f'{self.files_url}'
+            f'{urllib.parse.quote(remote_name)}'
+            f'{COMPRESSIONS[self.compression]}'
+        )
+        headers = {'Destination': destination}
+        if self.compression == 'none':
+            headers['OC-Total-Length'] = str(os.path.getsize(path))
+
+        if (
+                entry is not None and
+                entry.get('state') == PARTIAL and
+                entry.get('chunk_size') == self.chunk_size and
+                entry.get('compression') == self.compression
+        ):
+            resumed = True
+            upload_id = entry['upload_id']
+            done = entry['chunks']
+            self.logger.info(f'resuming upload of {name} at chunk {done + 1}')
+        else:
+            resumed = False
+            upload_id = f'crowdbike-{uuid.uuid4().hex}'
+            done = 0
+            self.request(
+                'MKCOL', f'{self.uploads_path}{upload_id}', headers=headers,
+            )
+            if self.manifest is not None:
+                size, mtime_ns = file_info(path)
+                self.manifest.update(
+                    name,
+                    state=PARTIAL,
+                    size=size,
+                    mtime_ns=mtime_ns,
+                    upload_id=upload_id,
+                    chunks=0,
+                    chunk_size=self.chunk_size,
+                    compression=self.compression,
+                )
+
+        sent = 0
+        try:
+            for index, chunk in enumerate(
+                    self._iter_chunks(path, skip=done), start=done + 1,
+            ):
+                # chunks are assembled in the order of their names
+                self.request(
+                    'PUT',
+                    f'{self.uploads_path}{upload_id}/{index:05d}',
+                    body=chunk,
+                    headers={**headers, 'Content-Length': str(len(chunk))},
+                )
+                sent += len(chunk)
+                if self.manifest is not None:
+                    self.manifest.update(name, chunks=index)
+
+            self.request(
+                'MOVE',
+                f'{self.uploads_path}{upload_id}/.file',
+                headers={**headers, **self._checksum(entry)},
+            )
+        except UploadError as e:
+            if e.status == 404 and resumed and self.manifest is not None:
+                # the server discarded the partial upload, start over
+                self.manifest.update(name, state=RECORDED, chunks=0)
+                raise UploadError(f'{e}, restarting the upload') from e
+            raise
+        return sent
+
+    def archive(self, path: str, archive_dir: str) -> None:
+        '''move an uploaded file to the archive, compressing it if needed'''
+        if self.archive_compression == 'none':
+            shutil.move(path, archive_dir)
+        else:
+            name = (
+                f'{os.path.basename(path)}'
+                f'{COMPRESSIONS[self.archive_compression]}'
+            )
+            compress_file(
+                path,
+                os.path.join(archive_dir, name),
+                self.archive_compression,
+            )
+            os.remove(path)
+
+    def upload_file(
+            self,
+            path: str,
+            archive_dir: str,
+            cancel: threading.Event | None = None,
+    ) -> UploadResult:
+        '''upload a file with retries and move it to the archive'''
+        name = os.path.basename(path)
+        attempt = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                return UploadResult(path, False, attempt, 0, CANCELLED)
+
+            attempt += 1
+            try:
+                entry = self._entry(path)
+                if entry is not None and entry.get('state') == UPLOADED:
+                    # only the archiving failed last time
+                    nbytes = 0
+                else:
+                    nbytes = self.put(path, name, entry)
+                    if self.manifest is not None:
+                        size, mtime_ns = file_info(path)
+                        self.manifest.update(
+                            name,
+                            state=UPLOADED,
+                            size=size,
+                            mtime_ns=mtime_ns,
+                        )
+                self.archive(path, archive_dir)
+                if self.manifest is not None:
+                    self.manifest.remove(name)
+                self.logger.info(f'uploaded {name} ({nbytes} bytes)')
+                return UploadResult(path, True, attempt, nbytes)
+            except UploadError as e:
+                if not e.retry or attempt > self.retries:
+                    self.logger.warning(f'failed uploading {name}: {e}')
+                    return UploadResult(path, False, attempt, 0, str(e))
+
+                delay = self.backoff * 2 ** (attempt - 1)
+                self.logger.info(
+                    f'uploading {name} failed ({e}), retrying in {delay}s',
+                )
+                if cancel is not None:
+                    cancel.wait(delay)
+                else:
+                    time.sleep(delay)
+            except OSError as e:
+                # e.g. the file could not be read or moved
+                self.logger.warning(f'failed uploading {name}: {e}')
+                return UploadResult(path, False, attempt, 0, str(e))
+
+    def _timed_upload(
+            self,
+            path: str,
+            archive_dir: str,
+            cancel: threading.Event | None,
+    ) -> UploadResult:
+        start = time.perf_counter()
+        result = self.upload_file(path, archive_dir, cancel)
+        if result.error != CANCELLED:
+            metrics.upload(
+                result.nbytes, time.perf_counter() - start, result.ok,
+            )
+        return result
+
+    def upload(
+            self,
+            paths: Sequence[str],
+            archive_dir: str,
+            progress: Callable[[int, int, UploadResult], None] | None = None,
+            cancel: threading.Event | None = None,
+    ) -> list[UploadResult]:
+        '''upload multiple files in parallel
+
+        :param progress: called with the number of finished files, the total
+            number of files and the result of the last finished file
+        :param cancel: once set, files that are not being uploaded yet are
+            skipped and reported as cancelled
+        '''
+        os.makedirs(archive_dir, exist_ok=True)
+        results = []
+        with ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix='upload',
+        ) as executor:
+            futures = [
+                executor.submit(self._timed_upload, p, archive_dir, cancel)
+                for p in paths
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if progress is not None:
+                    progress(len(results), len(paths), result)
+        self.close()
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'url={self.scheme}://{self.host}:{self.port}{self.dav_path}, '
+            f'workers={self.workers!r}, '
+            f'retries={self.retries!r}, '
+            f'compression={self.compression!r}, '
+            f'chunk_size={self.chunk_size!r}'
+            ')'
+        )
+
+
+def pending_files(log_dir: str) -> list[str]:
+    '''list the logfiles in ``log_dir`` that have not been uploaded yet
+
+    The logfile that is being recorded is named ``*.part`` until it is
+    closed, so it is not listed.
+    '''
+    return sorted(
+        os.path.join(log_dir, f)
+        for f in os.listdir(log_dir)
+        if (
+            os.path.splitext(f)[1].lower() in UPLOAD_EXTENSIONS and
+            os.path.isfile(os.path.join(log_dir, f))
+        )
+    )
+
+
+def upload_to_cloud(
+        verbose: bool,
+        config: dict[str, Any],
+        logger: logging.Logger,
+        *,
+        progress: Callable[[int, int, UploadResult], None] | None = None,
+        cancel: threading.Event | None = None,
+) -> list[UploadResult]:
+    '''upload all pending logfiles and return the result per file
+
+    This blocks until all files are uploaded, use ``progress`` and ``cancel``
+    to follow and stop the upload from another thread.
+    '''
+    log_dir = config['user']['logfile_path']
+    archive_dir = os.path.join(log_dir, 'archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    files = pending_files(log_dir)
+
+    if not files:
+        nothing_to_do = (
+            f'Everything up to date. '
+            f'There are no files to upload in "{log_dir}"'
+        )
+        logger.info(nothing_to_do)
+        print(nothing_to_do)
+        return []
+
+    def _progress(done: int, total: int, result: UploadResult) -> None:
+        name = os.path.basename(result.path)
+        if result.ok:
+            status = f'uploaded: {name} to the cloud ({done}/{total})'
+        else:
+            status = f'failed uploading: {name} ({done}/{total})'
+        print(status)
+        if progress is not None:
+            progress(done, total, result)
+
+    uploader = WebDavUploader(
+        base_url=config['cloud']['base_url'],
+        folder_token=config['cloud']['folder_token'],
+        passwd=config['cloud']['passwd'],
+        logger=logger,
+        workers=config['cloud'].get('upload_workers', 2),
+        retries=config['cloud'].get('upload_retries', 3),
+        timeout=config['cloud'].get('upload_timeout', 30),
+        compression=config['cloud'].get('compression', 'none'),
+        archive_compression=config['cloud'].get('archive_compression', 'none'),
+        chunk_size=config['cloud'].get('upload_chunk_size', 10 * 1024 * 1024),
+        manifest=UploadManifest.for_dir(log_dir),
+        verbose=verbose,
+    )
+    logger.info(f'uploading {len(files)} files using {uploader!r}')
+    results = uploader.upload(
+        files, archive_dir, progress=_progress, cancel=cancel,
+    )
+    for r in results:
+        if not r.ok and r.error != CANCELLED:
+            logger.warning(' error '.center(79, '='))
+            print(' error '.center(79, '='))
+            logger.warning(f'{r.path}: {r.error}')
+            print(f'{r.path}: {r.error}')
+    return results
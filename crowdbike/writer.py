@@ -0,0 +1,610 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable
+from collections.abc import Sequence
+from typing import BinaryIO
+from typing import NamedTuple
+from typing import TYPE_CHECKING
+
+from crowdbike.manifest import sha256_file
+from crowdbike.manifest import UploadManifest
+
+if TYPE_CHECKING:
+    from crowdbike.binlog import BinaryLogWriter
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+# used for sampling rates below one second
+PRECISE_TIME_FMT = '%Y-%m-%d %H:%M:%S.%f'
+CNAMES = (
+    'id',
+    'record',
+    'raspberry_time',
+    'gps_time',
+    'altitude',
+    'latitude',
+    'longitude',
+    'speed',
+    'temperature',
+    'temperature_raw',
+    'rel_humidity',
+    'rel_humidity_raw',
+    'vapour_pressure',
+    'pm10',
+    'pm2_5',
+    'mac',
+    'sensor_id',
+    'software_version',
+)
+
+# formatting of the measured values, must match the order of ``Sample``
+_SAMPLE_FMT = '{},{},{:.3f},{:.6f},{:.6f},{:.1f},{},{},{},{},{},{},{}'
+
+# file extension of the supported logfile formats
+LOG_FORMATS = {'csv': '.csv', 'binary': '.cbin'}
+FSYNC_POLICIES = ('always', 'interval', 'never')
+# appended to the name of a logfile that is still being written
+PART_SUFFIX = '.part'
+# wall-clock intervals a new logfile can be started at in seconds
+ROTATE_INTERVALS = {'hourly': 3600, 'daily': 86400}
+
+
+class Sample(NamedTuple):
+    '''the measured values of a single row in the logfile'''
+    raspberry_time: str
+    gps_time: str
+    altitude: float
+    latitude: float
+    longitude: float
+    speed: float
+    temperature: float
+    temperature_raw: float
+    rel_humidity: float
+    rel_humidity_raw: float
+    vapour_pressure: float
+    pm10: float
+    pm2_5: float
+    # values of the optional ``extra_columns`` of the logfile
+    extra: tuple[float, ...] = ()
+
+
+class LogWriter:
+    '''Append measurement rows to a csv logfile.
+
+    The file is opened once and kept open until :meth:`close` is called. The
+    record counter is kept in memory, so writing a row does not depend on the
+    size of the file. When appending to an existing file, the counter is
+    resumed from the last row of that file.
+
+    Rows are buffered, call :meth:`flush` or :meth:`sync` to commit them.
+
+    The sha256 of the file is updated with every row. If a ``manifest`` is
+    passed, the file is added to it on :meth:`close`, so the upload does not
+    have to read the file again.
+
+    ``extra_columns`` (name and number of decimals) are appended after the
+    default columns, their values are passed as ``Sample.extra``.
+    '''
+
+    def __init__(
+            self,
+            path: str,
+            *,
+            pi_id: str,
+            mac: str,
+            sensor_id: str,
+            version: str,
+            manifest: UploadManifest | None = None,
+            extra_columns: Sequence[tuple[str, int]] = (),
+    ) -> None:
+        self.path = path
+        self.manifest = manifest
+        self.extra_columns = tuple(extra_columns)
+        self.counter = 0
+        # the constant columns are formatted only once
+        self._prefix = f'{pi_id},'
+        self._suffix = f',{mac},{sensor_id},{version}'
+        self._extra_fmt = ''.join(f',{{:.{d}f}}' for _, d in extra_columns)
+        self._f: BinaryIO | None = None
+        self._hash = hashlib.sha256()
+        # size of the file in bytes
+        self.size = 0
+
+    def open(self) -> None:
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+            self.counter = _resume_counter(
+                self.path, len(CNAMES) + len(self.extra_columns),
+            )
+            self._hash = sha256_file(self.path)
+            self.size = os.path.getsize(self.path)
+            self._f = open(self.path, 'ab')
+            # terminate an incomplete last row e.g. after a power loss
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._write(b'\n')
+        else:
+            self.counter = 0
+            self._hash = hashlib.sha256()
+            self.size = 0
+            self._f = open(self.path, 'wb')
+            names = (*CNAMES, *(name for name, _ in self.extra_columns))
+            self._write(f"{','.join(names)}\n".encode())
+
+    @property
+    def sha256(self) -> str:
+        '''hex digest of everything written to the file so far'''
+        return self._hash.hexdigest()
+
+    def _write(self, data: bytes) -> None:
+        assert self._f is not None
+        self._f.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def _format(self, sample: Sample) -> str:
+        if len(sample.extra) != len(self.extra_columns):
+            raise ValueError(
+                f'expected {len(self.extra_columns)} extra values, got '
+                f'{len(sample.extra)}',
+            )
+        record = self.counter
+        self.counter += 1
+        return (
+            f'{self._prefix}{record},'
+            f'{_SAMPLE_FMT.format(*sample[:-1])}{self._suffix}'
+            f'{self._extra_fmt.format(*sample.extra)}\n'
+        )
+
+    def write(self, sample: Sample) -> int:
+        '''write a row and return the record number it was written with'''
+        if self._f is None:
+            raise ValueError(f'logfile {self.path!r} is not open')
+
+        self._write(self._format(sample).encode())
+        return self.counter - 1
+
+    def write_many(self, samples: Sequence[Sample]) -> None:
+        '''write multiple rows with a single call to the file object'''
+        if self._f is None:
+            raise ValueError(f'logfile {self.path!r} is not open')
+
+        self._write(''.join([self._format(s) for s in samples]).encode())
+
+    def flush(self) -> None:
+        '''hand all buffered rows over to the OS'''
+        if self._f is not None:
+            self._f.flush()
+
+    def sync(self) -> None:
+        '''flush and force the OS to write the rows to the storage'''
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            if self.manifest is not None:
+                self.manifest.record(self.path, self.sha256)
+
+    def __enter__(self) -> LogWriter:
+        self.open()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'path={self.path!r}, '
+            f'counter={self.counter!r}'
+            ')'
+        )
+
+
+class RotatingLogWriter:
+    '''Split the rows into multiple logfiles (segments).
+
+    A new segment is started once the current one has ``max_rows`` rows or
+    ``max_bytes`` bytes, or when the wall clock (UTC) passes a multiple of
+    ``interval`` seconds, e.g. every full hour for ``3600``. Segments never
+    end in the middle of a batch written with :meth:`write_many`, so they
+    can exceed ``max_bytes`` by one batch. Without any limit, all rows are
+    written to a single segment.
+
+    Every segment is written to ``<name>.part`` and only renamed to its final
+    name after it was closed and synced, so all logfiles without the suffix
+    are complete and can be uploaded while recording continues. The record
+    numbers continue across the segments, so ``id`` and ``record`` still
+    identify a row. ``make_path``
+    returns the final name of a new segment, ``make_sink`` creates the
+    :class:`LogWriter` or :class:`BinaryLogWriter` for a path. A closed
+    segment is added to the ``manifest``.
+    '''
+
+    def __init__(
+            self,
+            make_path: Callable[[], str],
+            make_sink: Callable[[str], LogWriter | BinaryLogWriter],
+            logger: logging.Logger,
+            *,
+            manifest: UploadManifest | None = None,
+            max_rows: int | None = None,
+            max_bytes: int | None = None,
+            interval: float | None = None,
+    ) -> None:
+        self.make_path = make_path
+        self.make_sink = make_sink
+        self.logger = logger
+        self.manifest = manifest
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.interval = interval
+        # final path of the current segment
+        self.path = ''
+        # the closed segments
+        self.segments: list[str] = []
+        # the record number of the next row and of the first row of the
+        # current segment
+        self._record = 0
+        self._segment_start = 0
+        self._sink: LogWriter | BinaryLogWriter | None = None
+        # time.time() the current segment ends at
+        self._rotate_at = float('inf')
+
+    @property
+    def counter(self) -> int:
+        '''number of rows written to all segments'''
+        return self._record if self._sink is None else self._sink.counter
+
+    def open(self) -> None:
+        path = self.make_path()
+        # e.g. if a segment was filled within a second
+        base, ext = os.path.splitext(path)
+        nr = 0
+        while os.path.exists(path) or os.path.exists(path + PART_SUFFIX):
+            nr += 1
+            path = f'{base}_{nr}{ext}'
+        sink = self.make_sink(path + PART_SUFFIX)
+        sink.open()
+        # continue with the record numbers of the previous segment
+        sink.counter = self._segment_start = self.counter
+        self.path = path
+        self._sink = sink
+        self._rotate_at = self._next_boundary()
+
+    def _close_segment(self) -> None:
+        sink, self._sink = self._sink, None
+        if sink is None:
+            return
+        self._record = sink.counter
+        # the data must be on the storage before the file appears complete
+        sink.sync()
+        sink.close()
+        os.replace(sink.path, self.path)
+        self.segments.append(self.path)
+        if self.manifest is not None:
+            try:
+                self.manifest.record(self.path, sink.sha256)
+            except Exception as e:
+                # the manifest only saves the upload hashing the file again
+                self.logger.warning(
+                    f'failed adding {self.path} to the upload manifest: {e}',
+                )
+
+    def rotate(self) -> None:
+        '''close the current segment and start a new one'''
+        try:
+            self._close_segment()
+        finally:
+            # keep logging, even if the old segment could not be completed
+            self.open()
+        self.logger.info(f'writing measurement logs to {self.path}')
+
+    def _next_boundary(self) -> float:
+        '''the next multiple of ``interval`` as time.time()'''
+        if self.interval is None:
+            return float('inf')
+        return (time.time() // self.interval + 1) * self.interval
+
+    def seconds_until_rotation(self) -> float:
+        '''seconds until the wall-clock interval ends, ``inf`` if not set'''
+        return self._rotate_at - time.time()
+
+    def rotate_if_due(self) -> None:
+        if self._sink is None or self.seconds_until_rotation() > 0:
+            return
+        if self._sink.counter == self._segment_start:
+            # keep the empty segment instead of leaving a file without rows
+            self._rotate_at = self._next_boundary()
+        else:
+            self.rotate()
+
+    def _full(self, sink: LogWriter | BinaryLogWriter) -> bool:
+        return (
+            self.max_rows is not None and
+            sink.counter - self._segment_start >= self.max_rows or
+            self.max_bytes is not None and sink.size >= self.max_bytes
+        )
+
+    def write_many(self, samples: Sequence[Sample]) -> None:
+        '''write the rows, starting new segments where needed'''
+        if self._sink is None:
+            raise ValueError(f'logfile {self.path!r} is not open')
+
+        self.rotate_if_due()
+        start = 0
+        while start < len(samples):
+            assert self._sink is not None
+            if self._full(self._sink):
+                self.rotate()
+                assert self._sink is not None
+            end = len(samples)
+            if self.max_rows is not None:
+                rows = self._sink.counter - self._segment_start
+                end = min(end, start + self.max_rows - rows)
+            self._sink.write_many(samples[start:end])
+            start = end
+
+    def write(self, sample: Sample) -> None:
+        self.write_many((sample,))
+
+    def flush(self) -> None:
+        if self._sink is not None:
+            self._sink.flush()
+
+    def sync(self) -> None:
+        if self._sink is not None:
+            self._sink.sync()
+
+    def close(self) -> None:
+        self._close_segment()
+        self._rotate_at = float('inf')
+
+    def __enter__(self) -> RotatingLogWriter:
+        self.open()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'path={self.path!r}, '
+            f'counter={self.counter!r}, '
+            f'segments={len(self.segments)!r}'
+            ')'
+        )
+
+
+class BackgroundWriter(threading.Thread):
+    '''Write rows to a :class:`LogWriter` from a dedicated thread.
+
+    Rows are passed through a bounded queue, so :meth:`submit` never blocks
+    on disk I/O. If the queue is full, the row is dropped and counted. Rows
+    are committed in groups, once ``commit_rows`` rows are pending or the
+    oldest pending row is ``commit_interval`` seconds old.
+
+    The ``fsync`` policy controls when committed rows are forced to storage:
+
+    - ``always``: after every commit
+    - ``interval``: at most ``fsync_interval`` seconds after a commit
+    - ``never``: leave it to the OS
+
+    A :class:`RotatingLogWriter` is also rotated at the end of its interval
+    if no rows are written, e.g. while there is no GPS fix.
+    '''
+
+    def __init__(
+            self,
+            sink: LogWriter | BinaryLogWriter | RotatingLogWriter,
+            logger: logging.Logger,
+            *,
+            queue_size: int = 1024,
+            commit_rows: int = 32,
+            commit_interval: float = 1,
+            fsync: str = 'interval',
+            fsync_interval: float = 5,
+    ) -> None:
+        threading.Thread.__init__(self, name='writer')
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(
+                f'fsync must be one of {", ".join(FSYNC_POLICIES)}',
+            )
+        self.sink = sink
+        self.logger = logger
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self._queue: queue.Queue[Sample | None] = queue.Queue(queue_size)
+
+    @property
+    def counter(self) -> int:
+        '''number of rows written to the logfile'''
+        return self.sink.counter
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, sample: Sample) -> bool:
+        '''queue a row for writing, returns ``False`` if it was dropped'''
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                self.logger.warning(
+                    f'writer queue is full, dropped {self.dropped} rows',
+                )
+            return False
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return True
+
+    def run(self) -> None:
+        pending: list[Sample] = []
+        commit_due = sync_due = float('inf')
+        last_sync = time.monotonic()
+        stopping = False
+        while not stopping:
+            rotate_due = self._rotate_due()
+            timeout = min(commit_due, sync_due, rotate_due) - time.monotonic()
+            try:
+                if timeout == float('inf'):
+                    sample = self._queue.get()
+                else:
+                    sample = self._queue.get(timeout=max(timeout, 0))
+
+                if sample is None:
+                    stopping = True
+                else:
+                    if not pending:
+                        commit_due = time.monotonic() + self.commit_interval
+                    pending.append(sample)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            try:
+                if pending and (
+                        stopping or
+                        len(pending) >= self.commit_rows or
+                        now >= commit_due or
+                        now >= rotate_due
+                ):
+                    self.sink.write_many(pending)
+                    self.sink.flush()
+                    pending.clear()
+                    commit_due = float('inf')
+                    if self.fsync == 'always':
+                        sync_due = now
+                    elif self.fsync == 'interval':
+                        sync_due = min(
+                            sync_due, last_sync + self.fsync_interval,
+                        )
+
+                if now >= sync_due or (stopping and self.fsync != 'never'):
+                    self.sink.sync()
+                    last_sync = now
+                    sync_due = float('inf')
+
+                if now >= rotate_due and not stopping:
+                    assert isinstance(self.sink, RotatingLogWriter)
+                    self.sink.rotate_if_due()
+            except (OSError, ValueError) as e:
+                self.logger.error(f'failed writing to the logfile: {e}')
+                self.dropped += len(pending)
+                pending.clear()
+                commit_due = float('inf')
+
+        self.sink.close()
+        self.logger.info(
+            f'closed {self.sink.path}: {self.sink.counter} rows written, '
+            f'{self.dropped} dropped, max. queue depth {self.max_queue_depth}',
+        )
+
+    def _rotate_due(self) -> float:
+        '''time.monotonic() the sink starts a new segment at'''
+        if isinstance(self.sink, RotatingLogWriter):
+            return time.monotonic() + self.sink.seconds_until_rotation()
+        else:
+            return float('inf')
+
+    def close(self) -> None:
+        '''commit all queued rows, close the logfile and stop the thread'''
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        else:
+            self.sink.close()
+
+    def __repr__(self) -> str:
+        return (
+            f'{type(self).__name__}('
+            f'sink={self.sink!r}, '
+            f'fsync={self.fsync!r}, '
+            f'queue_depth={self.queue_depth!r}, '
+            f'dropped={self.dropped!r}'
+            ')'
+        )
+
+
+def _resume_counter(path: str, ncols: int = len(CNAMES)) -> int:
+    '''get the next record number from the last row of an existing logfile'''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        # a row is ~150 bytes, so this is enough to contain at least one
+        f.seek(max(0, size - 4096))
+        tail = f.read().splitlines()
+
+    # the last line might be incomplete e.g. after a power loss
+    if tail and tail[-1]:
+        fields = tail[-1].split(b',')
+        if len(fields) == ncols:
+            if fields[1] == b'record':
+                return 0
+            try:
+                return int(fields[1]) + 1
+            except ValueError:
+                pass
+
+    # fall back to counting the rows, this only happens once per file
+    with open(path, 'rb') as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+
+def finalize_parts(
+        log_dir: str,
+        logger: logging.Logger,
+        manifest: UploadManifest | None = None,
+) -> list[str]:
+    '''complete the segments left in ``log_dir`` as ``.part`` files, e.g.
+    after a power loss, and rename them so they are uploaded
+
+    An incomplete last row is terminated (csv) or cut off (binary) the same
+    way as when appending to the logfile.
+    '''
+    from crowdbike.binlog import BinaryLogWriter
+
+    done = []
+    for name in sorted(os.listdir(log_dir)):
+        final, suffix = os.path.splitext(name)
+        ext = os.path.splitext(final)[1]
+        if suffix != PART_SUFFIX or ext not in LOG_FORMATS.values():
+            continue
+        part = os.path.join(log_dir, name)
+        sink: LogWriter | BinaryLogWriter
+        if ext == LOG_FORMATS['binary']:
+            sink = BinaryLogWriter(
+                part, pi_id='', mac='', sensor_id='', version='',
+            )
+        else:
+            sink = LogWriter(part, pi_id='', mac='', sensor_id='', version='')
+        try:
+            sink.open()
+            sink.sync()
+            sink.close()
+        except Exception as e:
+            logger.error(f'failed completing the logfile {part}: {e}')
+            continue
+        path = os.path.join(log_dir, final)
+        os.replace(part, path)
+        if manifest is not None:
+            manifest.record(path, sink.sha256)
+        logger.warning(f'completed the interrupted logfile {path}')
+        done.append(path)
+    return done
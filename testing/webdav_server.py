@@ -0,0 +1,293 @@
+'''A minimal local stand-in for the public WebDAV endpoint of Nextcloud.
+
+It only implements what the uploader needs (``PUT`` and the chunked upload
+using ``MKCOL``, ``PUT`` and ``MOVE``) and keeps the uploaded files in
+memory. It can be used from tests and benchmarks:
+
+    with WebDavServer() as server:
+        uploader = WebDavUploader(server.url, server.folder_token, ...)
+        ...
+        assert 'file.csv' in server.files
+
+or started standalone: ``python -m testing.webdav_server --port 8080``
+'''
+from __future__ import annotations
+
+import argparse
+import base64
+import threading
+import time
+from collections import Counter
+from collections.abc import Sequence
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+DAV_PATH = '/public.php/webdav/'
+UPLOADS_PATH = '/public.php/dav/uploads/'
+FILES_PATH = '/public.php/dav/files/'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # required for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+    server: _Server
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def log_message(self, format: str, *args: object) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _respond(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _authenticated(self) -> bool:
+        credentials = base64.b64encode(
+            f'{self.server.folder_token}:{self.server.passwd}'.encode(),
+        ).decode()
+        if self.headers.get('Authorization') != f'Basic {credentials}':
+            self._respond(401)
+            return False
+        return True
+
+    def _name(self) -> str | None:
+        '''get the file name and check authentication'''
+        if not self._authenticated():
+            return None
+        if not self.path.startswith(DAV_PATH):
+            self._respond(404)
+            return None
+        return unquote(self.path[len(DAV_PATH):])
+
+    def _upload(self) -> tuple[str, str] | None:
+        '''get the upload id and the chunk name of a chunked upload'''
+        if not self._authenticated():
+            return None
+        prefix = f'{UPLOADS_PATH}{self.server.folder_token}/'
+        if not self.server.chunking or not self.path.startswith(prefix):
+            self._respond(404)
+            return None
+        upload_id, _, chunk = unquote(self.path[len(prefix):]).partition('/')
+        return upload_id, chunk
+
+    def _read(self, size: int) -> bytes:
+        '''read from the connection, limited to the configured bandwidth'''
+        if self.server.bandwidth is None:
+            return self.rfile.read(size)
+
+        chunks: list[bytes] = []
+        while size > 0:
+            chunk = self.rfile.read(min(size, 16 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+            time.sleep(len(chunk) / self.server.bandwidth)
+        return b''.join(chunks)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self._read(int(self.headers.get('Content-Length', 0)))
+
+        chunks: list[bytes] = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                # skip the trailer
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(self._read(size))
+            self.rfile.readline()
+
+    def do_MKCOL(self) -> None:
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        upload = self._upload()
+        if upload is None:
+            return
+        with self.server.lock:
+            if upload[0] in self.server.uploads:
+                self._respond(405)
+                return
+            self.server.uploads[upload[0]] = {}
+        self._respond(201)
+
+    def _put_chunk(self, upload_id: str, chunk: str) -> None:
+        body = self._read_body()
+        with self.server.lock:
+            self.server.stats['bytes_received'] += len(body)
+            if upload_id not in self.server.uploads:
+                self._respond(404)
+                return
+            if self.server.fail[chunk] > 0:
+                self.server.fail[chunk] -= 1
+                self._respond(503)
+                return
+            self.server.uploads[upload_id][chunk] = body
+        self._respond(201)
+
+    def do_MOVE(self) -> None:
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        upload = self._upload()
+        if upload is None:
+            return
+        upload_id, chunk = upload
+        destination = urlsplit(self.headers.get('Destination', '')).path
+        prefix = f'{FILES_PATH}{self.server.folder_token}/'
+        if chunk != '.file' or not destination.startswith(prefix):
+            self._respond(400)
+            return
+        name = unquote(destination[len(prefix):])
+        with self.server.lock:
+            chunks = self.server.uploads.pop(upload_id, None)
+            if chunks is None:
+                self._respond(404)
+                return
+            created = name not in self.server.files
+            self.server.files[name] = b''.join(
+                chunks[k] for k in sorted(chunks)
+            )
+        self._respond(201 if created else 204)
+
+    def do_PUT(self) -> None:
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if self.path.startswith(UPLOADS_PATH):
+            upload = self._upload()
+            if upload is not None:
+                self._put_chunk(*upload)
+            return
+
+        name = self._name()
+        if name is None:
+            return
+        body = self._read_body()
+        with self.server.lock:
+            self.server.stats['bytes_received'] += len(body)
+            if self.server.fail[name] > 0:
+                self.server.fail[name] -= 1
+                self._respond(503)
+                return
+            created = name not in self.server.files
+            self.server.files[name] = body
+        self._respond(201 if created else 204)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            address: tuple[str, int],
+            folder_token: str,
+            passwd: str,
+            verbose: bool,
+            bandwidth: float | None,
+            chunking: bool,
+    ) -> None:
+        super().__init__(address, _Handler)
+        self.folder_token = folder_token
+        self.passwd = passwd
+        self.verbose = verbose
+        self.bandwidth = bandwidth
+        self.chunking = chunking
+        self.lock = threading.Lock()
+        self.files: dict[str, bytes] = {}
+        # the chunks of unfinished chunked uploads by upload id
+        self.uploads: dict[str, dict[str, bytes]] = {}
+        self.stats: Counter[str] = Counter()
+        # number of times a request for a file name (or the name of a chunk)
+        # should fail with 503
+        self.fail: Counter[str] = Counter()
+
+
+class WebDavServer:
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 0,
+            *,
+            folder_token: str = 'abcde1234',
+            passwd: str = 'my_password',
+            verbose: bool = False,
+            bandwidth: float | None = None,
+            chunking: bool = True,
+    ) -> None:
+        '''
+        :param bandwidth: limit the upload bandwidth per connection to this
+            many bytes per second, to emulate e.g. a mobile connection
+        :param chunking: support the chunked upload (v2) of Nextcloud
+        '''
+        self.folder_token = folder_token
+        self.passwd = passwd
+        self._server = _Server(
+            (host, port), folder_token, passwd, verbose, bandwidth, chunking,
+        )
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            daemon=True,
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host!s}:{port}'
+
+    @property
+    def files(self) -> dict[str, bytes]:
+        return self._server.files
+
+    @property
+    def stats(self) -> Counter[str]:
+        return self._server.stats
+
+    @property
+    def uploads(self) -> dict[str, dict[str, bytes]]:
+        return self._server.uploads
+
+    @property
+    def fail(self) -> Counter[str]:
+        return self._server.fail
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> WebDavServer:
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    server = WebDavServer(args.host, args.port, verbose=True)
+    print(f'serving on {server.url}')
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())